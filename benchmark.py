@@ -0,0 +1,279 @@
+"""
+Benchmark Suite
+Times every stage of Macenko normalization and of the image file round
+trip on synthetic H&E tiles, writes the results to JSON and optionally
+checks them against a stored baseline
+"""
+
+import numpy as np
+import cv2
+from pathlib import Path
+import argparse
+import json
+import platform
+import tempfile
+import time
+from datetime import datetime
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import MACENKO_PARAMS, RANDOM_SEED
+from src.macenko_normalization import (
+    MacenkoNormalizer, angle_percentiles, get_concentrations, get_max_concentrations, rgb_to_od,
+    stain_matrix_from_angles, tissue_eigh, tissue_od
+)
+from src.run_pipeline import build_normalizer
+from src.synthetic_data import synthetic_he_tile
+from src.fused_kernel import HAVE_NUMBA
+
+# Tile sizes and default repeats per size
+BENCHMARK_SIZES = {150: 30, 768: 5, 4096: 1}
+
+# Relative slowdown against the baseline that fails the regression check
+REGRESSION_THRESHOLD = 0.25
+
+# Stages faster than this (ms) in the baseline are too noisy to check
+MIN_CHECKED_MS = 0.5
+
+
+def _timed(fn, *args):
+    """Run fn(*args) and return (result, seconds)."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def time_macenko_stages(img, normalizer):
+    """
+    Time each stage of `MacenkoNormalizer.transform` (default path) on one image.
+
+    The stages call the functions `transform` runs, in its order: OD
+    conversion and the steps of `get_stain_matrix` (tissue selection,
+    covariance eigen-decomposition, angle percentiles, stain vectors),
+    the `lstsq` concentration solve, the 99th percentiles and `reconstruct`.
+
+    Returns:
+    --------
+    dict : Stage -> seconds
+    """
+    timings = {}
+    Io, alpha, beta = normalizer.Io, normalizer.alpha, normalizer.beta
+
+    OD, timings['od'] = _timed(lambda: rgb_to_od(img.reshape((-1, 3)).astype(np.float64), Io))
+    ODhat, timings['mask'] = _timed(tissue_od, OD, beta)
+    (_, eigvecs), timings['cov_eigh'] = _timed(tissue_eigh, ODhat)
+    (minPhi, maxPhi), timings['angle_percentiles'] = _timed(angle_percentiles, ODhat, eigvecs, alpha)
+    HE, timings['stain_vectors'] = _timed(stain_matrix_from_angles, eigvecs, minPhi, maxPhi)
+    C, timings['lstsq'] = _timed(get_concentrations, OD, HE)
+    maxC, timings['max_concentrations'] = _timed(get_max_concentrations, C)
+    _, timings['reconstruction'] = _timed(normalizer.reconstruct, C, maxC, img.shape)
+    return timings
+
+
+def time_file_stages(img, normalizer, directory):
+    """
+    Time each stage of `normalize_image_file` on one image (PNG round trip).
+
+    Returns:
+    --------
+    dict : Stage -> seconds
+    """
+    timings = {}
+    path = Path(directory) / "benchmark.png"
+    cv2.imwrite(str(path), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+
+    data, timings['read'] = _timed(lambda: np.fromfile(str(path), dtype=np.uint8))
+    bgr, timings['decode'] = _timed(cv2.imdecode, data, cv2.IMREAD_COLOR)
+    rgb, t_in = _timed(cv2.cvtColor, bgr, cv2.COLOR_BGR2RGB)
+    normalized, timings['normalize'] = _timed(normalizer.transform, rgb)
+    out_bgr, t_out = _timed(cv2.cvtColor, normalized, cv2.COLOR_RGB2BGR)
+    timings['color_conversion'] = t_in + t_out
+    (_, encoded), timings['encode'] = _timed(cv2.imencode, '.png', out_bgr)
+    _, timings['write'] = _timed(lambda: path.write_bytes(encoded.tobytes()))
+
+    return timings
+
+
+def normalizer_variants():
+    """
+    Normalizer configurations timed end to end (the Numba kernel only if installed).
+
+    'transform_configured' is the pipeline's normalizer (MACENKO_PARAMS,
+    with whichever modes are configured there).
+    """
+    params = dict(
+        Io=MACENKO_PARAMS['Io'],
+        alpha=MACENKO_PARAMS['alpha'],
+        beta=MACENKO_PARAMS['beta'],
+        HERef=MACENKO_PARAMS['HERef'],
+        maxCRef=MACENKO_PARAMS['maxCRef'],
+    )
+    variants = {
+        'transform': MacenkoNormalizer(**params),
+        'transform_fast': MacenkoNormalizer(**params, fast=True),
+        'transform_float32': MacenkoNormalizer(**params, dtype='float32'),
+        'transform_chunked': MacenkoNormalizer(**params, chunk_pixels=65536),
+        'transform_unique_colors': MacenkoNormalizer(**params, unique_colors=True),
+        'transform_fused_numpy': MacenkoNormalizer(**params, fused='numpy'),
+    }
+    if HAVE_NUMBA:
+        variants['transform_fused_numba'] = MacenkoNormalizer(**params, fused='numba')
+    variants['transform_configured'] = build_normalizer()
+    return variants
+
+
+def run_benchmark(sizes, repeats=None):
+    """
+    Run every benchmark on synthetic tiles of the given sizes.
+
+    Parameters:
+    -----------
+    sizes : list
+        Tile edge lengths in pixels
+    repeats : int
+        Repeats per size (default: BENCHMARK_SIZES, or 3 for other sizes)
+
+    Returns:
+    --------
+    dict : Size (str) -> group -> stage -> median milliseconds
+    """
+    variants = normalizer_variants()
+
+    # Untimed warm-up (compiles the Numba kernels on first use)
+    warmup = synthetic_he_tile(64, seed=RANDOM_SEED)
+    for normalizer in variants.values():
+        normalizer.transform(warmup)
+
+    results = {}
+    for size in sizes:
+        n = repeats or BENCHMARK_SIZES.get(size, 3)
+        img = synthetic_he_tile(size, seed=RANDOM_SEED)
+        print(f"  {size}x{size}: {n} repeat(s)")
+
+        samples = {'macenko': {}, 'file': {}, 'end_to_end': {}}
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in range(n):
+                for group, timings in (
+                    ('macenko', time_macenko_stages(img, variants['transform'])),
+                    ('file', time_file_stages(img, variants['transform'], directory)),
+                    ('end_to_end', {name: _timed(normalizer.transform, img)[1]
+                                    for name, normalizer in variants.items()}),
+                ):
+                    for stage, seconds in timings.items():
+                        samples[group].setdefault(stage, []).append(seconds)
+
+        results[str(size)] = {
+            group: {stage: 1e3 * float(np.median(values)) for stage, values in stages.items()}
+            for group, stages in samples.items()
+        }
+        results[str(size)]['end_to_end']['megapixels_per_s'] = (
+            size * size / 1e6 / (results[str(size)]['end_to_end']['transform'] / 1e3)
+        )
+
+    return results
+
+
+def check_regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Stages slower than the baseline by more than `threshold` (relative).
+
+    Only sizes and stages present in both runs are compared; rates and
+    stages below MIN_CHECKED_MS in the baseline are skipped.
+
+    Returns:
+    --------
+    list : (size, group, stage, baseline_ms, current_ms) tuples
+    """
+    regressions = []
+    for size, groups in results.items():
+        for group, stages in groups.items():
+            for stage, current in stages.items():
+                if stage.endswith('_per_s'):
+                    continue
+                reference = baseline.get(size, {}).get(group, {}).get(stage)
+                if reference is None or reference < MIN_CHECKED_MS:
+                    continue
+                if current > reference * (1 + threshold):
+                    regressions.append((size, group, stage, reference, current))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    """Print the timing tables (with the change against the baseline, if given)."""
+    for size, groups in results.items():
+        print(f"\n{size}x{size}")
+        for group, stages in groups.items():
+            print(f"  {group}")
+            for stage, value in stages.items():
+                unit = "" if stage.endswith('_per_s') else " ms"
+                line = f"    {stage:<24} {value:>12.3f}{unit}"
+                reference = (baseline or {}).get(size, {}).get(group, {}).get(stage)
+                if reference:
+                    line += f"   ({100 * (value / reference - 1):+.1f}% vs baseline)"
+                print(line)
+
+
+def main():
+    """Run the benchmark suite and the optional regression check."""
+    parser = argparse.ArgumentParser(description="Macenko normalization benchmark suite")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES),
+                        help="Tile sizes (default: %(default)s)")
+    parser.add_argument('--repeats', type=int, default=None,
+                        help="Repeats per size (default: per-size defaults)")
+    parser.add_argument('--output', default="results/benchmarks/benchmark.json",
+                        help="Result JSON (default: %(default)s)")
+    parser.add_argument('--baseline', default=None,
+                        help="Baseline JSON from a previous run to check against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Allowed relative slowdown per stage (default: %(default)s)")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("MACENKO NORMALIZATION BENCHMARK")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    results = run_benchmark(args.sizes, args.repeats)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print_results(results, baseline)
+
+    report = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+        },
+        'results': results,
+    }
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to: {output}")
+
+    if baseline is None:
+        return 0
+
+    regressions = check_regressions(results, baseline, args.threshold)
+    print("\n" + "="*60)
+    print(f"REGRESSION CHECK (threshold +{100 * args.threshold:.0f}%)")
+    print("="*60)
+    if not regressions:
+        print("  No regressions")
+        return 0
+    for size, group, stage, reference, current in regressions:
+        print(f"  REGRESSION {size}x{size} {group}/{stage}: "
+              f"{reference:.3f} ms -> {current:.3f} ms")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
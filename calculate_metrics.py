@@ -10,23 +10,43 @@ import pandas as pd
 from skimage.metrics import peak_signal_noise_ratio as psnr
 from skimage.metrics import structural_similarity as ssim
 from datetime import datetime
+from multiprocessing import Pool
 from tqdm import tqdm
+import argparse
+import csv
+import json
 import sys
 
 sys.path.append(str(Path(__file__).parent.parent))
-from config.pipeline_config import DATASETS, RANDOM_SEED
+from config.pipeline_config import DATASETS, PROCESSING, RANDOM_SEED
+from src.dataset_catalog import DatasetCatalog, image_groups
+from src.partitioning import add_shard_arguments, check_shard_arguments, select_shard, shard_suffix
 
 
-def calculate_image_metrics(original_path, normalized_path, channel_mode='rgb'):
+# Metric columns of metrics_detailed.csv (summarized in metrics.csv)
+METRICS = ('psnr_db', 'ssim', 'rmse')
+
+# pipeline.log titles of the metrics from this script and from run_pipeline --metrics
+METRICS_TITLE = "Phase 4 - Metrics Calculation COMPLETED"
+FUSED_METRICS_TITLE = "Phase 2 - Fused Metrics (in-memory arrays)"
+
+# Normalized image suffixes that are paired with their originals
+METRIC_SUFFIXES = ('.jpeg', '.jpg', '.png', '.tif')
+
+# State of the current process (installed once per worker)
+_worker = {}
+
+
+def compute_metrics(orig_rgb, norm_rgb, channel_mode='rgb'):
     """
-    Calculate PSNR, SSIM, and RMSE between two images.
+    Calculate PSNR, SSIM, and RMSE between two in-memory RGB images.
 
     Parameters:
     -----------
-    original_path : Path
-        Path to original image
-    normalized_path : Path
-        Path to normalized image
+    orig_rgb : np.ndarray
+        Original RGB image (H x W x 3, uint8)
+    norm_rgb : np.ndarray
+        Normalized RGB image (H x W x 3, uint8)
     channel_mode : str
         'rgb' for 3-channel or 'gray' for single channel
 
@@ -34,17 +54,6 @@ def calculate_image_metrics(original_path, normalized_path, channel_mode='rgb'):
     --------
     dict : Dictionary with PSNR, SSIM, RMSE values
     """
-    # Read images
-    orig = cv2.imread(str(original_path))
-    norm = cv2.imread(str(normalized_path))
-
-    if orig is None or norm is None:
-        return None
-
-    # Convert BGR to RGB
-    orig_rgb = cv2.cvtColor(orig, cv2.COLOR_BGR2RGB)
-    norm_rgb = cv2.cvtColor(norm, cv2.COLOR_BGR2RGB)
-
     if channel_mode == 'gray':
         # Convert to grayscale
         orig_gray = cv2.cvtColor(orig_rgb, cv2.COLOR_RGB2GRAY)
@@ -71,7 +80,225 @@ def calculate_image_metrics(original_path, normalized_path, channel_mode='rgb'):
     }
 
 
-def process_dataset(dataset_name, original_dir, normalized_dir, channel_mode='rgb'):
+def calculate_image_metrics(original_path, normalized_path, channel_mode='rgb'):
+    """
+    Calculate PSNR, SSIM, and RMSE between two image files.
+
+    Parameters:
+    -----------
+    original_path : Path
+        Path to original image
+    normalized_path : Path
+        Path to normalized image
+    channel_mode : str
+        'rgb' for 3-channel or 'gray' for single channel
+
+    Returns:
+    --------
+    dict : Dictionary with PSNR, SSIM, RMSE values
+    """
+    # Read images
+    orig = cv2.imread(str(original_path))
+    norm = cv2.imread(str(normalized_path))
+
+    if orig is None or norm is None:
+        return None
+
+    # Convert BGR to RGB
+    orig_rgb = cv2.cvtColor(orig, cv2.COLOR_BGR2RGB)
+    norm_rgb = cv2.cvtColor(norm, cv2.COLOR_BGR2RGB)
+
+    return compute_metrics(orig_rgb, norm_rgb, channel_mode)
+
+
+class RunningStats:
+    """Online count / mean / sample standard deviation (Welford)."""
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """Sample standard deviation (ddof=1, NaN for fewer than 2 values, as pandas)."""
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else float('nan')
+
+
+class MetricsWriter:
+    """
+    Streams per-image metrics into metrics_detailed.csv and aggregates the
+    summaries online, so memory does not grow with the number of images.
+
+    Running mean / std are kept per dataset (written to metrics.csv on
+    `close`) and per dataset and class folder / split (metrics_by_group.csv).
+    Used by calculate_metrics.py and by run_pipeline.py (fused metrics).
+
+    Runs over one shard of the datasets (see partitioning.py) tag the file
+    names with `suffix` and add the relative path of every image as a
+    'path' column, which the merge needs to restore the unsharded order.
+    They also write the pipeline.log `title` of the metrics to
+    metrics_source{suffix}.json, so the merge logs them under it.
+    """
+
+    COLUMNS = ['dataset', 'image'] + list(METRICS)
+
+    def __init__(self, output_dir="results/tables", suffix="", with_paths=False,
+                 title=METRICS_TITLE):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.detailed_path = self.output_dir / f"metrics_detailed{suffix}.csv"
+        self.summary_path = self.output_dir / f"metrics{suffix}.csv"
+        self.groups_path = self.output_dir / f"metrics_by_group{suffix}.csv"
+        self.source_path = self.output_dir / f"metrics_source{suffix}.json"
+        self.with_paths = with_paths
+        self.title = title
+        self.count = 0
+
+        # (level, dataset, group) -> metric -> RunningStats
+        self.stats = {}
+
+        self._file = open(self.detailed_path, 'w', newline='')
+        columns = self.COLUMNS + ['path'] if with_paths else self.COLUMNS
+        self._writer = csv.DictWriter(self._file, fieldnames=columns)
+        self._writer.writeheader()
+        if with_paths:
+            with open(self.source_path, 'w') as f:
+                json.dump({'title': title}, f)
+
+    def _update(self, key, metrics):
+        stats = self.stats.setdefault(key, {name: RunningStats() for name in METRICS})
+        for name in METRICS:
+            stats[name].update(metrics[name])
+
+    def add(self, dataset, image, metrics, relative_path=None):
+        """
+        Append one image's metrics (keys psnr_db, ssim, rmse).
+
+        `relative_path` (relative to the dataset root, default: `image`)
+        assigns the image to its class folder and split.
+        """
+        row = {'dataset': dataset, 'image': image, **metrics}
+        if self.with_paths:
+            row['path'] = Path(relative_path if relative_path is not None else image).as_posix()
+        self._writer.writerow(row)
+        self.count += 1
+        if self.count % 100 == 0:
+            self._file.flush()
+
+        image_class, split = image_groups(relative_path if relative_path is not None else image)
+        self._update(('dataset', dataset, ''), metrics)
+        self._update(('class', dataset, image_class), metrics)
+        if split:
+            self._update(('split', dataset, split), metrics)
+
+    def _summary_rows(self, level, dataset=None):
+        rows = []
+        for (key_level, key_dataset, group), stats in self.stats.items():
+            if key_level != level or (dataset is not None and key_dataset != dataset):
+                continue
+            row = {'dataset': key_dataset, 'method': 'Macenko Normalization',
+                   'n_images': stats['psnr_db'].count}
+            for name in METRICS:
+                prefix = 'psnr' if name == 'psnr_db' else name
+                row[f'{prefix}_mean'] = stats[name].mean
+                row[f'{prefix}_std'] = stats[name].std
+            if level != 'dataset':
+                row = {'level': level, 'group': group, **row}
+            rows.append(row)
+        return rows
+
+    def close(self, datasets=('LC25000', 'CRC5000')):
+        """
+        Finish metrics_detailed.csv and write metrics.csv and metrics_by_group.csv.
+
+        Returns:
+        --------
+        pd.DataFrame : Per-dataset summary table (metrics.csv)
+        """
+        self._file.close()
+
+        summary_rows = []
+        for dataset in datasets:
+            for summary in self._summary_rows('dataset', dataset):
+                summary_rows.append(summary)
+                print_summary(summary)
+        summary_df = pd.DataFrame(summary_rows)
+        summary_df.to_csv(self.summary_path, index=False)
+
+        group_rows = self._summary_rows('split') + self._summary_rows('class')
+        pd.DataFrame(group_rows).to_csv(self.groups_path, index=False)
+
+        return summary_df
+
+
+def print_summary(summary):
+    """Print one per-dataset summary row."""
+    print(f"\n{summary['dataset']}:")
+    print(f"  Images: {summary['n_images']}")
+    print(f"  PSNR: {summary['psnr_mean']:.2f} ± {summary['psnr_std']:.2f} dB")
+    print(f"  SSIM: {summary['ssim_mean']:.4f} ± {summary['ssim_std']:.4f}")
+    print(f"  RMSE: {summary['rmse_mean']:.2f} ± {summary['rmse_std']:.2f}")
+
+
+def _read_rgb(path):
+    img = cv2.imread(str(path))
+    return None if img is None else cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def _fast_metrics_chunk(chunk, channel_mode):
+    """
+    Metrics of a chunk with the batched float32 kernel (src.fast_metrics).
+
+    Pairs are decoded, grouped by image shape and each group is computed as
+    one stack; results come back in chunk order.
+    """
+    from src.fast_metrics import compute_metrics_batch
+
+    results = [None] * len(chunk)
+    groups = {}
+    for i, (orig_path, norm_path) in enumerate(chunk):
+        orig_rgb, norm_rgb = _read_rgb(orig_path), _read_rgb(norm_path)
+        if orig_rgb is None or norm_rgb is None:
+            continue
+        if orig_rgb.shape != norm_rgb.shape:
+            results[i] = compute_metrics(orig_rgb, norm_rgb, channel_mode)
+            continue
+        groups.setdefault(orig_rgb.shape, []).append((i, orig_rgb, norm_rgb))
+
+    for members in groups.values():
+        indices, origs, norms = zip(*members)
+        for i, metrics in zip(indices, compute_metrics_batch(np.stack(origs), np.stack(norms),
+                                                             channel_mode)):
+            results[i] = metrics
+    return results
+
+
+def _metrics_chunk(chunk):
+    """Metrics of a chunk of (orig_path, norm_path) pairs; one dict or None per pair."""
+    if _worker.get('fast'):
+        return _fast_metrics_chunk(chunk, _worker['channel_mode'])
+    return [calculate_image_metrics(orig_path, norm_path, _worker['channel_mode'])
+            for orig_path, norm_path in chunk]
+
+
+def _init_worker(channel_mode, fast=False):
+    """Pool initializer: per-process options; keep OpenCV single-threaded."""
+    _worker['channel_mode'] = channel_mode
+    _worker['fast'] = fast
+    cv2.setNumThreads(1)
+
+
+def process_dataset(dataset_name, original_dir, normalized_dir, writer, channel_mode='rgb',
+                    workers=1, chunk_size=32, fast=False, shard_index=0, num_shards=1):
     """
     Process a dataset and calculate metrics for all image pairs.
 
@@ -83,12 +310,22 @@ def process_dataset(dataset_name, original_dir, normalized_dir, channel_mode='rg
         Directory with original images
     normalized_dir : Path
         Directory with normalized images
+    writer : MetricsWriter
+        Receives the metrics of every image, in file order
     channel_mode : str
         'rgb' or 'gray'
+    workers : int
+        Number of worker processes (1 = serial)
+    chunk_size : int
+        Image pairs per worker task
+    fast : bool
+        Use the batched float32 kernel (src.fast_metrics) instead of skimage
+    shard_index, num_shards : int
+        Only process the images of this shard (see partitioning.py)
 
     Returns:
     --------
-    pd.DataFrame : DataFrame with metrics for each image
+    tuple : (processed, skipped) image counts
     """
     print(f"\n{'='*60}")
     print(f"Processing {dataset_name}")
@@ -98,134 +335,135 @@ def process_dataset(dataset_name, original_dir, normalized_dir, channel_mode='rg
     normalized_dir = Path(normalized_dir)
 
     # Find all normalized images
-    norm_images = list(normalized_dir.rglob('*.jpeg')) + \
-                  list(normalized_dir.rglob('*.jpg')) + \
-                  list(normalized_dir.rglob('*.png')) + \
-                  list(normalized_dir.rglob('*.tif'))
+    norm_images = DatasetCatalog(normalized_dir).files(METRIC_SUFFIXES)
 
     print(f"Found {len(norm_images)} normalized images")
+    if num_shards > 1:
+        norm_images = select_shard(norm_images, normalized_dir, shard_index, num_shards)
+        print(f"Shard {shard_index}/{num_shards}: {len(norm_images)} images")
 
-    results = []
+    # Find corresponding original images
+    originals = DatasetCatalog(original_dir)
+    pairs = []
     skipped = 0
-
-    for norm_path in tqdm(norm_images, desc=f"Calculating metrics for {dataset_name}"):
-        # Find corresponding original image
-        relative_path = norm_path.relative_to(normalized_dir)
-        orig_path = original_dir / relative_path
-
-        if not orig_path.exists():
-            # Try alternative locations (original structure might differ)
-            orig_path = original_dir / norm_path.name
-
-        if not orig_path.exists():
+    for norm_path in norm_images:
+        # Try alternative locations (original structure might differ)
+        orig_path = originals.find(norm_path.relative_to(normalized_dir))
+        if orig_path is None:
             skipped += 1
             continue
-
-        # Calculate metrics
-        metrics = calculate_image_metrics(orig_path, norm_path, channel_mode)
-
-        if metrics is not None:
-            results.append({
-                'dataset': dataset_name,
-                'image': norm_path.name,
-                'psnr_db': metrics['psnr'],
-                'ssim': metrics['ssim'],
-                'rmse': metrics['rmse']
-            })
-
-    print(f"Processed: {len(results)} images")
+        pairs.append((orig_path, norm_path))
+
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    processed = 0
+
+    def record(chunk, results):
+        nonlocal processed
+        for (orig_path, norm_path), metrics in zip(chunk, results):
+            if metrics is not None:
+                writer.add(dataset_name, norm_path.name, {
+                    'psnr_db': metrics['psnr'],
+                    'ssim': metrics['ssim'],
+                    'rmse': metrics['rmse']
+                }, relative_path=norm_path.relative_to(normalized_dir))
+                processed += 1
+
+    with tqdm(total=len(pairs), desc=f"Calculating metrics for {dataset_name}") as pbar:
+        if workers <= 1:
+            _worker.update(channel_mode=channel_mode, fast=fast)
+            for chunk in chunks:
+                record(chunk, _metrics_chunk(chunk))
+                pbar.update(len(chunk))
+        else:
+            with Pool(processes=workers, initializer=_init_worker,
+                      initargs=(channel_mode, fast)) as pool:
+                for chunk, results in zip(chunks, pool.imap(_metrics_chunk, chunks)):
+                    record(chunk, results)
+                    pbar.update(len(chunk))
+
+    print(f"Processed: {processed} images")
     print(f"Skipped: {skipped} images (original not found)")
 
-    return pd.DataFrame(results)
+    return processed, skipped
+
+
+def log_summary(summary_df, log_path, title, method="RGB 3-channel metrics (PSNR, SSIM, RMSE)"):
+    """Append the per-dataset summary to pipeline.log."""
+    with open(log_path, 'a') as f:
+        f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {title}\n")
+        f.write(f"Method: {method}\n")
+        for _, row in summary_df.iterrows():
+            f.write(f"  {row['dataset']}: n={row['n_images']}, ")
+            f.write(f"PSNR={row['psnr_mean']:.2f}±{row['psnr_std']:.2f} dB, ")
+            f.write(f"SSIM={row['ssim_mean']:.4f}±{row['ssim_std']:.4f}, ")
+            f.write(f"RMSE={row['rmse_mean']:.2f}±{row['rmse_std']:.2f}\n")
 
 
 def main():
     """Main function to calculate metrics for all datasets."""
+    parser = argparse.ArgumentParser(description="Metrics calculation (PSNR, SSIM, RMSE)")
+    parser.add_argument('--workers', type=int, default=PROCESSING['workers'],
+                        help="Number of worker processes (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int, default=32,
+                        help="Image pairs per worker task (default: %(default)s)")
+    parser.add_argument('--fast-metrics', action='store_true', default=PROCESSING['fast_metrics'],
+                        help="Batched float32 SSIM/PSNR/RMSE kernel instead of skimage "
+                             "(validated by python -m src.fast_metrics)")
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    suffix = shard_suffix(args.shard_index, args.num_shards)
+
     print("="*60)
     print("METRICS CALCULATION - Phase 4")
     print("="*60)
     print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"Metrics: PSNR (dB), SSIM [0-1], RMSE")
     print(f"Channel mode: RGB (3-channel average)")
+    print(f"Implementation: {'fast batched float32' if args.fast_metrics else 'skimage'}")
+    if args.num_shards > 1:
+        print(f"Shard: {args.shard_index} of {args.num_shards}")
     print()
 
     # Set random seed
     np.random.seed(RANDOM_SEED)
 
-    all_results = []
+    # Rows are streamed to metrics_detailed.csv as they are computed
+    # (per-shard files, merged by `python -m src.partitioning`)
+    writer = MetricsWriter("results/tables", suffix=suffix, with_paths=args.num_shards > 1)
 
     # Process LC25000
     lc_original = "data/processed/LC25000/LC25000"
     lc_normalized = "data/processed/LC25000/macenko_norm"
-    lc_df = process_dataset("LC25000", lc_original, lc_normalized, channel_mode='rgb')
-    all_results.append(lc_df)
+    process_dataset("LC25000", lc_original, lc_normalized, writer, channel_mode='rgb',
+                    workers=args.workers, chunk_size=args.chunk_size,
+                    fast=args.fast_metrics, shard_index=args.shard_index,
+                    num_shards=args.num_shards)
 
     # Process CRC5000
     crc_original = "data/processed/CRC5000/Kather_texture_2016_image_tiles_5000"
     crc_normalized = "data/processed/CRC5000/macenko_norm"
-    crc_df = process_dataset("CRC5000", crc_original, crc_normalized, channel_mode='rgb')
-    all_results.append(crc_df)
-
-    # Combine all results
-    combined_df = pd.concat(all_results, ignore_index=True)
+    process_dataset("CRC5000", crc_original, crc_normalized, writer, channel_mode='rgb',
+                    workers=args.workers, chunk_size=args.chunk_size,
+                    fast=args.fast_metrics, shard_index=args.shard_index,
+                    num_shards=args.num_shards)
 
     # Calculate summary statistics per dataset
     print("\n" + "="*60)
     print("SUMMARY STATISTICS")
     print("="*60)
 
-    summary_rows = []
-    for dataset in ['LC25000', 'CRC5000']:
-        dataset_metrics = combined_df[combined_df['dataset'] == dataset]
-
-        if len(dataset_metrics) > 0:
-            summary = {
-                'dataset': dataset,
-                'method': 'Macenko Normalization',
-                'n_images': len(dataset_metrics),
-                'psnr_mean': dataset_metrics['psnr_db'].mean(),
-                'psnr_std': dataset_metrics['psnr_db'].std(),
-                'ssim_mean': dataset_metrics['ssim'].mean(),
-                'ssim_std': dataset_metrics['ssim'].std(),
-                'rmse_mean': dataset_metrics['rmse'].mean(),
-                'rmse_std': dataset_metrics['rmse'].std()
-            }
-            summary_rows.append(summary)
-
-            print(f"\n{dataset}:")
-            print(f"  Images: {summary['n_images']}")
-            print(f"  PSNR: {summary['psnr_mean']:.2f} ± {summary['psnr_std']:.2f} dB")
-            print(f"  SSIM: {summary['ssim_mean']:.4f} ± {summary['ssim_std']:.4f}")
-            print(f"  RMSE: {summary['rmse_mean']:.2f} ± {summary['rmse_std']:.2f}")
-
-    summary_df = pd.DataFrame(summary_rows)
-
-    # Save results
-    output_dir = Path("results/tables")
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # Save detailed metrics
-    detailed_path = output_dir / "metrics_detailed.csv"
-    combined_df.to_csv(detailed_path, index=False)
-    print(f"\nDetailed metrics saved to: {detailed_path}")
-
-    # Save summary metrics
-    summary_path = output_dir / "metrics.csv"
-    summary_df.to_csv(summary_path, index=False)
-    print(f"Summary metrics saved to: {summary_path}")
+    summary_df = writer.close()
+
+    print(f"\nDetailed metrics saved to: {writer.detailed_path}")
+    print(f"Summary metrics saved to: {writer.summary_path}")
+    print(f"Per class/split metrics saved to: {writer.groups_path}")
 
     # Save log
     log_dir = Path("results/logs")
-    log_path = log_dir / "pipeline.log"
+    log_path = log_dir / f"pipeline{suffix}.log"
 
-    with open(log_path, 'a') as f:
-        f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Phase 4 - Metrics Calculation COMPLETED\n")
-        f.write(f"Method: RGB 3-channel metrics (PSNR, SSIM, RMSE)\n")
-        for _, row in summary_df.iterrows():
-            f.write(f"  {row['dataset']}: n={row['n_images']}, ")
-            f.write(f"PSNR={row['psnr_mean']:.2f}±{row['psnr_std']:.2f} dB, ")
-            f.write(f"SSIM={row['ssim_mean']:.4f}±{row['ssim_std']:.4f}, ")
-            f.write(f"RMSE={row['rmse_mean']:.2f}±{row['rmse_std']:.2f}\n")
+    log_summary(summary_df, log_path, writer.title)
 
     print(f"\nLog updated: {log_path}")
     print(f"\nEnd time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -0,0 +1,219 @@
+"""
+Dataset Catalog
+One os.scandir walk per dataset directory, recording path, size, mtime,
+class folder and split of every file, persisted to an index that is only
+rebuilt when a directory in the tree changes
+"""
+
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, PROCESSING, RANDOM_SEED
+
+# Suffixes of the dataset images (run_pipeline also reads .tiff)
+IMAGE_SUFFIXES = ('.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+# Bumped when the index layout changes
+CATALOG_VERSION = 1
+
+
+def image_groups(relative_path):
+    """
+    (class, split) of an image from its path relative to the dataset root.
+
+    The class is the parent folder; the split is the top-level folder when
+    the class folder is nested in one (e.g. LC25000 train/lung_aca/x.jpeg),
+    otherwise ''.
+    """
+    parts = Path(relative_path).parts
+    image_class = parts[-2] if len(parts) >= 2 else ''
+    split = parts[0] if len(parts) >= 3 else ''
+    return image_class, split
+
+
+def _walk(root):
+    """
+    Walk `root` with os.scandir.
+
+    Returns:
+    --------
+    tuple : (files, directories); files are (relative_path, size, mtime_ns)
+            and directories map relative path ('' = root) -> mtime_ns
+    """
+    files = []
+    directories = {}
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        directory = os.path.join(root, relative_dir)
+        directories[relative_dir] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as it:
+            for entry in it:
+                relative = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_dir():
+                    pending.append(relative)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((relative, stat.st_size, stat.st_mtime_ns))
+    return files, directories
+
+
+class DatasetCatalog:
+    """
+    Cached listing of every file under a dataset directory.
+
+    The first use walks the tree once and writes the index (JSON) to
+    `index_dir`; later uses load it and only re-walk when the mtime of a
+    recorded directory has changed (files added, removed or renamed) or a
+    directory has disappeared. Rewriting a file in place does not change
+    its directory's mtime; pass `refresh=True` to force a walk.
+
+    Entries are sorted by relative path, so listings and samples do not
+    depend on the file system's directory order.
+
+    Parameters:
+    -----------
+    root : str or Path
+        Dataset directory
+    index_dir : str or Path
+        Directory of the persisted indexes (None = keep in memory only)
+    refresh : bool
+        Re-walk even if the stored index is current
+    """
+
+    def __init__(self, root, index_dir=PROCESSING['catalog_dir'], refresh=False):
+        self.root = Path(root)
+        self.index_path = None
+        if index_dir is not None:
+            key = hashlib.blake2b(str(self.root.resolve()).encode(), digest_size=8).hexdigest()
+            self.index_path = Path(index_dir) / f"{self.root.name or 'root'}_{key}.json"
+
+        self.rescanned = False
+        self.entries = []
+        self.directories = {}
+        self._lookup = None
+        if not self.root.is_dir():
+            return
+
+        if refresh or not self._load():
+            self._scan()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load(self):
+        """Load the stored index; False if it is missing, stale or unreadable."""
+        if self.index_path is None or not self.index_path.exists():
+            return False
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if index.get('version') != CATALOG_VERSION:
+            return False
+
+        for relative_dir, mtime_ns in index['directories'].items():
+            try:
+                if os.stat(self.root / relative_dir).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+
+        self.directories = index['directories']
+        self.entries = [dict(zip(index['columns'], row)) for row in index['files']]
+        return True
+
+    def _scan(self):
+        """Walk the tree, rebuild the entries and persist the index."""
+        files, self.directories = _walk(self.root)
+        self.entries = []
+        for relative, size, mtime_ns in sorted(files, key=lambda f: Path(f[0])):
+            image_class, split = image_groups(relative)
+            self.entries.append({'path': relative, 'size': size, 'mtime_ns': mtime_ns,
+                                 'class': image_class, 'split': split})
+        self.rescanned = True
+
+        if self.index_path is not None:
+            columns = ['path', 'size', 'mtime_ns', 'class', 'split']
+            index = {
+                'version': CATALOG_VERSION,
+                'root': str(self.root),
+                'columns': columns,
+                'directories': self.directories,
+                'files': [[entry[c] for c in columns] for entry in self.entries],
+            }
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            partial = self.index_path.with_name(f".{self.index_path.name}.partial")
+            with open(partial, 'w') as f:
+                json.dump(index, f)
+            os.replace(partial, self.index_path)
+
+    def select(self, suffixes=None):
+        """Entries whose file suffix is in `suffixes` (case-sensitive; None = all)."""
+        if suffixes is None:
+            return list(self.entries)
+        suffixes = tuple(suffixes)
+        return [entry for entry in self.entries if entry['path'].endswith(suffixes)]
+
+    def files(self, suffixes=None):
+        """Paths (root / relative path) of the selected files, sorted."""
+        return [self.root / entry['path'] for entry in self.select(suffixes)]
+
+    def find(self, relative_path):
+        """
+        File matching a path from another tree (e.g. a normalized image).
+
+        Looks up the same relative path first, then falls back to the first
+        file (in path order) with the same name, for trees whose structure
+        differs. Returns None if there is no match.
+        """
+        if self._lookup is None:
+            by_name = {}
+            for entry in self.entries:
+                by_name.setdefault(entry['path'].rsplit('/', 1)[-1], entry)
+            self._lookup = ({entry['path']: entry for entry in self.entries}, by_name)
+
+        by_relative, by_name = self._lookup
+        relative_path = Path(relative_path)
+        entry = by_relative.get(relative_path.as_posix()) or by_name.get(relative_path.name)
+        return None if entry is None else self.root / entry['path']
+
+    def sample(self, n, suffixes=IMAGE_SUFFIXES, seed=RANDOM_SEED):
+        """`n` files drawn without replacement with a seeded RNG (fewer if the tree is smaller)."""
+        files = self.files(suffixes)
+        return random.Random(seed).sample(files, min(n, len(files)))
+
+
+def main():
+    """Build or refresh the catalogs of the input and output directories of every dataset."""
+    parser = argparse.ArgumentParser(description="Build the cached dataset catalogs")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Re-walk every directory even if its index is current")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("DATASET CATALOG")
+    print("="*60)
+    for dataset_name, config in DATASETS.items():
+        for key in ('input_dir', 'output_dir'):
+            catalog = DatasetCatalog(config[key], refresh=args.refresh)
+            if not catalog.root.is_dir():
+                print(f"  {dataset_name} {key}: {config[key]} (missing)")
+                continue
+            images = catalog.select(IMAGE_SUFFIXES)
+            classes = {entry['class'] for entry in images}
+            print(f"  {dataset_name} {key}: {len(images)} images in {len(classes)} classes, "
+                  f"{len(catalog.directories)} directories "
+                  f"({'rescanned' if catalog.rescanned else 'cached'}) -> {catalog.index_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
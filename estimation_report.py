@@ -0,0 +1,299 @@
+"""
+Stain Estimation Drift Report
+Compares subsampled / reduced-resolution stain estimation against the
+full-resolution Macenko estimate (HE stain matrix and maxC)
+
+Seeded synthetic H&E tiles are always included, and every mode is checked
+on degenerate edge tiles, so the report runs without the datasets
+"""
+
+import numpy as np
+from pathlib import Path
+import pandas as pd
+import argparse
+import random
+import time
+import warnings
+from datetime import datetime
+from tqdm import tqdm
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, MACENKO_PARAMS, RANDOM_SEED
+from src.macenko_normalization import (
+    MacenkoNormalizer, REDUCED_COLOR_FLAGS, read_estimation_image, read_image_rgb
+)
+from src.run_pipeline import get_all_images
+from src.synthetic_data import edge_case_tiles, synthetic_he_tile
+
+# (sample_pixels, estimation_scale) combinations compared against the full estimate
+ESTIMATION_MODES = [
+    (100000, 1),
+    (20000, 1),
+    (5000, 1),
+    (None, 2),
+    (None, 4),
+    (20000, 2),
+]
+
+# Seeded synthetic tiles in the drift table: edge length -> number of tiles
+SYNTHETIC_TILES = {768: 5}
+
+# Edge lengths of the degenerate tiles checked for every mode
+EDGE_CASE_SIZES = (64, 150, 512)
+
+
+def stain_angle_error(HE_a, HE_b):
+    """Largest angle (degrees) between corresponding stain vectors of two stain matrices."""
+    cos = np.sum(HE_a * HE_b, axis=0) / (np.linalg.norm(HE_a, axis=0) * np.linalg.norm(HE_b, axis=0))
+    return float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))).max())
+
+
+def make_normalizer(sample_pixels=None, estimation_scale=1):
+    """Normalizer with the configured reference and the given estimation mode."""
+    return MacenkoNormalizer(
+        Io=MACENKO_PARAMS['Io'],
+        alpha=MACENKO_PARAMS['alpha'],
+        beta=MACENKO_PARAMS['beta'],
+        HERef=MACENKO_PARAMS['HERef'],
+        maxCRef=MACENKO_PARAMS['maxCRef'],
+        sample_pixels=sample_pixels,
+        estimation_scale=estimation_scale,
+        seed=RANDOM_SEED
+    )
+
+
+def compare_image(img, name, img_path=None, modes=ESTIMATION_MODES):
+    """
+    Compare every estimation mode against the full estimate for one image.
+
+    Parameters:
+    -----------
+    img : np.ndarray
+        RGB image (H x W x 3, uint8)
+    name : str
+        Image name in the table
+    img_path : Path
+        Path of the image file (JPEGs use a reduced decode for scaled modes)
+    modes : list
+        List of (sample_pixels, estimation_scale) tuples
+
+    Returns:
+    --------
+    list : One dict per mode, or an empty list if the image has no tissue
+    """
+    full = make_normalizer()
+    start = time.perf_counter()
+    params = full.estimate(img)
+    full_time = time.perf_counter() - start
+    if params is None:
+        return []
+    HE_full, maxC_full = params
+    norm_full = full.transform(img).astype(np.int16)
+
+    is_jpeg = img_path is not None and img_path.suffix.lower() in ('.jpg', '.jpeg')
+
+    rows = []
+    for sample_pixels, estimation_scale in modes:
+        normalizer = make_normalizer(sample_pixels, estimation_scale)
+
+        # Use a reduced decode where the pipeline would
+        estimation_image = None
+        if estimation_scale in REDUCED_COLOR_FLAGS and is_jpeg:
+            estimation_image = read_estimation_image(img_path, estimation_scale)
+
+        start = time.perf_counter()
+        params = normalizer.estimate(img, estimation_image)
+        est_time = time.perf_counter() - start
+        if params is None:
+            continue
+        HE, maxC = params
+
+        diff = np.abs(normalizer.transform(img, estimation_image).astype(np.int16) - norm_full)
+
+        rows.append({
+            'image': name,
+            'sample_pixels': sample_pixels if sample_pixels is not None else 'all',
+            'estimation_scale': estimation_scale,
+            'he_angle_deg': stain_angle_error(HE, HE_full),
+            'maxc_rel_err': float(np.max(np.abs(maxC - maxC_full) / maxC_full)),
+            'output_mae': float(diff.mean()),
+            'output_max_diff': int(diff.max()),
+            'estimate_speedup': full_time / est_time if est_time > 0 else np.nan,
+        })
+
+    return rows
+
+
+def process_dataset(dataset_name, config, n_images=50):
+    """
+    Build the drift table for a random sample of a dataset.
+
+    Parameters:
+    -----------
+    dataset_name : str
+        Name of the dataset
+    config : dict
+        Dataset configuration from pipeline_config.py
+    n_images : int
+        Number of images to sample
+
+    Returns:
+    --------
+    pd.DataFrame : One row per (image, estimation mode)
+    """
+    print(f"\n{'='*60}")
+    print(f"Processing {dataset_name}")
+    print(f"{'='*60}")
+
+    images = get_all_images(config['input_dir'])
+    random.seed(RANDOM_SEED)
+    images = random.sample(images, min(n_images, len(images)))
+    print(f"Sampled {len(images)} images")
+
+    rows = []
+    for img_path in tqdm(images, desc=f"Estimating {dataset_name}"):
+        img = read_image_rgb(img_path)
+        if img is None:
+            continue
+        for row in compare_image(img, img_path.name, img_path):
+            row['dataset'] = dataset_name
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+def process_synthetic(tiles=SYNTHETIC_TILES):
+    """Drift table of seeded synthetic H&E tiles (dataset 'synthetic')."""
+    rng = np.random.default_rng(RANDOM_SEED)
+    rows = []
+    for size, n in tiles.items():
+        for i in range(n):
+            for row in compare_image(synthetic_he_tile(size, seed=rng), f"synthetic_{size}_{i}"):
+                row['dataset'] = 'synthetic'
+                rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def check_edge_cases(modes=ESTIMATION_MODES, sizes=EDGE_CASE_SIZES):
+    """
+    Check every estimation mode on the degenerate tiles of `edge_case_tiles`.
+
+    A mode fails on a tile if it raises where the full estimate does not,
+    returns an image of another shape or dtype, or, when it does not reduce
+    the tile (scale 1 and at least as many samples as pixels), differs from
+    the full estimate's output. Reduced modes may otherwise drift (e.g.
+    sparse tissue averaged into background by downscaling).
+
+    Returns:
+    --------
+    list : (tile, mode, failure) tuples
+    """
+    failures = []
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        # Degenerate tiles warn in np.cov / divisions
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for size in sizes:
+            for name, tile in edge_case_tiles(size).items():
+                tile_name = f"{name} ({size}x{size})"
+                try:
+                    reference = make_normalizer().transform(tile)
+                except Exception:
+                    # Undefined at full resolution (single tissue pixel): any outcome
+                    continue
+
+                for sample_pixels, estimation_scale in modes:
+                    mode = f"sample_pixels={sample_pixels}, scale={estimation_scale}"
+                    try:
+                        out = make_normalizer(sample_pixels, estimation_scale).transform(tile)
+                    except Exception as e:
+                        failures.append((tile_name, mode, f"raised {type(e).__name__}: {e}"))
+                        continue
+                    if out.shape != reference.shape or out.dtype != reference.dtype:
+                        failures.append((tile_name, mode, f"returned {out.dtype} {out.shape}"))
+                        continue
+                    unreduced = estimation_scale == 1 and (sample_pixels is None
+                                                           or sample_pixels >= size * size)
+                    if unreduced and np.any(out != reference):
+                        failures.append((tile_name, mode, "differs from the full estimate"))
+    return failures
+
+
+def summarize(df):
+    """Mean / 95th percentile / max drift per dataset and estimation mode."""
+    group = df.groupby(['dataset', 'sample_pixels', 'estimation_scale'], sort=False)
+    return group.agg(
+        n_images=('image', 'count'),
+        he_angle_mean=('he_angle_deg', 'mean'),
+        he_angle_p95=('he_angle_deg', lambda x: np.percentile(x, 95)),
+        maxc_rel_err_mean=('maxc_rel_err', 'mean'),
+        maxc_rel_err_p95=('maxc_rel_err', lambda x: np.percentile(x, 95)),
+        output_mae_mean=('output_mae', 'mean'),
+        output_max_diff=('output_max_diff', 'max'),
+        estimate_speedup=('estimate_speedup', 'median'),
+    ).reset_index()
+
+
+def main():
+    """Report how far reduced stain estimation drifts from the full estimate."""
+    parser = argparse.ArgumentParser(description="Stain estimation drift report")
+    parser.add_argument('--n-images', type=int, default=50,
+                        help="Images sampled per dataset (default: %(default)s)")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("STAIN ESTIMATION DRIFT REPORT")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Random seed: {RANDOM_SEED}")
+
+    print(f"\n{'='*60}")
+    print("Processing synthetic tiles")
+    print(f"{'='*60}")
+    tables = [process_synthetic()]
+    for name, config in DATASETS.items():
+        if get_all_images(config['input_dir']):
+            tables.append(process_dataset(name, config, args.n_images))
+        else:
+            print(f"\n{name}: no images in {config['input_dir']} (synthetic tiles only)")
+    detailed = pd.concat(tables, ignore_index=True)
+
+    summary = summarize(detailed)
+
+    print("\n" + "="*60)
+    print("DRIFT SUMMARY")
+    print("="*60)
+    print(summary.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+
+    output_dir = Path("results/tables")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    detailed.to_csv(output_dir / "estimation_drift_detailed.csv", index=False)
+    summary.to_csv(output_dir / "estimation_drift.csv", index=False)
+    print(f"\nDrift tables saved to: {output_dir}")
+
+    log_dir = Path("results/logs")
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / "pipeline.log", 'a') as f:
+        f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Stain Estimation Drift Report\n")
+        for _, row in summary.iterrows():
+            f.write(f"  {row['dataset']} (sample_pixels={row['sample_pixels']}, "
+                    f"scale={row['estimation_scale']}): ")
+            f.write(f"HE angle={row['he_angle_mean']:.3f} deg (p95 {row['he_angle_p95']:.3f}), ")
+            f.write(f"maxC rel err={row['maxc_rel_err_mean']:.4f}, ")
+            f.write(f"output MAE={row['output_mae_mean']:.3f}\n")
+
+    failures = check_edge_cases()
+    n_cases = len(EDGE_CASE_SIZES) * len(edge_case_tiles())
+    print("\n" + "="*60)
+    print(f"EDGE CASES ({n_cases} tiles x {len(ESTIMATION_MODES)} modes)")
+    print("="*60)
+    for tile_name, mode, failure in failures:
+        print(f"  FAILED {tile_name}, {mode}: {failure}")
+    if not failures:
+        print("  All checks passed (no mode raises where the full estimate succeeds; "
+              "unreduced modes identical)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Fast Batched Image Quality Metrics
+Float32 separable-filter SSIM with exact PSNR/RMSE for stacks of
+same-size image pairs, validated against scikit-image
+"""
+
+import numpy as np
+import cv2
+from pathlib import Path
+import argparse
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import RANDOM_SEED
+
+# Largest allowed absolute difference to skimage (see `main` for the check)
+SSIM_TOLERANCE = 1e-6
+PSNR_TOLERANCE = 1e-9
+
+# PSNR of identical images is capped (as in calculate_metrics.compute_metrics)
+PSNR_CAP = 60.0
+
+
+def ssim_batch(orig, norm, data_range=255, win_size=7, K1=0.01, K2=0.03):
+    """
+    Mean SSIM of each pair in a stack, matching skimage's defaults.
+
+    Same definition as `skimage.metrics.structural_similarity` with a
+    uniform `win_size` window, sample covariance, the per-channel mean for
+    color images, and the `(win_size - 1) // 2` border excluded from the
+    mean. Local statistics come from float32 separable box filters over
+    the whole stack: the images are stacked vertically and, since only
+    pixels whose window lies inside their own image are averaged, the
+    stacking does not change the result. Pixel values are centered before
+    filtering to keep the float32 variance cancellation small.
+
+    Parameters:
+    -----------
+    orig, norm : np.ndarray
+        Image stacks (N x H x W x C or N x H x W), uint8
+    data_range : float
+        Dynamic range of the pixel values
+    win_size : int
+        Side of the (odd) uniform window
+
+    Returns:
+    --------
+    np.ndarray : SSIM per pair (N,), float64
+    """
+    if orig.shape != norm.shape:
+        raise ValueError("Image stacks must have the same shape")
+    n, h, w = orig.shape[:3]
+    pad = (win_size - 1) // 2
+    if h <= 2 * pad or w <= 2 * pad:
+        raise ValueError(f"Images must be larger than {2 * pad} pixels in each dimension")
+
+    # Centered float32 images, stacked vertically: (N * H) x W [x C]
+    offset = np.float32(data_range / 2)
+    x = orig.reshape((n * h,) + orig.shape[2:]).astype(np.float32)
+    y = norm.reshape((n * h,) + norm.shape[2:]).astype(np.float32)
+    x -= offset
+    y -= offset
+
+    ksize = (win_size, win_size)
+    border = cv2.BORDER_REFLECT
+    ux = cv2.boxFilter(x, -1, ksize, borderType=border)
+    uy = cv2.boxFilter(y, -1, ksize, borderType=border)
+    vx = cv2.sqrBoxFilter(x, -1, ksize, borderType=border)
+    vy = cv2.sqrBoxFilter(y, -1, ksize, borderType=border)
+    np.multiply(x, y, out=x)
+    vxy = cv2.boxFilter(x, -1, ksize, borderType=border)
+    del x, y
+
+    # Sample (co)variances, in place: cov_norm * (E[xy] - E[x] E[y])
+    cov_norm = np.float32(win_size ** 2 / (win_size ** 2 - 1))
+    tmp = np.empty_like(ux)
+    for v, a, b in ((vx, ux, ux), (vy, uy, uy), (vxy, ux, uy)):
+        np.multiply(a, b, out=tmp)
+        v -= tmp
+        v *= cov_norm
+
+    # Back to the uncentered means for the luminance term
+    ux += offset
+    uy += offset
+
+    C1 = np.float32((K1 * data_range) ** 2)
+    C2 = np.float32((K2 * data_range) ** 2)
+
+    # S = ((2 ux uy + C1) (2 vxy + C2)) / ((ux^2 + uy^2 + C1) (vx + vy + C2))
+    vxy *= 2
+    vxy += C2
+    vx += vy
+    vx += C2
+    np.multiply(ux, uy, out=tmp)
+    tmp *= 2
+    tmp += C1
+    vxy *= tmp
+    np.multiply(ux, ux, out=tmp)
+    np.multiply(uy, uy, out=uy)
+    tmp += uy
+    tmp += C1
+    vx *= tmp
+    S = np.divide(vxy, vx, out=vxy)
+
+    # Mean over the interior of each image (and over channels)
+    S = S.reshape((n, h, w, -1))[:, pad:h - pad, pad:w - pad]
+    return S.reshape((n, -1)).mean(axis=1, dtype=np.float64)
+
+
+def psnr_rmse_batch(orig, norm, data_range=255):
+    """
+    PSNR (dB, uncapped) and RMSE of each pair in a stack, from exact integer squared errors.
+
+    Returns:
+    --------
+    tuple : (psnr, rmse), each (N,) float64
+    """
+    diff = orig.astype(np.int32) - norm.astype(np.int32)
+    diff = diff.reshape((diff.shape[0], -1))
+    mse = np.einsum('ij,ij->i', diff, diff, dtype=np.int64) / diff.shape[1]
+    with np.errstate(divide='ignore'):
+        psnr = 10 * np.log10(data_range ** 2 / mse)
+    return psnr, np.sqrt(mse)
+
+
+def compute_metrics_batch(orig, norm, channel_mode='rgb'):
+    """
+    PSNR, SSIM and RMSE of a stack of same-size RGB pairs.
+
+    Parameters:
+    -----------
+    orig, norm : np.ndarray
+        RGB image stacks (N x H x W x 3, uint8)
+    channel_mode : str
+        'rgb' for 3-channel or 'gray' for single channel
+
+    Returns:
+    --------
+    list : One dict per pair with 'psnr', 'ssim', 'rmse' (as compute_metrics)
+    """
+    if channel_mode == 'gray':
+        orig = np.stack([cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) for img in orig])
+        norm = np.stack([cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) for img in norm])
+
+    psnr, rmse = psnr_rmse_batch(orig, norm)
+    psnr[np.isinf(psnr)] = PSNR_CAP
+    ssim = ssim_batch(orig, norm)
+
+    return [{'psnr': float(p), 'ssim': float(s), 'rmse': float(r)}
+            for p, s, r in zip(psnr, ssim, rmse)]
+
+
+def main():
+    """Validate the fast metrics against skimage on synthetic and real image pairs."""
+    from src.calculate_metrics import compute_metrics
+    from src.macenko_normalization import MacenkoNormalizer, read_image_rgb
+    from src.synthetic_data import synthetic_he_tile
+
+    parser = argparse.ArgumentParser(description="Validate fast SSIM/PSNR/RMSE against skimage")
+    parser.add_argument('images', nargs='*', help="Optional real images (normalized on the fly)")
+    parser.add_argument('--n-synthetic', type=int, default=20,
+                        help="Synthetic pairs per size (default: %(default)s)")
+    args = parser.parse_args()
+
+    normalizer = MacenkoNormalizer()
+    rng = np.random.default_rng(RANDOM_SEED)
+    pairs = []
+    for size in (150, 768):
+        for _ in range(args.n_synthetic):
+            img = synthetic_he_tile(size, seed=rng)
+            pairs.append((f"synthetic {size}", img, normalizer.transform(img)))
+    for path in args.images:
+        img = read_image_rgb(path)
+        if img is not None:
+            pairs.append((path, img, normalizer.transform(img)))
+    # Identical pair (PSNR cap)
+    pairs.append(("identical", pairs[0][1], pairs[0][1]))
+
+    worst = {'psnr': 0.0, 'ssim': 0.0, 'rmse': 0.0}
+    for channel_mode in ('rgb', 'gray'):
+        for name, orig, norm in pairs:
+            fast = compute_metrics_batch(orig[np.newaxis], norm[np.newaxis], channel_mode)[0]
+            reference = compute_metrics(orig, norm, channel_mode)
+            for key in worst:
+                worst[key] = max(worst[key], abs(fast[key] - reference[key]))
+
+    print(f"Pairs: {len(pairs)} (rgb and gray)")
+    print(f"Max |SSIM - skimage|: {worst['ssim']:.2e} (tolerance {SSIM_TOLERANCE:g})")
+    print(f"Max |PSNR - skimage|: {worst['psnr']:.2e} dB (tolerance {PSNR_TOLERANCE:g})")
+    print(f"Max |RMSE - numpy|:   {worst['rmse']:.2e} (tolerance {PSNR_TOLERANCE:g})")
+
+    failed = (worst['ssim'] > SSIM_TOLERANCE or worst['psnr'] > PSNR_TOLERANCE
+              or worst['rmse'] > PSNR_TOLERANCE)
+    print("FAILED" if failed else "PASSED")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
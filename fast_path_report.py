@@ -0,0 +1,257 @@
+"""
+Fast Path Equivalence and Speedup Report
+Checks that the lookup-table / pseudo-inverse / selection fast path
+(MacenkoNormalizer(fast=True)) and the unique-color mode
+(MacenkoNormalizer(unique_colors=True)) reproduce macenko_normalize, and
+times each stage of the implementations
+
+The checks always run on seeded synthetic H&E tiles and on degenerate edge
+tiles (no tissue, one or two tissue pixels, flat, sparse and noise tiles),
+and additionally on a sample of the dataset images when they are present
+"""
+
+import numpy as np
+from pathlib import Path
+import pandas as pd
+import argparse
+import random
+import time
+import warnings
+from datetime import datetime
+from tqdm import tqdm
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, MACENKO_PARAMS, RANDOM_SEED
+from src.macenko_normalization import (
+    MacenkoNormalizer, get_stain_matrix, od_lookup_table, read_image_rgb, rgb_to_od,
+    select_percentiles
+)
+from src.run_pipeline import get_all_images
+from src.synthetic_data import edge_case_tiles, synthetic_he_tile
+
+# Largest allowed difference between lstsq and pseudo-inverse concentrations
+SOLVE_TOLERANCE = 1e-10
+
+# Seeded synthetic tiles checked on every run: edge length -> number of tiles
+SYNTHETIC_TILES = {150: 4, 768: 2}
+
+
+def _timed(fn, *args):
+    """Run fn(*args) and return (result, seconds)."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _outcome(fn, *args):
+    """Run fn(*args) and return (result, seconds); the result is the exception if it raised."""
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - start
+
+
+def _mismatches(reference, result):
+    """
+    Differing output values of two end-to-end results.
+
+    Two exceptions of the same type count as equal; an exception against an
+    image, or images of different shapes, count as every value differing.
+    """
+    if isinstance(reference, Exception) or isinstance(result, Exception):
+        if type(reference) is type(result):
+            return 0
+        return int(getattr(reference, 'size', 0) or getattr(result, 'size', 0) or 1)
+    if reference.shape != result.shape:
+        return int(max(reference.size, result.size))
+    return int(np.count_nonzero(reference != result))
+
+
+def compare_outputs(img, Io, alpha, beta):
+    """
+    Compare the end-to-end output of the reference, fast and unique-color paths.
+
+    Failures count as outputs: a path must raise the same exception type as
+    the reference (e.g. for a single tissue pixel) to pass.
+
+    Returns:
+    --------
+    tuple : (timings, checks) as for `compare_stages` (end-to-end entries only)
+    """
+    params = (Io, alpha, beta, MACENKO_PARAMS['HERef'], MACENKO_PARAMS['maxCRef'])
+    reference = MacenkoNormalizer(*params)
+    fast = MacenkoNormalizer(*params, fast=True)
+    unique = MacenkoNormalizer(*params, unique_colors=True)
+
+    out, t_ref = _outcome(reference.transform, img)
+    out_fast, t_fast = _outcome(fast.transform, img)
+    out_unique, t_unique = _outcome(unique.transform, img)
+
+    # Unique-color mode: per-color math, count-weighted statistics
+    timings = {'total': (t_ref, t_fast), 'total_unique_colors': (t_ref, t_unique)}
+    checks = {'output_pixel_mismatches': _mismatches(out, out_fast),
+              'unique_output_pixel_mismatches': _mismatches(out, out_unique)}
+    return timings, checks
+
+
+def compare_stages(img, Io, alpha, beta):
+    """
+    Run the reference and fast implementation of every stage on one image.
+
+    Parameters:
+    -----------
+    img : np.ndarray
+        Input RGB image (H x W x 3, uint8)
+    Io, alpha, beta :
+        Macenko parameters
+
+    Returns:
+    --------
+    tuple : (timings, checks) where timings maps stage -> (reference_s, fast_s)
+            and checks maps check name -> measured value; with fewer than 2
+            tissue pixels only the end-to-end entries (`compare_outputs`)
+    """
+    timings = {}
+    checks = {}
+    pixels = img.reshape((-1, 3))
+
+    # OD conversion
+    OD, t_ref = _timed(lambda: rgb_to_od(pixels.astype(np.float64), Io))
+    lut = od_lookup_table(Io)
+    OD_fast, t_fast = _timed(lambda: lut[pixels])
+    timings['od'] = (t_ref, t_fast)
+    checks['od_mismatches'] = int(np.count_nonzero(OD != OD_fast))
+
+    # Tissue mask
+    mask, t_ref = _timed(lambda: ~np.any(OD < beta, axis=1))
+    background = lut < beta
+    mask_fast, t_fast = _timed(
+        lambda: ~(background[pixels[:, 0]] | background[pixels[:, 1]] | background[pixels[:, 2]])
+    )
+    timings['mask'] = (t_ref, t_fast)
+    checks['mask_mismatches'] = int(np.count_nonzero(mask != mask_fast))
+
+    ODhat = OD[mask]
+    if ODhat.shape[0] < 2:
+        end_timings, end_checks = compare_outputs(img, Io, alpha, beta)
+        return {**timings, **end_timings}, {**checks, **end_checks}
+
+    # Angle percentiles
+    eigvals, eigvecs = np.linalg.eigh(np.cov(ODhat.T))
+    That = ODhat.dot(eigvecs[:, 1:3])
+    phi = np.arctan2(That[:, 1], That[:, 0])
+    phis, t_ref = _timed(lambda: np.array([np.percentile(phi, alpha), np.percentile(phi, 100 - alpha)]))
+    phis_fast, t_fast = _timed(lambda: select_percentiles(phi[np.newaxis, :], (alpha, 100 - alpha))[:, 0])
+    timings['angle_percentiles'] = (t_ref, t_fast)
+    checks['angle_percentile_mismatches'] = int(np.count_nonzero(phis != phis_fast))
+
+    # Concentration solve
+    HE = get_stain_matrix(OD, alpha, beta)
+    C, t_ref = _timed(lambda: np.linalg.lstsq(HE, OD.T, rcond=None)[0])
+    C_fast, t_fast = _timed(lambda: np.matmul(OD, np.linalg.pinv(HE).T))
+    timings['solve'] = (t_ref, t_fast)
+    checks['solve_max_abs_diff'] = float(np.abs(C - C_fast.T).max())
+
+    # Concentration percentiles
+    maxC, t_ref = _timed(lambda: np.array([np.percentile(C[0, :], 99), np.percentile(C[1, :], 99)]))
+    maxC_fast, t_fast = _timed(lambda: select_percentiles(C, (99,))[0])
+    timings['max_concentrations'] = (t_ref, t_fast)
+    checks['max_concentration_mismatches'] = int(np.count_nonzero(maxC != maxC_fast))
+
+    # End to end
+    end_timings, end_checks = compare_outputs(img, Io, alpha, beta)
+    return {**timings, **end_timings}, {**checks, **end_checks}
+
+
+def check_failures(checks):
+    """Names of failed equivalence checks."""
+    failures = [name for name, value in checks.items()
+                if name.endswith('mismatches') and value != 0]
+    if checks.get('solve_max_abs_diff', 0) > SOLVE_TOLERANCE:
+        failures.append('solve_max_abs_diff')
+    return failures
+
+
+def main():
+    """Run the fast path equivalence checks and per-stage speedup report."""
+    parser = argparse.ArgumentParser(description="Fast path equivalence and speedup report")
+    parser.add_argument('--n-images', type=int, default=50,
+                        help="Images sampled per dataset (default: %(default)s)")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("FAST PATH EQUIVALENCE AND SPEEDUP REPORT")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    Io, alpha, beta = MACENKO_PARAMS['Io'], MACENKO_PARAMS['alpha'], MACENKO_PARAMS['beta']
+
+    # (group, name, image, timed) for every checked image
+    rng = np.random.default_rng(RANDOM_SEED)
+    cases = [('synthetic', f"synthetic {size} #{i}", synthetic_he_tile(size, seed=rng), True)
+             for size, n in SYNTHETIC_TILES.items() for i in range(n)]
+    cases += [('edge_cases', name, tile, False) for name, tile in edge_case_tiles().items()]
+    for dataset_name, config in DATASETS.items():
+        images = get_all_images(config['input_dir'])
+        if not images:
+            print(f"{dataset_name}: no images in {config['input_dir']} (synthetic checks only)")
+            continue
+        random.seed(RANDOM_SEED)
+        images = random.sample(images, min(args.n_images, len(images)))
+        cases += [(dataset_name, img_path, img_path, True) for img_path in images]
+
+    rows = []
+    failed_images = []
+    n_checked = 0
+    for group, name, img, timed in tqdm(cases, desc="Checking"):
+        if not isinstance(img, np.ndarray):
+            img = read_image_rgb(img)
+            if img is None:
+                continue
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            # Degenerate tiles warn in np.cov / divisions on every path alike
+            warnings.simplefilter('ignore', RuntimeWarning)
+            timings, checks = compare_stages(img, Io, alpha, beta)
+        n_checked += 1
+
+        failures = check_failures(checks)
+        if failures:
+            failed_images.append((f"{group}: {name}", failures))
+
+        if timed:
+            for stage, (t_ref, t_fast) in timings.items():
+                rows.append({'dataset': group, 'stage': stage,
+                             'reference_ms': 1e3 * t_ref, 'fast_ms': 1e3 * t_fast})
+
+    df = pd.DataFrame(rows)
+    summary = df.groupby(['dataset', 'stage'], sort=False)[['reference_ms', 'fast_ms']].mean().reset_index()
+    summary['speedup'] = summary['reference_ms'] / summary['fast_ms']
+
+    print("\n" + "="*60)
+    print("PER-STAGE SPEEDUP (mean ms per image)")
+    print("="*60)
+    print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    print("\n" + "="*60)
+    print(f"EQUIVALENCE ({n_checked} images, {len(edge_case_tiles())} edge cases)")
+    print("="*60)
+    if failed_images:
+        for img_path, failures in failed_images:
+            print(f"  FAILED {img_path}: {', '.join(failures)}")
+    else:
+        print("  All checks passed (OD, mask, percentiles and output identical; "
+              f"solve within {SOLVE_TOLERANCE:g})")
+
+    output_dir = Path("results/tables")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    summary.to_csv(output_dir / "fast_path_speedup.csv", index=False)
+    print(f"\nSpeedup table saved to: {output_dir / 'fast_path_speedup.csv'}")
+
+    return 1 if failed_images else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
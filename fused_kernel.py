@@ -0,0 +1,147 @@
+"""
+Fused Single-Pass Reconstruction Kernels
+OD lookup -> concentration solve -> rescaling -> reconstruction -> uint8 in
+one pass per pixel (or from already solved concentrations), compiled with
+Numba (multithreaded with prange) when it is installed, with a blocked NumPy
+implementation of the same math otherwise
+"""
+
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    numba = None
+    HAVE_NUMBA = False
+
+# Kernel implementations ('auto' = Numba if installed, else NumPy)
+FUSED_BACKENDS = ('auto', 'numba', 'numpy')
+
+# Pixels per block of the NumPy implementation (temporaries stay in cache)
+NUMPY_BLOCK = 65536
+
+
+def resolve_backend(backend):
+    """Implementation used for `backend` ('numba' or 'numpy'); raises ImportError for 'numba' without Numba."""
+    if backend not in FUSED_BACKENDS:
+        raise ValueError(f"fused backend must be one of {FUSED_BACKENDS}, got {backend!r}")
+    if backend == 'auto':
+        return 'numba' if HAVE_NUMBA else 'numpy'
+    if backend == 'numba' and not HAVE_NUMBA:
+        raise ImportError("The 'numba' fused backend requires Numba (pip install numba)")
+    return backend
+
+
+def set_threads(n):
+    """Limit the Numba kernel to `n` threads in this process (no-op without Numba)."""
+    if HAVE_NUMBA:
+        numba.set_num_threads(max(1, min(n, numba.config.NUMBA_NUM_THREADS)))
+
+
+def _reconstruct_numpy(pixels, od_lut, pinv, scale, neg_HERef, Io, out):
+    """Blocked NumPy implementation of `fused_reconstruct`."""
+    for s in range(0, pixels.shape[0], NUMPY_BLOCK):
+        e = min(s + NUMPY_BLOCK, pixels.shape[0])
+        C = np.matmul(od_lut[pixels[s:e]], pinv)
+        _rescale_numpy(C, scale, neg_HERef, Io, out[s:e])
+
+
+def _rescale_numpy(C, scale, neg_HERef, Io, out):
+    """Blocked NumPy implementation of `fused_rescale` (C is modified in place)."""
+    for s in range(0, C.shape[0], NUMPY_BLOCK):
+        block = C[s:s + NUMPY_BLOCK]
+        block *= scale
+        Inorm = np.exp(np.matmul(block, neg_HERef))
+        Inorm *= Io
+        np.minimum(Inorm, 255, out=Inorm)
+        out[s:s + NUMPY_BLOCK] = Inorm
+
+
+if HAVE_NUMBA:
+    @numba.njit(parallel=True, cache=True)
+    def _reconstruct_numba(pixels, od_lut, pinv, scale, neg_HERef, Io, out):
+        for i in numba.prange(pixels.shape[0]):
+            od0 = od_lut[pixels[i, 0]]
+            od1 = od_lut[pixels[i, 1]]
+            od2 = od_lut[pixels[i, 2]]
+            c0 = (od0 * pinv[0, 0] + od1 * pinv[1, 0] + od2 * pinv[2, 0]) * scale[0]
+            c1 = (od0 * pinv[0, 1] + od1 * pinv[1, 1] + od2 * pinv[2, 1]) * scale[1]
+            for k in range(3):
+                value = np.exp(c0 * neg_HERef[0, k] + c1 * neg_HERef[1, k]) * Io
+                if value > 255.0:
+                    value = 255.0
+                out[i, k] = np.uint8(value)
+
+    @numba.njit(parallel=True, cache=True)
+    def _rescale_numba(C, scale, neg_HERef, Io, out):
+        for i in numba.prange(C.shape[0]):
+            c0 = C[i, 0] * scale[0]
+            c1 = C[i, 1] * scale[1]
+            for k in range(3):
+                value = np.exp(c0 * neg_HERef[0, k] + c1 * neg_HERef[1, k]) * Io
+                if value > 255.0:
+                    value = 255.0
+                out[i, k] = np.uint8(value)
+
+
+def fused_reconstruct(pixels, od_lut, pinv, scale, neg_HERef, Io, out, backend='auto'):
+    """
+    Normalize uint8 pixels with a known stain estimate into `out`.
+
+    Per pixel: OD from the 256-entry lookup table, concentrations with the
+    pseudo-inverse of the source stain matrix, rescaling to the reference
+    maxC, reconstruction with the reference stain vectors, clipping at 255
+    and truncation to uint8 (as `MacenkoNormalizer.apply_stain_params`).
+    The Numba kernel does this in a single multithreaded pass without
+    temporaries; the first call compiles it (cached on disk afterwards).
+
+    Parameters:
+    -----------
+    pixels : np.ndarray
+        Input pixels (N x 3, uint8)
+    od_lut : np.ndarray
+        Optical density of every intensity (256,), float64
+    pinv : np.ndarray
+        Transposed pseudo-inverse of the source stain matrix (3 x 2)
+    scale : np.ndarray
+        maxCRef / maxC (2,)
+    neg_HERef : np.ndarray
+        Negated, transposed reference stain matrix (2 x 3)
+    Io : float
+        Transmitted light intensity
+    out : np.ndarray
+        Output pixels (N x 3, uint8), written in place
+    backend : str
+        'auto', 'numba' or 'numpy'
+    """
+    args = (np.ascontiguousarray(pixels), od_lut, np.ascontiguousarray(pinv, dtype=np.float64),
+            np.asarray(scale, dtype=np.float64), np.ascontiguousarray(neg_HERef, dtype=np.float64),
+            float(Io), out)
+    if resolve_backend(backend) == 'numba':
+        _reconstruct_numba(*args)
+    else:
+        _reconstruct_numpy(*args)
+
+
+def fused_rescale(C, scale, neg_HERef, Io, out, backend='auto'):
+    """
+    Rescale solved concentrations and reconstruct uint8 pixels into `out`.
+
+    The second half of `fused_reconstruct`, for paths that already hold the
+    source concentrations (they are needed for maxC during estimation).
+    The NumPy implementation rescales `C` in place.
+
+    Parameters:
+    -----------
+    C : np.ndarray
+        Source concentrations (N x 2), float64
+    scale, neg_HERef, Io, out, backend :
+        As for `fused_reconstruct`
+    """
+    args = (np.ascontiguousarray(C, dtype=np.float64), np.asarray(scale, dtype=np.float64),
+            np.ascontiguousarray(neg_HERef, dtype=np.float64), float(Io), out)
+    if resolve_backend(backend) == 'numba':
+        _rescale_numba(*args)
+    else:
+        _rescale_numpy(*args)
@@ -1,19 +1,41 @@
 """
 Visual Examples Generation Script - Phase 5
-Creates side-by-side comparisons of original vs normalized images
+Creates side-by-side comparisons of original vs normalized images, and
+QA contact sheets (mosaics of many original|normalized thumbnail pairs)
 """
 
 import numpy as np
 import cv2
 from pathlib import Path
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from multiprocessing import Pool
 from datetime import datetime
+from tqdm import tqdm
+import argparse
+import csv
+import hashlib
+import os
 import sys
 import random
 
 sys.path.append(str(Path(__file__).parent.parent))
-from config.pipeline_config import RANDOM_SEED
+from config.pipeline_config import DATASETS, PROCESSING, RANDOM_SEED
+from src.dataset_catalog import IMAGE_SUFFIXES, DatasetCatalog
+
+# Contact-sheet layout (pixels) and colors (BGR)
+SHEET_GAP = 6            # Between pairs
+PAIR_GAP = 2             # Between the original and normalized thumbnail of a pair
+LABEL_HEIGHT = 14        # Label band under each pair
+HEADER_HEIGHT = 30       # Title band of each sheet
+SHEET_BACKGROUND = (32, 32, 32)
+LABEL_COLOR = (230, 230, 230)
+MISSING_COLOR = (0, 0, 160)  # Pairs that could not be read
+
+# JPEG decode reductions tried for thumbnails (cv2.IMREAD_REDUCED_COLOR_*)
+JPEG_REDUCTIONS = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                   2: cv2.IMREAD_REDUCED_COLOR_2}
+
+# State of the current process (installed once per worker)
+_worker = {}
 
 
 def create_comparison_figure(orig_path, norm_path, title, save_path, add_zoom=False):
@@ -33,6 +55,9 @@ def create_comparison_figure(orig_path, norm_path, title, save_path, add_zoom=Fa
     add_zoom : bool
         Whether to add zoomed inset
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+
     # Read images
     orig = cv2.imread(str(orig_path))
     norm = cv2.imread(str(norm_path))
@@ -118,20 +143,317 @@ def select_representative_images(dataset_dir, n_samples=3):
     --------
     list : List of selected image paths
     """
-    # Find all images
-    image_extensions = ['*.jpeg', '*.jpg', '*.png', '*.tif']
-    all_images = []
-    for ext in image_extensions:
-        all_images.extend(list(dataset_dir.rglob(ext)))
+    # Randomly select n_samples from the cached catalog (no directory walk)
+    image_extensions = ['.jpeg', '.jpg', '.png', '.tif']
+    return DatasetCatalog(dataset_dir).sample(n_samples, image_extensions, seed=RANDOM_SEED)
 
-    if len(all_images) == 0:
-        return []
 
-    # Randomly select n_samples
-    random.seed(RANDOM_SEED)
-    selected = random.sample(all_images, min(n_samples, len(all_images)))
+def stratified_sample(catalog, n, suffixes=IMAGE_SUFFIXES, seed=RANDOM_SEED):
+    """
+    Up to `n` files of a catalog spread evenly over its class folders.
 
-    return selected
+    Each class is shuffled with a seeded RNG and files are taken from the
+    classes in turn, so every class contributes n // classes files (or all
+    of its files, the remainder going to the larger classes).
+
+    Returns:
+    --------
+    list : Catalog entries, grouped by class (sorted) and in path order within a class
+    """
+    by_class = {}
+    for entry in catalog.select(suffixes):
+        by_class.setdefault(entry['class'], []).append(entry)
+
+    rng = random.Random(seed)
+    pools = []
+    for image_class in sorted(by_class):
+        entries = list(by_class[image_class])
+        rng.shuffle(entries)
+        pools.append(entries)
+
+    chosen = [[] for _ in pools]
+    taken = 0
+    depth = 0
+    while taken < n and any(depth < len(pool) for pool in pools):
+        for i, pool in enumerate(pools):
+            if depth < len(pool) and taken < n:
+                chosen[i].append(pool[depth])
+                taken += 1
+        depth += 1
+
+    return [entry for entries in chosen for entry in sorted(entries, key=lambda e: Path(e['path']))]
+
+
+def _jpeg_size(path):
+    """(height, width) from the frame header of a JPEG file, or None if not found."""
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] in (0x01, 0xFF) or 0xD0 <= marker[1] <= 0xD7:
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB,
+                             0xCD, 0xCE, 0xCF):
+                header = f.read(5)
+                if len(header) < 5:
+                    return None
+                return int.from_bytes(header[1:3], 'big'), int.from_bytes(header[3:5], 'big')
+            f.seek(int.from_bytes(length, 'big') - 2, os.SEEK_CUR)
+
+
+def _read_thumbnail(path, size):
+    """
+    Image scaled to fit a size x size box (BGR, uint8), or None if unreadable.
+
+    JPEGs are decoded at the largest DCT reduction that still covers the
+    box (sized from the frame header); other formats are decoded in full.
+    Downscaling uses INTER_AREA.
+    """
+    flag = cv2.IMREAD_COLOR
+    if path.suffix.lower() in ('.jpg', '.jpeg'):
+        try:
+            shape = _jpeg_size(path)
+        except OSError:
+            return None
+        if shape is not None:
+            factor = next((f for f in (8, 4, 2) if max(shape) // f >= size), 1)
+            flag = JPEG_REDUCTIONS.get(factor, cv2.IMREAD_COLOR)
+    img = cv2.imread(str(path), flag)
+    if img is None:
+        return None
+
+    h, w = img.shape[:2]
+    scale = size / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return img
+
+
+def thumbnail(path, size, cache_dir=None):
+    """
+    Cached thumbnail of an image (see `_read_thumbnail`).
+
+    Thumbnails are stored as PNG in `cache_dir`, keyed by the resolved
+    path, file size, mtime and thumbnail size, so a rewritten image gets a
+    new thumbnail. Cache files are written atomically (safe with several
+    worker processes). The cache directory can be deleted at any time.
+    """
+    path = Path(path)
+    if cache_dir is None:
+        return _read_thumbnail(path, size)
+
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    key = hashlib.blake2b(f"{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{size}".encode(),
+                          digest_size=16).hexdigest()
+    cache_path = Path(cache_dir) / key[:2] / f"{key}.png"
+
+    if cache_path.exists():
+        img = cv2.imread(str(cache_path), cv2.IMREAD_COLOR)
+        if img is not None:
+            return img
+
+    img = _read_thumbnail(path, size)
+    if img is not None:
+        ok, encoded = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if ok:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            partial = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.partial")
+            partial.write_bytes(encoded.tobytes())
+            os.replace(partial, cache_path)
+    return img
+
+
+def _thumbnail_chunk(chunk):
+    """Thumbnails of a chunk of (orig_path, norm_path) pairs; (orig, norm) per pair (None if unreadable)."""
+    size, cache_dir = _worker['size'], _worker['cache_dir']
+    return [(thumbnail(orig_path, size, cache_dir), thumbnail(norm_path, size, cache_dir))
+            for orig_path, norm_path in chunk]
+
+
+def _init_worker(size, cache_dir):
+    """Pool initializer: thumbnail options; keep OpenCV single-threaded."""
+    _worker['size'] = size
+    _worker['cache_dir'] = cache_dir
+    cv2.setNumThreads(1)
+
+
+def compose_sheet(cells, title, size, columns):
+    """
+    Composite original|normalized thumbnail pairs into one contact sheet.
+
+    Parameters:
+    -----------
+    cells : list
+        (orig_thumb, norm_thumb, label) per pair (BGR thumbnails, None = unreadable)
+    title : str
+        Text of the sheet's title band
+    size : int
+        Thumbnail box edge (pixels)
+    columns : int
+        Pairs per row
+
+    Returns:
+    --------
+    np.ndarray : Sheet image (BGR, uint8)
+    """
+    cell_w = 2 * size + PAIR_GAP
+    cell_h = size + LABEL_HEIGHT
+    columns = max(1, min(columns, len(cells)))
+    rows = -(-len(cells) // columns)
+    sheet = np.empty((HEADER_HEIGHT + rows * (cell_h + SHEET_GAP) + SHEET_GAP,
+                      columns * (cell_w + SHEET_GAP) + SHEET_GAP, 3), dtype=np.uint8)
+    sheet[:] = SHEET_BACKGROUND
+    cv2.putText(sheet, title, (SHEET_GAP, HEADER_HEIGHT - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                0.55, LABEL_COLOR, 1, cv2.LINE_AA)
+
+    for i, (orig, norm, label) in enumerate(cells):
+        y = HEADER_HEIGHT + (i // columns) * (cell_h + SHEET_GAP)
+        x = SHEET_GAP + (i % columns) * (cell_w + SHEET_GAP)
+        for offset, thumb in ((0, orig), (size + PAIR_GAP, norm)):
+            if thumb is None:
+                sheet[y:y + size, x + offset:x + offset + size] = MISSING_COLOR
+            else:
+                h, w = thumb.shape[:2]
+                sheet[y:y + h, x + offset:x + offset + w] = thumb
+        cv2.putText(sheet, label, (x, y + size + LABEL_HEIGHT - 3), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.35, LABEL_COLOR, 1, cv2.LINE_AA)
+    return sheet
+
+
+def create_contact_sheets(dataset_name, original_dir, normalized_dir, output_dir, n_pairs=500,
+                          pairs_per_sheet=500, size=PROCESSING['qa_thumb_size'],
+                          columns=PROCESSING['qa_columns'], workers=1,
+                          cache_dir=PROCESSING['thumbnail_dir'], chunk_size=32):
+    """
+    Build QA contact sheets of original|normalized pairs for one dataset.
+
+    Pairs are sampled with `stratified_sample` from the normalized tree and
+    matched to their originals through the dataset catalogs. Thumbnails
+    are decoded and cached in parallel chunks (`workers` processes) and
+    the sheets are composited with OpenCV and written as JPEG
+    (<dataset>_sheet_NN.jpg). Each cell is labelled with its number and
+    class; `index_rows` maps the numbers back to the image paths.
+
+    Returns:
+    --------
+    tuple : (sheet paths, index_rows) with one dict per pair in index_rows
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    normalized = DatasetCatalog(normalized_dir)
+    originals = DatasetCatalog(original_dir)
+    pairs = []
+    for entry in stratified_sample(normalized, n_pairs):
+        orig_path = originals.find(entry['path'])
+        if orig_path is not None:
+            pairs.append((orig_path, normalized.root / entry['path'], entry))
+    if not pairs:
+        return [], []
+
+    chunks = [[pair[:2] for pair in pairs[i:i + chunk_size]]
+              for i in range(0, len(pairs), chunk_size)]
+    thumbs = []
+    with tqdm(total=len(pairs), desc=f"Thumbnails for {dataset_name}") as pbar:
+        if workers <= 1:
+            _worker.update(size=size, cache_dir=cache_dir)
+            results = map(_thumbnail_chunk, chunks)
+            for chunk, result in zip(chunks, results):
+                thumbs.extend(result)
+                pbar.update(len(chunk))
+        else:
+            with Pool(processes=workers, initializer=_init_worker,
+                      initargs=(size, cache_dir)) as pool:
+                for chunk, result in zip(chunks, pool.imap(_thumbnail_chunk, chunks)):
+                    thumbs.extend(result)
+                    pbar.update(len(chunk))
+
+    n_sheets = -(-len(pairs) // pairs_per_sheet)
+    sheet_paths = []
+    index_rows = []
+    for k in range(n_sheets):
+        start = k * pairs_per_sheet
+        cells = []
+        for i in range(start, min(start + pairs_per_sheet, len(pairs))):
+            _, _, entry = pairs[i]
+            cells.append(thumbs[i] + (f"{i + 1} {entry['class']}",))
+            index_rows.append({'dataset': dataset_name, 'sheet': k + 1, 'cell': i + 1,
+                               'class': entry['class'], 'split': entry['split'],
+                               'path': entry['path']})
+
+        title = (f"{dataset_name} - sheet {k + 1}/{n_sheets}: original | Macenko normalized "
+                 f"(pairs {start + 1}-{start + len(cells)} of {len(pairs)})")
+        sheet = compose_sheet(cells, title, size, columns)
+        sheet_path = output_dir / f"{dataset_name.lower()}_sheet_{k + 1:02d}.jpg"
+        cv2.imwrite(str(sheet_path), sheet, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        sheet_paths.append(sheet_path)
+
+    return sheet_paths, index_rows
+
+
+def contact_sheets_main(args):
+    """Contact-sheet mode: QA mosaics for every dataset instead of per-pair figures."""
+    print("="*60)
+    print("QA CONTACT SHEETS - Phase 5")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Random seed: {RANDOM_SEED}")
+    print(f"Pairs per dataset: {args.pairs} (stratified by class), {args.pairs_per_sheet} per sheet")
+    print(f"Thumbnails: {args.thumb_size} px, cache: {args.thumbnail_dir or 'off'}, "
+          f"workers: {args.workers}")
+
+    output_dir = Path("results/figures/contact_sheets")
+    counts = {}
+    index_rows = []
+    for dataset_name, config in DATASETS.items():
+        print("\n" + "="*60)
+        print(f"Processing {dataset_name} Contact Sheets")
+        print("="*60)
+        start = datetime.now()
+        sheets, rows = create_contact_sheets(
+            dataset_name, config['input_dir'], config['output_dir'], output_dir,
+            n_pairs=args.pairs, pairs_per_sheet=args.pairs_per_sheet, size=args.thumb_size,
+            columns=args.columns, workers=args.workers, cache_dir=args.thumbnail_dir
+        )
+        elapsed = (datetime.now() - start).total_seconds()
+        counts[dataset_name] = (len(rows), len(sheets))
+        index_rows.extend(rows)
+        classes = {row['class'] for row in rows}
+        print(f"{dataset_name}: {len(rows)} pairs from {len(classes)} classes "
+              f"on {len(sheets)} sheet(s) in {elapsed:.1f} s")
+        for sheet_path in sheets:
+            print(f"✓ Saved: {sheet_path.name}")
+
+    if index_rows:
+        index_path = output_dir / "contact_sheets_index.csv"
+        with open(index_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(index_rows[0]))
+            writer.writeheader()
+            writer.writerows(index_rows)
+        print(f"\nCell index saved to: {index_path}")
+
+    log_path = Path("results/logs") / "pipeline.log"
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, 'a') as f:
+        f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Phase 5 - QA Contact Sheets COMPLETED\n")
+        for dataset_name, (n_pairs, n_sheets) in counts.items():
+            f.write(f"  {dataset_name}: {n_pairs} pairs on {n_sheets} sheet(s)\n")
+        f.write(f"Output: {output_dir}/\n")
+
+    print(f"\nLog updated: {log_path}")
+    print(f"End time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print("="*60)
+    return 0 if index_rows else 1
 
 
 def process_lc25000():
@@ -147,14 +469,15 @@ def process_lc25000():
 
     # Select 3 representative images
     norm_images = select_representative_images(normalized_dir, n_samples=3)
+    originals = DatasetCatalog(original_dir)
 
     success_count = 0
     for i, norm_path in enumerate(norm_images, 1):
-        # Find corresponding original
+        # Find corresponding original (same relative path)
         relative_path = norm_path.relative_to(normalized_dir)
-        orig_path = original_dir / relative_path
+        orig_path = originals.find(relative_path)
 
-        if not orig_path.exists():
+        if orig_path is None or orig_path.relative_to(original_dir) != relative_path:
             continue
 
         # Create comparison (with zoom for first example)
@@ -182,18 +505,14 @@ def process_crc5000():
 
     # Select 3 representative images
     norm_images = select_representative_images(normalized_dir, n_samples=3)
+    originals = DatasetCatalog(original_dir)
 
     success_count = 0
     for i, norm_path in enumerate(norm_images, 1):
-        # Find corresponding original
-        relative_path = norm_path.relative_to(normalized_dir)
-        orig_path = original_dir / relative_path
+        # Find corresponding original (same relative path, else same file name)
+        orig_path = originals.find(norm_path.relative_to(normalized_dir))
 
-        if not orig_path.exists():
-            # Try alternative location
-            orig_path = original_dir / norm_path.name
-
-        if not orig_path.exists():
+        if orig_path is None:
             continue
 
         # Create comparison (with zoom for first example)
@@ -210,6 +529,31 @@ def process_crc5000():
 
 def main():
     """Main function to generate all visual examples."""
+    parser = argparse.ArgumentParser(description="Visual examples and QA contact sheets")
+    parser.add_argument('--contact-sheets', action='store_true',
+                        help="Build QA contact sheets of many thumbnail pairs instead of "
+                             "the per-pair matplotlib figures")
+    parser.add_argument('--pairs', type=int, default=500,
+                        help="Contact sheets: pairs per dataset, stratified by class (default: %(default)s)")
+    parser.add_argument('--pairs-per-sheet', type=int, default=500,
+                        help="Contact sheets: pairs per sheet (default: %(default)s)")
+    parser.add_argument('--thumb-size', type=int, default=PROCESSING['qa_thumb_size'],
+                        help="Contact sheets: thumbnail edge in pixels (default: %(default)s)")
+    parser.add_argument('--columns', type=int, default=PROCESSING['qa_columns'],
+                        help="Contact sheets: pairs per row (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=PROCESSING['workers'],
+                        help="Contact sheets: thumbnail worker processes (default: %(default)s)")
+    parser.add_argument('--thumbnail-dir', default=PROCESSING['thumbnail_dir'],
+                        help="Contact sheets: thumbnail cache directory (default: %(default)s)")
+    parser.add_argument('--no-thumbnail-cache', dest='thumbnail_dir', action='store_const', const=None,
+                        help="Contact sheets: do not cache thumbnails")
+    args = parser.parse_args()
+    if args.pairs < 1 or args.pairs_per_sheet < 1 or args.thumb_size < 8 or args.columns < 1:
+        parser.error("--pairs, --pairs-per-sheet and --columns must be positive, --thumb-size at least 8")
+
+    if args.contact_sheets:
+        return contact_sheets_main(args)
+
     print("="*60)
     print("VISUAL EXAMPLES GENERATION - Phase 5")
     print("="*60)
@@ -249,7 +593,8 @@ def main():
     print(f"\nLog updated: {log_path}")
     print(f"End time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*60)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Overlapped I/O Pipeline
+Decode and encode/write on thread pools around an in-order compute stage,
+with a bounded number of images in flight
+"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# End-of-items marker for the lazily consumed item iterator
+_END = object()
+
+
+def overlapped_map(items, decode, compute, encode, threads=2, depth=8):
+    """
+    Run decode -> compute -> encode over `items` with overlapped I/O.
+
+    Decoding runs up to `depth` items ahead on a thread pool, compute runs
+    in the calling thread in item order, and encoding/writing runs on a
+    second thread pool with at most `depth` pending writes. OpenCV codecs
+    and most large NumPy operations release the GIL, so disk reads, JPEG /
+    TIFF coding and the numerical core overlap. At most about 2 x `depth`
+    decoded or normalized images are held in memory at once.
+
+    Each stage receives the item and the previous stage's result. An
+    exception in any stage is caught and returned for that item, so one
+    bad item does not stop the stream.
+
+    Parameters:
+    -----------
+    items : list
+        Work items (e.g. (input_path, output_path) tasks)
+    decode : callable
+        decode(item) -> decoded
+    compute : callable
+        compute(item, decoded) -> computed
+    encode : callable
+        encode(item, computed) -> result
+    threads : int
+        Threads in each of the decode and encode pools
+    depth : int
+        Maximum items decoded ahead of compute, and maximum pending writes
+
+    Returns:
+    --------
+    list : Per item, the encode result or the exception raised for it
+    """
+    return list(overlapped_imap(items, decode, compute, encode, threads, depth))
+
+
+def overlapped_imap(items, decode, compute, encode, threads=2, depth=8):
+    """
+    Streaming `overlapped_map`: yields each item's result, in item order, as
+    soon as it is written.
+
+    `items` may be any iterable and is consumed lazily (at most `depth`
+    items ahead of compute), so one pipeline can run over a whole task list
+    without draining between batches of work.
+    """
+    depth = max(1, depth)
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=threads) as decode_pool, \
+            ThreadPoolExecutor(max_workers=threads) as encode_pool:
+        decoding = deque()
+        # (future or outcome) per item in order; failed items hold their exception
+        writing = deque()
+        exhausted = False
+
+        def fill_decode_queue():
+            nonlocal exhausted
+            while not exhausted and len(decoding) < depth:
+                item = next(items, _END)
+                if item is _END:
+                    exhausted = True
+                    return
+                decoding.append((item, decode_pool.submit(decode, item)))
+
+        def collect_write():
+            pending = writing.popleft()
+            return _result(pending) if isinstance(pending, Future) else pending
+
+        fill_decode_queue()
+        while decoding:
+            item, future = decoding.popleft()
+            fill_decode_queue()
+
+            decoded = _result(future)
+            if isinstance(decoded, Exception):
+                outcome = decoded
+            else:
+                try:
+                    outcome = encode_pool.submit(encode, item, compute(item, decoded))
+                except Exception as e:
+                    outcome = e
+
+            while len(writing) >= depth:
+                yield collect_write()
+            writing.append(outcome)
+
+        while writing:
+            yield collect_write()
+
+
+def _result(future):
+    """Future result, or the exception it raised."""
+    try:
+        return future.result()
+    except Exception as e:
+        return e
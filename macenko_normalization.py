@@ -7,67 +7,170 @@ IEEE ISBI 2009
 import numpy as np
 import cv2
 from pathlib import Path
+import os
 import sys
+import time
 
 sys.path.append(str(Path(__file__).parent.parent))
-from config.pipeline_config import MACENKO_PARAMS
+from config.pipeline_config import MACENKO_PARAMS, RANDOM_SEED
+from src.fused_kernel import fused_reconstruct, fused_rescale, resolve_backend
 
+# Handling of tiles below the tissue pre-check threshold (see MacenkoNormalizer)
+LOW_TISSUE_MODES = ('passthrough', 'reference')
 
-def macenko_normalize(img, Io=240, alpha=1, beta=0.15, HERef=None, maxCRef=None):
+# Tissue covariances whose second-largest eigenvalue is at most this fraction of
+# the largest are near-singular: their stain plane is set by rounding noise, so
+# the low-memory, unique-color and batched paths reproduce the default
+# computation there
+NEAR_SINGULAR_EIGVAL_RATIO = 1e-4
+
+# Tiles with fewer tissue pixels are computed in float64 on the low-memory path
+# (a near-singular tissue covariance makes the float32 stain estimate unstable)
+LOW_MEMORY_MIN_TISSUE = 1024
+
+# cv2 decode flags for reduced-resolution reads (JPEG downscales in the DCT domain)
+REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def rgb_to_od(img_flat, Io=240):
+    """Convert flattened RGB values (N x 3) to optical density."""
+    return -np.log((img_flat + 1) / Io)
+
+
+def od_lookup_table(Io=240):
     """
-    Apply Macenko color normalization to an H&E stained image.
+    Optical density of every possible uint8 intensity (256,).
+
+    Indexing this table with a uint8 image gives exactly the values of
+    `rgb_to_od` without evaluating a logarithm per pixel.
+    """
+    return rgb_to_od(np.arange(256, dtype=np.float64), Io)
+
+
+def get_stain_matrix(OD, alpha=1, beta=0.15, stats=None):
+    """
+    Estimate the H&E stain matrix from optical densities.
 
     Parameters:
     -----------
-    img : np.ndarray
-        Input RGB image (H x W x 3)
-    Io : int
-        Transmitted light intensity (default 240)
+    OD : np.ndarray
+        Optical densities (N_pixels x 3)
     alpha : float
-        Percentile for robust OD computation (default 1%)
+        Percentile for robust angle computation
     beta : float
-        OD threshold for tissue detection (default 0.15)
-    HERef : np.ndarray
-        Reference H&E stain matrix (3 x 2)
-    maxCRef : np.ndarray
-        Reference maximum concentrations (2,)
+        OD threshold for tissue detection
+    stats : dict
+        Optional dict that receives 'tissue_fraction' and 'eigvals'
 
     Returns:
     --------
-    np.ndarray : Normalized RGB image
+    np.ndarray or None : Stain matrix (3 x 2), or None if no tissue was detected
     """
-    # Set default reference values if not provided
-    if HERef is None:
-        HERef = np.array(MACENKO_PARAMS['HERef'])
-    if maxCRef is None:
-        maxCRef = np.array(MACENKO_PARAMS['maxCRef'])
+    # Remove transparent pixels (background)
+    ODhat = tissue_od(OD, beta)
 
-    # Reshape image to (N_pixels, 3)
-    h, w, c = img.shape
-    img_flat = img.reshape((-1, 3)).astype(np.float64)
+    if stats is not None:
+        stats['tissue_fraction'] = ODhat.shape[0] / max(OD.shape[0], 1)
 
-    # Convert RGB to optical density (OD)
-    OD = -np.log((img_flat + 1) / Io)
+    if ODhat.shape[0] == 0:
+        return None
 
-    # Remove transparent pixels (background)
-    ODhat = OD[~np.any(OD < beta, axis=1)]
+    return stain_matrix_from_tissue(ODhat, alpha, stats=stats)
 
-    if ODhat.shape[0] == 0:
-        # If no tissue detected, return original image
-        return img
 
-    # Compute eigenvectors (stain vectors)
-    eigvals, eigvecs = np.linalg.eigh(np.cov(ODhat.T))
+def tissue_od(OD, beta=0.15):
+    """Optical densities of tissue pixels (N_tissue x 3): no channel below `beta`."""
+    return OD[~np.any(OD < beta, axis=1)]
+
+
+def tissue_eigh(ODhat):
+    """Eigenvalues (ascending) and eigenvectors (3 x 3) of the tissue OD covariance."""
+    return np.linalg.eigh(np.cov(ODhat.T))
+
+
+def angle_percentiles(ODhat, eigvecs, alpha=1, select=False):
+    """
+    Robust minimum and maximum angles of the tissue pixels projected on the
+    plane of the two largest eigenvectors.
+
+    Parameters:
+    -----------
+    ODhat : np.ndarray
+        Optical densities of tissue pixels (N_tissue x 3)
+    eigvecs : np.ndarray
+        Eigenvectors of the tissue OD covariance (3 x 3, ascending eigenvalues)
+    alpha : float
+        Percentile for robust angle computation
+    select : bool
+        Compute both percentiles with a single `np.partition`
 
+    Returns:
+    --------
+    tuple : (minPhi, maxPhi)
+    """
     # Project on the plane spanned by the two largest eigenvectors
     That = ODhat.dot(eigvecs[:, 1:3])
 
     # Find the min and max angles
     phi = np.arctan2(That[:, 1], That[:, 0])
 
-    minPhi = np.percentile(phi, alpha)
-    maxPhi = np.percentile(phi, 100 - alpha)
+    if select:
+        minPhi, maxPhi = select_percentiles(phi[np.newaxis, :], (alpha, 100 - alpha))[:, 0]
+    else:
+        minPhi = np.percentile(phi, alpha)
+        maxPhi = np.percentile(phi, 100 - alpha)
+    return minPhi, maxPhi
+
+
+def stain_matrix_from_tissue(ODhat, alpha=1, select=False, stats=None):
+    """
+    Estimate the H&E stain matrix from tissue optical densities.
+
+    Parameters:
+    -----------
+    ODhat : np.ndarray
+        Optical densities of tissue pixels (N_tissue x 3), N_tissue > 0
+    alpha : float
+        Percentile for robust angle computation
+    select : bool
+        Compute both angle percentiles with a single `np.partition`
+        (same values as two `np.percentile` calls)
+    stats : dict
+        Optional dict that receives the covariance 'eigvals' (ascending)
+
+    Returns:
+    --------
+    np.ndarray : Stain matrix (3 x 2)
+    """
+    # Compute eigenvectors (stain vectors)
+    eigvals, eigvecs = tissue_eigh(ODhat)
+    if stats is not None:
+        stats['eigvals'] = eigvals
+
+    minPhi, maxPhi = angle_percentiles(ODhat, eigvecs, alpha, select)
+
+    return stain_matrix_from_angles(eigvecs, minPhi, maxPhi)
 
+
+def stain_matrix_from_angles(eigvecs, minPhi, maxPhi):
+    """
+    Build the H&E stain matrix from the extreme angles in the eigenvector plane.
+
+    Parameters:
+    -----------
+    eigvecs : np.ndarray
+        Eigenvectors of the tissue OD covariance (3 x 3, ascending eigenvalues)
+    minPhi, maxPhi : float
+        Robust minimum and maximum angles of the projected tissue pixels
+
+    Returns:
+    --------
+    np.ndarray : Stain matrix (3 x 2), hematoxylin first
+    """
     # Compute stain vectors
     vMin = eigvecs[:, 1:3].dot(np.array([(np.cos(minPhi), np.sin(minPhi))]).T)
     vMax = eigvecs[:, 1:3].dot(np.array([(np.cos(maxPhi), np.sin(maxPhi))]).T)
@@ -81,26 +184,1051 @@ def macenko_normalize(img, Io=240, alpha=1, beta=0.15, HERef=None, maxCRef=None)
     # Rows of HE must be normalized
     HE = HE / np.linalg.norm(HE, axis=0)
 
-    # Compute source concentrations
-    C = np.linalg.lstsq(HE, OD.T, rcond=None)[0]
+    return HE
+
+
+def get_concentrations(OD, HE):
+    """Solve for stain concentrations (2 x N_pixels) given a stain matrix."""
+    return np.linalg.lstsq(HE, OD.T, rcond=None)[0]
+
 
-    # Normalize stain concentrations
+def get_max_concentrations(C):
+    """Robust (99th percentile) maximum concentration of each stain."""
     maxC = np.array([np.percentile(C[0, :], 99), np.percentile(C[1, :], 99)])
 
     # Avoid division by zero
     maxC[maxC == 0] = 1.0
 
-    C = C * (maxCRef / maxC)[:, np.newaxis]
+    return maxC
+
+
+def _record(stats, HE, maxC):
+    """Store the source estimate in an optional stats dict; returns maxC."""
+    if stats is not None:
+        stats['HE'] = HE
+        stats['maxC'] = maxC
+    return maxC
+
+
+def _percentile_ranks(counts, q):
+    """Lower and upper ranks and interpolation weight of percentile `q` of `counts` samples."""
+    quantile = np.true_divide(q, 100)
+    virtual = (counts - 1) * quantile
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+
+    previous = previous.astype(np.intp)
+    following = np.minimum(previous + 1, counts - 1)
+    return previous, following, gamma
+
+
+def _interpolate(a, b, gamma):
+    """Linear interpolation between the values at the two ranks, as `np.percentile`."""
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+
+def _percentile_of_sorted(sorted_rows, counts, q):
+    """
+    Percentile of each row of a row-sorted array (NumPy's default 'linear' method).
+
+    Only the first `counts[i]` values of row `i` are considered, which lets
+    rows with different numbers of valid samples share one array. Rows only
+    need to be sorted around the two interpolation ranks, so the output of
+    `np.partition` at those ranks is also accepted. The interpolation mirrors
+    `np.percentile`, so results are bit-identical.
+    """
+    previous, following, gamma = _percentile_ranks(counts, q)
+    rows = np.arange(sorted_rows.shape[0])
+    return _interpolate(sorted_rows[rows, previous], sorted_rows[rows, following], gamma)
+
+
+def select_percentiles(rows, qs):
+    """
+    Percentiles of every row of a 2-D array using O(n) selection.
+
+    All requested ranks are found with one `np.partition` call instead of a
+    separate `np.percentile` per percentile and row; values are identical
+    to `np.percentile` (default 'linear' method).
+
+    Parameters:
+    -----------
+    rows : np.ndarray
+        Values (N_rows x N)
+    qs : sequence of float
+        Percentiles in [0, 100]
+
+    Returns:
+    --------
+    np.ndarray : Percentiles (len(qs) x N_rows)
+    """
+    n = rows.shape[1]
+    kth = set()
+    for q in qs:
+        lower = int(np.floor((n - 1) * np.true_divide(q, 100)))
+        kth.update((lower, min(lower + 1, n - 1)))
+
+    partitioned = np.partition(rows, sorted(kth), axis=1)
+    counts = np.full(rows.shape[0], n)
+    return np.array([_percentile_of_sorted(partitioned, counts, q) for q in qs])
+
+
+def _weighted_rank_values(values, weights, total, ranks):
+    """
+    Values at the given ranks of `values` expanded by integer `weights`.
+
+    With weights >= 1, the value at rank r from the bottom is among the
+    r + 1 smallest distinct values (likewise from the top), so only that
+    tail is selected with `np.argpartition` and sorted.
+    """
+    m = values.shape[0]
+    low, high = min(ranks), max(ranks)
+    if low < total - 1 - high:
+        n = min(high + 1, m)
+        tail = np.argpartition(values, n - 1)[:n] if n < m else np.arange(m)
+        below = 0
+    else:
+        n = min(total - low, m)
+        tail = np.argpartition(values, m - n)[m - n:] if n < m else np.arange(m)
+        below = None
+    tail = tail[np.argsort(values[tail], kind='stable')]
+    cumulative = np.cumsum(weights[tail])
+    if below is None:
+        below = total - cumulative[-1]
+    return [values[tail[np.searchsorted(cumulative, rank - below, side='right')]] for rank in ranks]
+
+
+def weighted_percentiles(rows, weights, qs):
+    """
+    Percentiles of every row of a 2-D array whose columns are repeated samples.
+
+    Column `j` stands for `weights[j]` copies of its value, so the result is
+    `np.percentile` of each row expanded by the weights (bit-identical, the
+    same 'linear' interpolation) without expanding it: the two
+    interpolation ranks are located in the cumulative weights of the
+    sorted tail that contains them.
+
+    Parameters:
+    -----------
+    rows : np.ndarray
+        Values (N_rows x N)
+    weights : np.ndarray
+        Integer sample count (>= 1) of each column (N,)
+    qs : sequence of float
+        Percentiles in [0, 100]
+
+    Returns:
+    --------
+    np.ndarray : Percentiles (len(qs) x N_rows)
+    """
+    total = int(weights.sum())
+    result = []
+    for q in qs:
+        previous, following, gamma = _percentile_ranks(total, q)
+        a, b = np.array([_weighted_rank_values(row, weights, total, (int(previous), int(following)))
+                         for row in rows]).T
+        result.append(_interpolate(a, b, gamma))
+    return np.array(result)
+
+
+def unique_colors(img):
+    """
+    Distinct colors of a uint8 RGB image and where they occur.
+
+    Pixels are packed into 24-bit keys (R << 16 | G << 8 | B) and
+    deduplicated with one sort.
+
+    Returns:
+    --------
+    tuple : (colors, inverse, counts) with colors (N_colors x 3, uint8,
+            in key order), inverse (N_pixels,) such that
+            `colors[inverse]` is the flattened image, and the pixel count
+            of each color (N_colors,)
+    """
+    pixels = img.reshape((-1, 3))
+    keys = pixels[:, 0].astype(np.uint32) << 16
+    keys |= pixels[:, 1].astype(np.uint32) << 8
+    keys |= pixels[:, 2]
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    colors = np.empty((keys.shape[0], 3), dtype=np.uint8)
+    colors[:, 0] = keys >> 16
+    colors[:, 1] = keys >> 8
+    colors[:, 2] = keys
+    return colors, inverse.reshape(-1), counts
+
+
+def estimate_stain_params(img, Io=240, alpha=1, beta=0.15):
+    """
+    Estimate the stain matrix and maximum concentrations of an image.
+
+    Parameters:
+    -----------
+    img : np.ndarray
+        Input RGB image (H x W x 3)
+    Io : int
+        Transmitted light intensity
+    alpha : float
+        Percentile for robust angle computation
+    beta : float
+        OD threshold for tissue detection
+
+    Returns:
+    --------
+    tuple or None : (HE, maxC) with shapes (3, 2) and (2,), or None if no tissue
+    """
+    OD = rgb_to_od(img.reshape((-1, 3)).astype(np.float64), Io)
 
-    # Recreate the image using reference stain vectors
-    Inorm = np.exp(-HERef.dot(C)) * Io
-    Inorm[Inorm > 255] = 255
-    Inorm = np.reshape(Inorm.T, (h, w, 3)).astype(np.uint8)
+    HE = get_stain_matrix(OD, alpha, beta)
+    if HE is None:
+        return None
 
-    return Inorm
+    C = get_concentrations(OD, HE)
+    return HE, get_max_concentrations(C)
 
 
-def normalize_image_file(input_path, output_path, **kwargs):
+class MacenkoNormalizer:
+    """
+    Fit-once / transform-many Macenko normalizer.
+
+    The reference stain matrix and maximum concentrations are either taken
+    from `pipeline_config.MACENKO_PARAMS` or fitted on a target tile with
+    `fit`. All reference-side constants are computed once, so `transform`
+    only does the per-image (source-side) work. Instances are plain Python
+    objects holding NumPy arrays and can be pickled to worker processes.
+
+    Source stain vectors and maximum concentrations can be estimated on a
+    reduced set of pixels: a seeded random subsample of `sample_pixels`
+    pixels and/or a copy downscaled by `estimation_scale`. The full-resolution
+    image is always transformed. An estimation set with a single tissue
+    pixel (e.g. sparse tissue averaged away by downscaling) has no
+    covariance, so such tiles are estimated at full resolution instead.
+
+    Setting `dtype='float32'` and/or `chunk_pixels` selects a low-memory path
+    that streams the concentration solve and reconstruction over blocks of
+    `chunk_pixels` pixels into a preallocated uint8 output. Combined with
+    `sample_pixels`, peak memory is bounded by the chunk size; with exact
+    estimation the tissue OD and the 2 x N concentrations (needed for the
+    99th percentile) are still held in `dtype`. The float64 chunked output
+    is identical to `transform`; on LC25000/CRC5000-sized H&E tiles the
+    float32 output differs from the float64 path by at most 1 intensity
+    level, on roughly 0.001% of pixels. The bound needs a well-conditioned
+    tissue covariance: with very few tissue pixels (2 pixels give a rank-1
+    covariance) or a single tissue color the float32 eigenvectors can flip
+    and the output differ by hundreds of levels, so tiles with fewer than
+    LOW_MEMORY_MIN_TISSUE tissue pixels or a near-singular covariance
+    (NEAR_SINGULAR_EIGVAL_RATIO) are computed in float64 (still chunked).
+
+    `fast=True` selects an exact fast path: OD and the tissue mask come from
+    256-entry lookup tables, concentrations are one matmul with the
+    pseudo-inverse of the stain matrix instead of `lstsq`, and percentiles
+    use a single `np.partition` selection instead of repeated
+    `np.percentile` calls. Output matches `transform` (see
+    fast_path_report.py for the equivalence checks).
+
+    `unique_colors=True` runs the per-pixel math once per distinct color:
+    pixels are packed into 24-bit keys and deduplicated, OD, angles,
+    concentrations and the reconstruction are computed per color, the
+    covariance and percentiles are weighted by the color counts, and the
+    output colors are scattered back through the inverse index. The
+    weighted percentiles are exact; the weighted covariance can differ
+    from `np.cov` over the pixels in the last floating-point bits, and the
+    uint8 output is identical to `transform` (checked by
+    fast_path_report.py). Near-singular covariances (e.g. a single tissue
+    color), whose eigenvectors depend on exactly those bits, are
+    recomputed over the pixels. Deduplication costs one sort of the pixel keys,
+    so the mode pays off when distinct colors are a small fraction of the
+    pixels: 768 x 768 LC25000 tiles (~20% distinct colors) are about 2x
+    faster and 2048 x 2048 tiles (~10%) about 2.3x, while 150 x 150
+    CRC5000 tiles (~85%) gain nothing. It applies to the exact float64
+    path (not with reduced estimation, `dtype`/`chunk_pixels` or
+    `transform_batch`) and takes precedence over `fast`.
+
+    `fused` replaces the transform half of the float64 path (OD, solve,
+    rescaling, reconstruction, clipping and uint8 conversion, which
+    otherwise make a full pass and a new array each) with one pass per
+    pixel straight into the uint8 output (see fused_kernel.py): 'numba'
+    runs a multithreaded Numba kernel, 'numpy' a blocked NumPy version of
+    the same math, and 'auto' picks Numba when it is installed. In
+    `transform` the exact estimate is the fast path's (whose concentrations
+    are then rescaled and reconstructed in one pass), so the output matches
+    `transform`; the benchmark reports both backends. It applies to
+    `transform` (after `unique_colors`, in place of `fast`) and
+    `apply_stain_params`, not to the low-memory path.
+
+    `min_tissue_fraction` enables a tissue pre-check: the tissue fraction is
+    estimated on a thumbnail downscaled by `precheck_scale` (the background
+    lookup table applied to area-averaged pixels), and tiles below the
+    threshold skip stain estimation. `low_tissue` selects what they get:
+    'passthrough' returns the tile unchanged (as for tiles without tissue),
+    'reference' projects it onto the reference stain vectors with the
+    reference maxC as source estimate (concentration solve and
+    reconstruction only). Near-empty tiles otherwise pay for the full OD /
+    covariance / percentile path on a handful of tissue pixels, and are the
+    tiles whose estimate is degenerate.
+
+    Example:
+    --------
+    >>> normalizer = MacenkoNormalizer().fit(reference_rgb)
+    >>> normalized = normalizer.transform(img_rgb)
+    """
+
+    def __init__(self, Io=240, alpha=1, beta=0.15, HERef=None, maxCRef=None,
+                 sample_pixels=None, estimation_scale=1, seed=RANDOM_SEED,
+                 dtype='float64', chunk_pixels=None, fast=False, min_tissue_fraction=None,
+                 precheck_scale=8, low_tissue='passthrough', unique_colors=False, fused=None):
+        if low_tissue not in LOW_TISSUE_MODES:
+            raise ValueError(f"low_tissue must be one of {LOW_TISSUE_MODES}, got {low_tissue!r}")
+        self.Io = Io
+        self.alpha = alpha
+        self.beta = beta
+        self.sample_pixels = sample_pixels
+        self.estimation_scale = estimation_scale
+        self.seed = seed
+        self.dtype = np.dtype(dtype)
+        self.chunk_pixels = chunk_pixels
+        self.fast = fast
+        self.min_tissue_fraction = min_tissue_fraction
+        self.precheck_scale = precheck_scale
+        self.low_tissue = low_tissue
+        self.unique_colors = unique_colors
+        self.fused = None if fused is None else resolve_backend(fused)
+
+        # Source-side lookup tables for uint8 inputs
+        self._od_lut = od_lookup_table(Io)
+        self._background_lut = self._od_lut < beta
+
+        if HERef is None:
+            HERef = MACENKO_PARAMS['HERef']
+        if maxCRef is None:
+            maxCRef = MACENKO_PARAMS['maxCRef']
+
+        self._set_reference(HERef, maxCRef)
+
+    def _set_reference(self, HERef, maxCRef):
+        """Store the reference stain state and precompute derived constants."""
+        self.HERef = np.array(HERef, dtype=np.float64)
+        self.maxCRef = np.array(maxCRef, dtype=np.float64)
+
+        # Negated reference matrix used in the reconstruction exponent
+        self._neg_HERef = -self.HERef
+
+    def get_params(self):
+        """All settings that affect the output, as a JSON-serialisable dict."""
+        params = {
+            'Io': self.Io,
+            'alpha': self.alpha,
+            'beta': self.beta,
+            'HERef': self.HERef.tolist(),
+            'maxCRef': self.maxCRef.tolist(),
+            'sample_pixels': self.sample_pixels,
+            'estimation_scale': self.estimation_scale,
+            'seed': self.seed,
+            'dtype': self.dtype.name,
+            'chunk_pixels': self.chunk_pixels,
+            'fast': self.fast,
+        }
+        if self.min_tissue_fraction is not None:
+            params.update(min_tissue_fraction=self.min_tissue_fraction,
+                          precheck_scale=self.precheck_scale, low_tissue=self.low_tissue)
+        if self.unique_colors:
+            params['unique_colors'] = True
+        if self.fused is not None:
+            params['fused'] = self.fused
+        return params
+
+    def fit(self, reference_image):
+        """
+        Derive HERef and maxCRef from a reference (target) RGB image.
+
+        Parameters:
+        -----------
+        reference_image : np.ndarray
+            Reference RGB image (H x W x 3)
+
+        Returns:
+        --------
+        MacenkoNormalizer : self
+        """
+        params = estimate_stain_params(reference_image, self.Io, self.alpha, self.beta)
+        if params is None:
+            raise ValueError("No tissue detected in reference image")
+
+        self._set_reference(*params)
+        return self
+
+    @property
+    def reduced_estimation(self):
+        """True if stain estimation does not use every full-resolution pixel."""
+        return self.sample_pixels is not None or self.estimation_scale > 1
+
+    @property
+    def low_memory(self):
+        """True if the float32 / chunked compute path is selected."""
+        return self.dtype != np.float64 or self.chunk_pixels is not None
+
+    def _estimation_od(self, img, OD=None, estimation_image=None):
+        """
+        Optical densities used for stain estimation (subsampled/downscaled if configured).
+
+        `OD` is the full-resolution OD of `img` if already computed; otherwise
+        only the selected pixels are converted.
+        """
+        if estimation_image is None and self.estimation_scale > 1:
+            h, w = img.shape[:2]
+            size = (max(1, w // self.estimation_scale), max(1, h // self.estimation_scale))
+            estimation_image = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+        if estimation_image is not None:
+            img, OD = estimation_image, None
+
+        pixels = img.reshape((-1, 3))
+        if self.sample_pixels is not None and pixels.shape[0] > self.sample_pixels:
+            rng = np.random.default_rng(self.seed)
+            idx = np.sort(rng.choice(pixels.shape[0], self.sample_pixels, replace=False))
+            if OD is not None:
+                return OD[idx]
+            pixels = pixels[idx]
+
+        if OD is None:
+            OD = rgb_to_od(pixels.astype(np.float64), self.Io)
+        return OD
+
+    def estimate(self, img, estimation_image=None):
+        """
+        Estimate the source stain matrix and maximum concentrations of an image.
+
+        Parameters:
+        -----------
+        img : np.ndarray
+            Input RGB image (H x W x 3)
+        estimation_image : np.ndarray
+            Optional pre-reduced copy of `img` (e.g. from a reduced decode)
+
+        Returns:
+        --------
+        tuple or None : (HE, maxC), or None if no tissue was detected
+        """
+        OD = rgb_to_od(img.reshape((-1, 3)).astype(np.float64), self.Io)
+        params = self._estimate(img, OD, estimation_image)
+        return None if params is None else params[:2]
+
+    def _estimate(self, img, OD, estimation_image=None, stats=None):
+        """
+        Estimate (HE, maxC, C) for an image given its full-resolution OD.
+
+        C holds the full-resolution concentrations when they were needed for
+        maxC (exact mode, or a reduced estimation set with a single tissue
+        pixel), and is None for reduced estimation modes. `OD` may be None
+        in reduced modes.
+        """
+        if self.reduced_estimation or estimation_image is not None:
+            est_OD = self._estimation_od(img, OD, estimation_image)
+            if not self._single_tissue_pixel(est_OD):
+                HE = get_stain_matrix(est_OD, self.alpha, self.beta, stats)
+                if HE is None:
+                    return None
+                return HE, _record(stats, HE, get_max_concentrations(get_concentrations(est_OD, HE))), None
+            if OD is None:
+                OD = rgb_to_od(img.reshape((-1, 3)).astype(np.float64), self.Io)
+
+        HE = get_stain_matrix(OD, self.alpha, self.beta, stats)
+        if HE is None:
+            return None
+        C = get_concentrations(OD, HE)
+        return HE, _record(stats, HE, get_max_concentrations(C)), C
+
+    def _single_tissue_pixel(self, OD):
+        """True if exactly one row of `OD` is tissue (reduced estimation falls back to full resolution)."""
+        return np.count_nonzero(~np.any(OD < self.beta, axis=1)) == 1
+
+    def transform(self, img, estimation_image=None, stats=None):
+        """
+        Normalize an RGB image (H x W x 3) to the reference stain state.
+
+        `estimation_image` is an optional pre-reduced copy of `img` used for
+        stain estimation. Returns the input unchanged if no tissue is detected.
+
+        If `stats` is a dict it receives the source estimate: 'tissue_fraction',
+        'eigvals' (tissue OD covariance), 'HE' and 'maxC'. Entries are filled
+        as estimation progresses, so a failing image still reports how far it
+        got (e.g. its tissue fraction). With the tissue pre-check it also
+        receives 'thumbnail_tissue_fraction', and 'precheck' (the low_tissue
+        mode) for tiles that skipped estimation.
+        """
+        if self.min_tissue_fraction is not None and self.precheck(img, stats) is not None:
+            return self._transform_low_tissue(img)
+        if self.low_memory:
+            return self._transform_low_memory(img, estimation_image, stats)
+        if self.unique_colors and not self.reduced_estimation and estimation_image is None:
+            return self._transform_unique(img, stats)
+        if self.fused is not None:
+            return self._transform_fused(img, estimation_image, stats)
+        if self.fast and not self.reduced_estimation and estimation_image is None:
+            return self._transform_fast(img, stats)
+
+        # Reshape image to (N_pixels, 3)
+        h, w, c = img.shape
+        img_flat = img.reshape((-1, 3)).astype(np.float64)
+
+        # Convert RGB to optical density (OD)
+        OD = rgb_to_od(img_flat, self.Io)
+
+        params = self._estimate(img, OD, estimation_image, stats)
+        if params is None:
+            # If no tissue detected, return original image
+            return img
+        HE, maxC, C = params
+
+        # Compute source concentrations
+        if C is None:
+            C = get_concentrations(OD, HE)
+
+        return self.reconstruct(C, maxC, (h, w, c))
+
+    def reconstruct(self, C, maxC, shape):
+        """
+        Rescale source concentrations to the reference and rebuild the image.
+
+        Parameters:
+        -----------
+        C : np.ndarray
+            Source concentrations (2 x N_pixels)
+        maxC : np.ndarray
+            Source maximum concentrations (2,)
+        shape : tuple
+            Output image shape (H, W, 3)
+
+        Returns:
+        --------
+        np.ndarray : Normalized RGB image (uint8)
+        """
+        # Normalize stain concentrations
+        C = C * (self.maxCRef / maxC)[:, np.newaxis]
+
+        # Recreate the image using reference stain vectors
+        Inorm = np.exp(self._neg_HERef.dot(C)) * self.Io
+        Inorm[Inorm > 255] = 255
+        Inorm = np.reshape(Inorm.T, shape).astype(np.uint8)
+
+        return Inorm
+
+    def thumbnail_tissue_fraction(self, img):
+        """Tissue fraction of an RGB image estimated on its `precheck_scale` thumbnail."""
+        h, w = img.shape[:2]
+        if self.precheck_scale > 1:
+            size = (max(1, w // self.precheck_scale), max(1, h // self.precheck_scale))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        return float(self.tissue_mask(img.reshape((-1, 3))).mean())
+
+    def precheck(self, img, stats=None):
+        """
+        Tissue pre-check of one image.
+
+        Returns:
+        --------
+        str or None : The low_tissue mode if the image is below
+                      `min_tissue_fraction` (skip estimation), else None
+        """
+        fraction = self.thumbnail_tissue_fraction(img)
+        if stats is not None:
+            stats['thumbnail_tissue_fraction'] = fraction
+        if fraction >= self.min_tissue_fraction:
+            return None
+        if stats is not None:
+            stats['precheck'] = self.low_tissue
+        return self.low_tissue
+
+    def _transform_low_tissue(self, img):
+        """Output for a tile that failed the tissue pre-check."""
+        if self.low_tissue == 'reference':
+            return self.apply_stain_params(img, self.HERef, self.maxCRef)
+        return img
+
+    def optical_density(self, pixels):
+        """Optical density of uint8 pixels (... x 3) via the lookup table (float64)."""
+        return self._od_lut[pixels]
+
+    def tissue_mask(self, pixels):
+        """Tissue mask of uint8 pixels (... x 3) via the background lookup table."""
+        background = self._background_lut
+        return ~(background[pixels[..., 0]] | background[pixels[..., 1]] | background[pixels[..., 2]])
+
+    def _estimate_fast(self, pixels, stats=None):
+        """
+        Lookup-table / pseudo-inverse / selection stain estimate of uint8 pixels (N x 3).
+
+        Returns:
+        --------
+        tuple or None : (HE, maxC, C) with the source concentrations C (N x 2),
+                        or None if no tissue was detected
+        """
+        # OD and tissue mask from lookup tables
+        OD = self._od_lut[pixels]
+        ODhat = OD[self.tissue_mask(pixels)]
+        if stats is not None:
+            stats['tissue_fraction'] = ODhat.shape[0] / max(OD.shape[0], 1)
+
+        if ODhat.shape[0] == 0:
+            return None
+
+        HE = stain_matrix_from_tissue(ODhat, self.alpha, select=True, stats=stats)
+
+        # Source concentrations (N x 2) with the pseudo-inverse of HE
+        C = np.matmul(OD, np.linalg.pinv(HE).T)
+
+        maxC = select_percentiles(np.ascontiguousarray(C.T), (99,))[0]
+        maxC[maxC == 0] = 1.0
+        _record(stats, HE, maxC)
+        return HE, maxC, C
+
+    def _transform_fast(self, img, stats=None):
+        """Lookup-table / pseudo-inverse / selection variant of `transform`."""
+        h, w, c = img.shape
+        params = self._estimate_fast(img.reshape((-1, 3)), stats)
+        if params is None:
+            # If no tissue detected, return original image
+            return img
+        HE, maxC, C = params
+
+        # Normalize stain concentrations
+        C *= self.maxCRef / maxC
+
+        # Recreate the image using reference stain vectors
+        Inorm = np.exp(np.matmul(C, self._neg_HERef.T))
+        Inorm *= self.Io
+        np.minimum(Inorm, 255, out=Inorm)
+
+        return Inorm.reshape((h, w, c)).astype(np.uint8)
+
+    def _transform_unique(self, img, stats=None):
+        """Variant of `transform` computing the per-pixel math once per distinct color."""
+        h, w, c = img.shape
+        colors, inverse, counts = unique_colors(img)
+
+        # OD and tissue mask of each color
+        OD = rgb_to_od(colors.astype(np.float64), self.Io)
+        tissue = ~np.any(OD < self.beta, axis=1)
+        n_tissue = int(counts[tissue].sum())
+        if stats is not None:
+            stats['tissue_fraction'] = n_tissue / max(inverse.shape[0], 1)
+
+        if n_tissue == 0:
+            # If no tissue detected, return original image
+            return img
+
+        # Tissue covariance with each color weighted by its pixel count
+        eigvals, eigvecs = np.linalg.eigh(np.cov(OD[tissue].T, fweights=counts[tissue]))
+        if eigvals[1] <= NEAR_SINGULAR_EIGVAL_RATIO * eigvals[2]:
+            # Near-singular: the eigenvectors depend on the rounding of the
+            # per-pixel covariance, so compute it as `transform` does
+            ODhat = np.take(OD, inverse, axis=0)[tissue[inverse]]
+            eigvals, eigvecs = np.linalg.eigh(np.cov(ODhat.T))
+            del ODhat
+        if stats is not None:
+            stats['eigvals'] = eigvals
+
+        # Angles of the tissue colors, percentiles weighted by their pixel counts
+        That = OD[tissue].dot(eigvecs[:, 1:3])
+        phi = np.arctan2(That[:, 1], That[:, 0])
+        minPhi, maxPhi = weighted_percentiles(phi[np.newaxis, :], counts[tissue],
+                                              (self.alpha, 100 - self.alpha))[:, 0]
+        HE = stain_matrix_from_angles(eigvecs, minPhi, maxPhi)
+
+        # Concentrations of every color (2 x N_colors)
+        C = get_concentrations(OD, HE)
+        maxC = weighted_percentiles(C, counts, (99,))[0]
+        maxC[maxC == 0] = 1.0
+        _record(stats, HE, maxC)
+
+        # Normalize stain concentrations and recreate the colors
+        C = C * (self.maxCRef / maxC)[:, np.newaxis]
+        Inorm = np.exp(self._neg_HERef.dot(C)) * self.Io
+        Inorm[Inorm > 255] = 255
+        normalized = Inorm.T.astype(np.uint8)
+
+        # Scatter the normalized colors back to the pixels
+        return np.take(normalized, inverse, axis=0).reshape((h, w, c))
+
+    def _transform_fused(self, img, estimation_image=None, stats=None):
+        """Variant of `transform` with the fused single-pass reconstruction."""
+        if self.reduced_estimation or estimation_image is not None:
+            params = self._estimate(img, None, estimation_image, stats)
+            if params is None:
+                return img
+            # Only the estimation pixels were solved: go from the pixels
+            return self.apply_stain_params(img, *params[:2])
+
+        params = self._estimate_fast(img.reshape((-1, 3)), stats)
+        if params is None:
+            # If no tissue detected, return original image
+            return img
+        HE, maxC, C = params
+
+        # Reuse the concentrations solved for maxC
+        h, w, c = img.shape
+        out = np.empty((h * w, 3), dtype=np.uint8)
+        fused_rescale(C, self.maxCRef / maxC, self._neg_HERef.T, self.Io, out, self.fused)
+        return out.reshape((h, w, c))
+
+    def _chunks(self, n):
+        """(start, end) pixel ranges of the streamed blocks for n pixels."""
+        step = self.chunk_pixels or n
+        return [(s, min(s + step, n)) for s in range(0, n, step)]
+
+    def _chunk_od(self, pixels, dtype=None):
+        """Optical density of a block of uint8 pixels in the compute dtype (or `dtype`)."""
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        return rgb_to_od(pixels.astype(dtype), dtype.type(self.Io))
+
+    def _reconstruct(self, pixels, pinv, maxC, out, C_all=None, dtype=None):
+        """
+        Stream concentration solve, rescaling and reconstruction into `out`.
+
+        pinv is the transposed pseudo-inverse of the source stain matrix
+        (3 x 2, compute dtype); C_all optionally holds precomputed
+        concentrations (N x 2) that are rescaled in place. `dtype`
+        overrides the compute dtype.
+        """
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        scale = (self.maxCRef / maxC).astype(dtype)
+        neg_HERef = self._neg_HERef.T.astype(dtype)
+        Io = dtype.type(self.Io)
+
+        for s, e in self._chunks(pixels.shape[0]):
+            C = C_all[s:e] if C_all is not None else np.matmul(self._chunk_od(pixels[s:e], dtype), pinv)
+            C *= scale
+            Inorm = np.exp(np.matmul(C, neg_HERef))
+            Inorm *= Io
+            np.minimum(Inorm, 255, out=Inorm)
+            out[s:e] = Inorm
+
+    def apply_stain_params(self, img, HE, maxC):
+        """
+        Normalize an image with a known source stain matrix and maxC.
+
+        Skips stain estimation entirely, e.g. for tiles that share one
+        slide-level estimate. Honors `dtype` and `chunk_pixels`, and uses
+        the fused kernel on the float64 path if `fused` is set.
+
+        Parameters:
+        -----------
+        img : np.ndarray
+            Input RGB image (H x W x 3, uint8)
+        HE : np.ndarray
+            Source stain matrix (3 x 2)
+        maxC : np.ndarray
+            Source maximum concentrations (2,)
+
+        Returns:
+        --------
+        np.ndarray : Normalized RGB image
+        """
+        h, w, c = img.shape
+        pixels = img.reshape((-1, 3))
+        out = np.empty((pixels.shape[0], 3), dtype=np.uint8)
+        if self.fused is not None and not self.low_memory:
+            fused_reconstruct(pixels, self._od_lut, np.linalg.pinv(HE).T, self.maxCRef / np.asarray(maxC),
+                              self._neg_HERef.T, self.Io, out, self.fused)
+        else:
+            self._reconstruct(pixels, np.linalg.pinv(HE).T.astype(self.dtype), np.asarray(maxC), out)
+        return out.reshape((h, w, c))
+
+    def _transform_low_memory(self, img, estimation_image=None, stats=None):
+        """Float32 / chunked variant of `transform` writing into a uint8 output."""
+        h, w, c = img.shape
+        pixels = img.reshape((-1, 3))
+        n = pixels.shape[0]
+
+        C_all = None
+        dtype = self.dtype
+        reduced = self.reduced_estimation or estimation_image is not None
+        if reduced:
+            est_OD = self._estimation_od(img, estimation_image=estimation_image)
+            reduced = not self._single_tissue_pixel(est_OD)
+        if reduced:
+            HE = get_stain_matrix(est_OD, self.alpha, self.beta, stats)
+            if HE is None:
+                return img
+            maxC = get_max_concentrations(get_concentrations(est_OD, HE))
+            pinv = np.linalg.pinv(HE).T.astype(dtype)
+        else:
+            # Tissue OD collected chunk by chunk
+            def tissue_od(dtype):
+                return np.concatenate([
+                    OD[~np.any(OD < self.beta, axis=1)]
+                    for OD in (self._chunk_od(pixels[s:e], dtype) for s, e in self._chunks(n))
+                ])
+
+            ODhat = tissue_od(dtype)
+            if stats is not None:
+                stats['tissue_fraction'] = ODhat.shape[0] / max(n, 1)
+            if ODhat.shape[0] == 0:
+                return img
+            estimate = {}
+            if dtype != np.float64:
+                stable = ODhat.shape[0] >= LOW_MEMORY_MIN_TISSUE
+                if stable:
+                    HE = stain_matrix_from_tissue(ODhat, self.alpha, stats=estimate)
+                    eigvals = estimate['eigvals']
+                    stable = eigvals[1] > NEAR_SINGULAR_EIGVAL_RATIO * eigvals[2]
+                if not stable:
+                    # Too little tissue or a near-singular covariance for a float32 estimate
+                    dtype = np.dtype(np.float64)
+                    ODhat = tissue_od(dtype)
+            if dtype == np.float64:
+                HE = stain_matrix_from_tissue(ODhat, self.alpha, stats=estimate)
+            if stats is not None:
+                stats.update(estimate)
+            pinv = np.linalg.pinv(HE).T.astype(dtype)
+
+            # The 99th percentile needs the concentrations of every pixel
+            C_all = np.empty((n, 2), dtype=dtype)
+            for s, e in self._chunks(n):
+                np.matmul(self._chunk_od(pixels[s:e], dtype), pinv, out=C_all[s:e])
+            maxC = get_max_concentrations(C_all.T)
+        _record(stats, HE, maxC)
+
+        out = np.empty((n, 3), dtype=np.uint8)
+        self._reconstruct(pixels, pinv, maxC, out, C_all, dtype)
+
+        return out.reshape((h, w, c))
+
+    def transform_batch(self, stack, stats=None):
+        """
+        Normalize a stack of same-size RGB tiles (N x H x W x 3, uint8).
+
+        Covariance, eigen-decomposition, angle percentiles, concentration
+        solves and reconstruction are all done as batched NumPy operations.
+        Each tile is normalized with its own stain estimate, exactly as
+        `transform` would. The batched covariance and pseudo-inverse solve
+        can differ from `np.cov`/`lstsq` in the last floating-point bits; in
+        practice the uint8 output is identical to `transform`.
+
+        With a reduced estimation mode (`sample_pixels`/`estimation_scale`)
+        or the low-memory path the tiles are passed through `transform` one
+        at a time.
+
+        Tiles without tissue are returned unchanged. Tiles with a single
+        tissue pixel or a near-singular tissue covariance
+        (NEAR_SINGULAR_EIGVAL_RATIO), and tiles below the tissue pre-check
+        threshold, are passed to `transform`, which handles (or raises for)
+        them as it would for that tile on its own.
+
+        If `stats` is a list with one dict (or None) per tile, each dict
+        receives the entries `transform` would fill for that tile.
+        """
+        if stats is None:
+            stats = [None] * len(stack)
+        if self.reduced_estimation or self.low_memory:
+            return np.stack([self.transform(tile, stats=s) for tile, s in zip(stack, stats)])
+
+        n, h, w, c = stack.shape
+        out = np.empty_like(stack)
+
+        # Optical density (OD) and tissue mask from lookup tables, (N, P, 3)
+        pixels = stack.reshape((n, -1, 3))
+        OD = self._od_lut[pixels]
+        mask = self.tissue_mask(pixels)
+        counts = mask.sum(axis=1)
+
+        batched = counts > 1
+        if self.min_tissue_fraction is not None:
+            batched &= np.array([self.precheck(tile, s) is None for tile, s in zip(stack, stats)])
+        for i in np.flatnonzero(~batched):
+            out[i] = self.transform(stack[i], stats=stats[i])
+        if not batched.any():
+            return out
+
+        if not batched.all():
+            OD = OD[batched]
+            mask = mask[batched]
+            counts = counts[batched]
+
+        # Covariance of tissue OD per tile
+        weights = mask[:, np.newaxis, :].astype(np.float64)
+        mean = np.matmul(weights, OD) / counts[:, np.newaxis, np.newaxis]
+        X = np.subtract(OD, mean)
+        np.multiply(X, mask[:, :, np.newaxis], out=X)
+        cov = np.matmul(X.transpose(0, 2, 1), X) / (counts - 1)[:, np.newaxis, np.newaxis]
+
+        # Batched eigen-decomposition; plane of the two largest eigenvectors
+        eigvals, eigvecs = np.linalg.eigh(cov)
+
+        # Near-singular covariances: the eigenvectors depend on rounding, so
+        # those tiles are computed as `transform` does
+        singular = eigvals[:, 1] <= NEAR_SINGULAR_EIGVAL_RATIO * eigvals[:, 2]
+        if singular.any():
+            rows = np.flatnonzero(batched)[singular]
+            for i in rows:
+                out[i] = self.transform(stack[i], stats=stats[i])
+            batched[rows] = False
+            if not batched.any():
+                return out
+            OD, mask, counts = OD[~singular], mask[~singular], counts[~singular]
+            eigvals, eigvecs = eigvals[~singular], eigvecs[~singular]
+
+        plane = eigvecs[:, :, 1:3]
+
+        # Angles of tissue pixels in the plane; background sorts to the end
+        That = np.matmul(OD, plane)
+        phi = np.arctan2(That[:, :, 1], That[:, :, 0])
+        phi[~mask] = np.inf
+        phi.sort(axis=1)
+
+        minPhi = _percentile_of_sorted(phi, counts, self.alpha)
+        maxPhi = _percentile_of_sorted(phi, counts, 100 - self.alpha)
+
+        # Stain vectors, (N, 3)
+        vMin = np.matmul(plane, np.stack((np.cos(minPhi), np.sin(minPhi)), axis=1)[:, :, np.newaxis])[:, :, 0]
+        vMax = np.matmul(plane, np.stack((np.cos(maxPhi), np.sin(maxPhi)), axis=1)[:, :, np.newaxis])[:, :, 0]
+
+        # Stain matrix (H&E), hematoxylin first
+        swap = (vMin[:, 0] > vMax[:, 0])[:, np.newaxis]
+        HE = np.stack((np.where(swap, vMin, vMax), np.where(swap, vMax, vMin)), axis=2)
+        HE = HE / np.linalg.norm(HE, axis=1, keepdims=True)
+
+        # Source concentrations, (N, 2, P)
+        C = np.matmul(np.linalg.pinv(HE), OD.transpose(0, 2, 1))
+
+        # Normalize stain concentrations
+        maxC = select_percentiles(C.reshape((-1, C.shape[2])), (99,))[0].reshape((-1, 2))
+        maxC[maxC == 0] = 1.0
+        for j, i in enumerate(np.flatnonzero(batched)):
+            if stats[i] is not None:
+                stats[i].update(tissue_fraction=float(counts[j]) / (h * w), eigvals=eigvals[j],
+                                HE=HE[j], maxC=maxC[j])
+        C = C * (self.maxCRef / maxC)[:, :, np.newaxis]
+
+        # Recreate the images using reference stain vectors
+        Inorm = np.exp(np.matmul(C.transpose(0, 2, 1), self._neg_HERef.T)) * self.Io
+        np.minimum(Inorm, 255, out=Inorm)
+        out[batched] = Inorm.reshape((-1, h, w, c)).astype(np.uint8)
+
+        return out
+
+
+def macenko_normalize_batch(stack, Io=240, alpha=1, beta=0.15, HERef=None, maxCRef=None):
+    """
+    Apply Macenko color normalization to a stack of same-size tiles.
+
+    Parameters:
+    -----------
+    stack : np.ndarray
+        Input RGB tiles (N x H x W x 3, uint8)
+    Io, alpha, beta, HERef, maxCRef :
+        Same as `macenko_normalize`
+
+    Returns:
+    --------
+    np.ndarray : Normalized RGB tiles (N x H x W x 3)
+    """
+    return MacenkoNormalizer(Io, alpha, beta, HERef, maxCRef).transform_batch(stack)
+
+
+def macenko_normalize(img, Io=240, alpha=1, beta=0.15, HERef=None, maxCRef=None):
+    """
+    Apply Macenko color normalization to an H&E stained image.
+
+    Parameters:
+    -----------
+    img : np.ndarray
+        Input RGB image (H x W x 3)
+    Io : int
+        Transmitted light intensity (default 240)
+    alpha : float
+        Percentile for robust OD computation (default 1%)
+    beta : float
+        OD threshold for tissue detection (default 0.15)
+    HERef : np.ndarray
+        Reference H&E stain matrix (3 x 2)
+    maxCRef : np.ndarray
+        Reference maximum concentrations (2,)
+
+    Returns:
+    --------
+    np.ndarray : Normalized RGB image
+    """
+    return MacenkoNormalizer(Io, alpha, beta, HERef, maxCRef).transform(img)
+
+
+def read_image_rgb(path):
+    """Read an image from disk as RGB, or return None if it cannot be decoded."""
+    img = cv2.imread(str(path))
+    if img is None:
+        return None
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def read_estimation_image(path, scale):
+    """
+    Decode a reduced-resolution RGB copy of an image for stain estimation.
+
+    Uses cv2's IMREAD_REDUCED_COLOR_{2,4,8} flags, which let the JPEG decoder
+    skip most of the work. Returns None if the image cannot be decoded.
+    """
+    img = cv2.imread(str(path), REDUCED_COLOR_FLAGS[scale])
+    if img is None:
+        return None
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def write_image_rgb(path, img_rgb):
+    """
+    Save an RGB image to disk (format from extension), creating parent folders.
+
+    The image is encoded in memory and written to a temporary file that is
+    renamed into place, so an interrupted run never leaves a truncated
+    output behind.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    ok, encoded = cv2.imencode(path.suffix, cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise IOError(f"Could not encode {path}")
+
+    partial = path.with_name(f".{path.name}.partial")
+    with open(partial, 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(partial, path)
+    return True
+
+
+def decode_image_file(input_path, normalizer=None, stain_params=None):
+    """
+    Decode an input image and, if the normalizer uses one, its reduced estimation copy.
+
+    Returns:
+    --------
+    tuple or None : (img_rgb, estimation_image), or None if the image cannot be read
+    """
+    img_rgb = read_image_rgb(input_path)
+    if img_rgb is None:
+        return None
+
+    estimation_image = None
+    if (normalizer is not None and stain_params is None
+            and normalizer.estimation_scale in REDUCED_COLOR_FLAGS
+            and Path(input_path).suffix.lower() in ('.jpg', '.jpeg')):
+        estimation_image = read_estimation_image(input_path, normalizer.estimation_scale)
+
+    return img_rgb, estimation_image
+
+
+def normalize_decoded(img_rgb, estimation_image=None, normalizer=None, stats=None,
+                      stain_params=None, **kwargs):
+    """Normalize a decoded image (see `normalize_image_file` for the parameters)."""
+    if stain_params is not None:
+        HE, maxC = stain_params
+        return img_rgb if HE is None else normalizer.apply_stain_params(img_rgb, HE, maxC)
+    if normalizer is not None:
+        return normalizer.transform(img_rgb, estimation_image, stats)
+    return macenko_normalize(img_rgb, **kwargs)
+
+
+def normalize_image_file(input_path, output_path, normalizer=None, stats=None,
+                         stain_params=None, timings=None, on_normalized=None,
+                         writer=write_image_rgb, **kwargs):
     """
     Load, normalize, and save a single image.
 
@@ -110,6 +1238,24 @@ def normalize_image_file(input_path, output_path, **kwargs):
         Path to input image
     output_path : str or Path
         Path to save normalized image
+    normalizer : MacenkoNormalizer
+        Pre-built normalizer; if given, **kwargs are ignored
+    stats : dict
+        Optional dict that receives the source stain estimate (see
+        `MacenkoNormalizer.transform`); requires `normalizer`
+    stain_params : tuple
+        Known source (HE, maxC) of the image, e.g. from a StainParamStore;
+        skips stain estimation. (None, None) marks an image without tissue,
+        which is saved unchanged. Requires `normalizer`
+    timings : dict
+        Optional dict that receives the seconds spent in 'decode',
+        'normalize' and 'encode_write'
+    on_normalized : callable
+        Optional on_normalized(img_rgb, normalized) called with the
+        in-memory original and result after saving (e.g. quality metrics)
+    writer : callable
+        writer(output_path, normalized) that saves the result
+        (default: write_image_rgb)
     **kwargs : dict
         Additional parameters for macenko_normalize
 
@@ -118,25 +1264,32 @@ def normalize_image_file(input_path, output_path, **kwargs):
     bool : True if successful, False otherwise
     """
     try:
-        # Read image
-        img = cv2.imread(str(input_path))
-        if img is None:
+        start = time.perf_counter()
+
+        # Read image (RGB)
+        decoded = decode_image_file(input_path, normalizer, stain_params)
+        if decoded is None:
             print(f"Warning: Could not read {input_path}")
             return False
 
-        # Convert BGR to RGB
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        decoded_at = time.perf_counter()
 
         # Apply normalization
-        normalized = macenko_normalize(img_rgb, **kwargs)
+        normalized = normalize_decoded(*decoded, normalizer=normalizer, stats=stats,
+                                       stain_params=stain_params, **kwargs)
+
+        normalized_at = time.perf_counter()
+
+        # Save (converted back to BGR)
+        writer(output_path, normalized)
 
-        # Convert back to BGR for saving
-        normalized_bgr = cv2.cvtColor(normalized, cv2.COLOR_RGB2BGR)
+        if timings is not None:
+            timings['decode'] = decoded_at - start
+            timings['normalize'] = normalized_at - decoded_at
+            timings['encode_write'] = time.perf_counter() - normalized_at
 
-        # Save
-        output_path = Path(output_path)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(output_path), normalized_bgr)
+        if on_normalized is not None:
+            on_normalized(decoded[0], normalized)
 
         return True
 
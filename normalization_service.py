@@ -0,0 +1,713 @@
+"""
+Local Normalization Service
+asyncio HTTP service on localhost or a Unix socket that normalizes encoded
+images or raw RGB arrays for inference workers, grouping concurrent
+requests into micro-batches that run on a worker pool, with latency and
+queue-depth statistics
+
+    python -m src.normalization_service serve --socket /tmp/macenko.sock
+    curl --unix-socket /tmp/macenko.sock --data-binary @tile.png \\
+         -o normalized.png http://localhost/normalize
+    curl --unix-socket /tmp/macenko.sock http://localhost/stats
+
+Endpoints:
+    POST /normalize[?format=png|jpg|tif|raw]
+        Body: an encoded image (PNG, JPEG, TIFF, ...), or raw H x W x 3
+        uint8 RGB bytes with an `X-Image-Shape: H,W` header. The response
+        is the normalized image, encoded as `format` (default: png for
+        encoded requests, raw for raw requests; raw responses carry
+        X-Image-Shape).
+    GET /stats
+        Request counts, latency and queue-wait percentiles, batch sizes and
+        queue depth (JSON)
+    GET /health
+"""
+
+import numpy as np
+import cv2
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, PROCESSING, RANDOM_SEED
+from src.macenko_normalization import read_image_rgb
+from src.fused_kernel import set_threads as set_kernel_threads
+
+# Output encodings (format query parameter) and their content types
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'tif': 'image/tiff',
+    'raw': 'application/octet-stream',
+}
+
+# Header giving the H,W of raw RGB request bodies (and raw responses)
+SHAPE_HEADER = 'X-Image-Shape'
+
+# Largest accepted request body
+MAX_BODY_BYTES = 256 * 2**20
+
+# Recent requests / batches kept for the percentiles in /stats
+STATS_WINDOW = 10000
+
+# Longest wait (s) for client connections to finish closing on shutdown
+CLOSE_TIMEOUT = 5.0
+
+# State of a worker process: the normalizer (installed once per worker)
+_worker = {}
+
+
+def _init_worker(normalizer):
+    """Pool initializer: receive the normalizer once per worker process."""
+    _worker['normalizer'] = normalizer
+
+    # Keep OpenCV (and the fused kernel) single-threaded inside workers to avoid oversubscription
+    cv2.setNumThreads(1)
+    set_kernel_threads(1)
+
+
+def decode_request(body, shape=None):
+    """
+    RGB image of a request body.
+
+    Parameters:
+    -----------
+    body : bytes
+        Encoded image, or raw RGB bytes if `shape` is given
+    shape : tuple
+        (height, width) of a raw body
+
+    Returns:
+    --------
+    np.ndarray : RGB image (H x W x 3, uint8); raises ValueError if the
+                 body cannot be decoded
+    """
+    if shape is not None:
+        height, width = shape
+        if len(body) != height * width * 3:
+            raise ValueError(f"Raw body has {len(body)} bytes, expected {height}x{width}x3")
+        return np.frombuffer(body, dtype=np.uint8).reshape((height, width, 3))
+
+    img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def encode_response(img_rgb, fmt):
+    """Bytes of a normalized RGB image in the requested format ('raw' = H x W x 3 uint8)."""
+    if fmt == 'raw':
+        return np.ascontiguousarray(img_rgb).tobytes()
+    ok, encoded = cv2.imencode(f".{fmt}", cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise IOError(f"Could not encode the result as {fmt}")
+    return encoded.tobytes()
+
+
+def normalize_batch(requests):
+    """
+    Normalize one micro-batch in a worker.
+
+    Same-size images are normalized together with `transform_batch` (as
+    run_pipeline's batched path); if a stack fails, its images are retried
+    one by one, so a bad image only fails itself.
+
+    Parameters:
+    -----------
+    requests : list
+        (body, shape, fmt) per request (see `decode_request` / `encode_response`)
+
+    Returns:
+    --------
+    list : (ok, payload, shape) per request; payload is the encoded result
+           or, if not ok, the error message
+    """
+    normalizer = _worker['normalizer']
+    results = [None] * len(requests)
+
+    groups = {}
+    for i, (body, shape, _) in enumerate(requests):
+        try:
+            img = decode_request(body, shape)
+        except Exception as e:
+            results[i] = (False, str(e), None)
+            continue
+        groups.setdefault(img.shape, []).append((i, img))
+
+    for items in groups.values():
+        normalized = None
+        if len(items) > 1:
+            try:
+                normalized = normalizer.transform_batch(np.stack([img for _, img in items]))
+            except Exception:
+                pass
+        for k, (i, img) in enumerate(items):
+            try:
+                out = normalized[k] if normalized is not None else normalizer.transform(img)
+                results[i] = (True, encode_response(out, requests[i][2]), out.shape[:2])
+            except Exception as e:
+                results[i] = (False, str(e), None)
+
+    return results
+
+
+def _percentiles(values, scale=1.0):
+    """p50 / p90 / p99 / max of recent samples (None if there are none)."""
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64) * scale
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': float(values.max())}
+
+
+class ServiceStats:
+    """
+    Request, latency, batch and queue-depth statistics of the service.
+
+    Latency is measured from the moment a request is queued to the moment
+    its result is ready (queue wait + batch processing); percentiles are
+    over the last `window` requests or batches.
+    """
+
+    def __init__(self, window=STATS_WINDOW):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.queue_depths = deque(maxlen=window)
+
+    def queued(self, depth):
+        """Record the queue depth seen by an arriving request."""
+        self.queue_depths.append(depth)
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def snapshot(self, queue_depth=0, batches_in_flight=0):
+        """Statistics as a JSON-serialisable dict (milliseconds)."""
+        elapsed = time.time() - self.started
+        return {
+            'uptime_s': elapsed,
+            'requests': self.requests,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'requests_per_s': self.requests / max(elapsed, 1e-9),
+            'batches': self.batches,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+            'latency_ms': _percentiles(self.latencies, 1e3),
+            'queue_wait_ms': _percentiles(self.queue_waits, 1e3),
+            'queue_depth': {
+                'current': queue_depth,
+                'mean': float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+                'max': self.max_queue_depth,
+            },
+            'batches_in_flight': batches_in_flight,
+        }
+
+
+class NormalizationService:
+    """
+    asyncio normalization service with micro-batching.
+
+    Requests are put on a bounded queue. A batcher waits for a free worker,
+    takes the first queued request and collects more until `max_batch`
+    requests are gathered or `max_wait_ms` has passed, then hands the batch
+    to the worker pool. While all workers are busy requests accumulate in
+    the queue, so batches grow with load, and a lone request waits at most
+    `max_wait_ms`. Requests beyond `max_queue` are rejected (HTTP 503).
+
+    Parameters:
+    -----------
+    normalizer : MacenkoNormalizer
+        Normalizer installed in every worker (default: the pipeline normalizer)
+    workers : int
+        Worker processes (0 = one thread in the service process)
+    max_batch : int
+        Most requests per batch
+    max_wait_ms : float
+        Longest time a batch waits for more requests after its first
+    max_queue : int
+        Most queued requests
+    """
+
+    def __init__(self, normalizer=None, workers=PROCESSING['service_workers'],
+                 max_batch=PROCESSING['service_max_batch'],
+                 max_wait_ms=PROCESSING['service_max_wait_ms'],
+                 max_queue=PROCESSING['service_max_queue']):
+        if normalizer is None:
+            from src.run_pipeline import build_normalizer
+            normalizer = build_normalizer()
+        self.normalizer = normalizer
+        self.workers = workers
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1e3
+        self.max_queue = max_queue
+        self.stats = ServiceStats()
+        self.address = None
+        self._server = None
+        self._executor = None
+        self._queue = None
+        self._batcher = None
+        self._slots = None
+        self._in_flight = set()
+        self._writers = set()
+
+    async def start(self, host=None, port=None, socket_path=None):
+        """Start the worker pool and listen on host:port, or on a Unix socket if `socket_path` is given."""
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                 initargs=(self.normalizer,))
+        else:
+            _worker['normalizer'] = self.normalizer
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(max(1, self.workers))
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._server = await asyncio.start_unix_server(self._handle, path=socket_path)
+            self.address = str(socket_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host or PROCESSING['service_host'],
+                                                      PROCESSING['service_port'] if port is None else port)
+            host, port = self._server.sockets[0].getsockname()[:2]
+            self.address = f"http://{host}:{port}"
+        return self
+
+    async def close(self):
+        """
+        Stop listening, close client connections, finish the batches in
+        flight and shut the pool down.
+
+        Open keep-alive connections are closed first: from Python 3.12.1
+        `Server.wait_closed` waits for every connection, so idle clients
+        would otherwise block shutdown.
+        """
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        try:
+            await asyncio.wait_for(self._server.wait_closed(), CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Warning: client connections still open after {CLOSE_TIMEOUT:g} s")
+        self._batcher.cancel()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        # Every submitted batch has finished, so no pool futures are pending
+        self._executor.shutdown(wait=True)
+        if self.address and not self.address.startswith('http') and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    async def submit(self, body, shape=None, fmt='png'):
+        """
+        Queue one request and wait for its result.
+
+        Returns:
+        --------
+        tuple : (ok, payload, shape) as `normalize_batch`; raises asyncio.QueueFull
+                if the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.stats.queued(self._queue.qsize())
+        self._queue.put_nowait(((body, shape, fmt), future, time.perf_counter()))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        dispatched = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self._executor, normalize_batch,
+                                                 [request for request, _, _ in batch])
+        except Exception as e:
+            results = [(False, f"Worker failed: {e}", None)] * len(batch)
+        finally:
+            self._slots.release()
+
+        done = time.perf_counter()
+        self.stats.batches += 1
+        self.stats.batch_sizes.append(len(batch))
+        for (_, future, queued), result in zip(batch, results):
+            self.stats.requests += 1
+            self.stats.errors += not result[0]
+            self.stats.queue_waits.append(dispatched - queued)
+            self.stats.latencies.append(done - queued)
+            if not future.done():
+                future.set_result(result)
+
+    def snapshot(self):
+        """Current statistics (see `ServiceStats.snapshot`)."""
+        return self.stats.snapshot(self._queue.qsize() if self._queue else 0, len(self._in_flight))
+
+    async def _handle(self, reader, writer):
+        """Serve the HTTP/1.1 requests of one connection (keep-alive)."""
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload, response_headers = await self._route(method, target, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_response(writer, status, payload, response_headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError as e:
+            _write_response(writer, HTTPStatus.BAD_REQUEST, str(e).encode(), keep_alive=False)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _route(self, method, target, headers, body):
+        url = urlsplit(target)
+        if url.path == '/health' and method == 'GET':
+            return HTTPStatus.OK, b'ok\n', {'Content-Type': 'text/plain'}
+        if url.path == '/stats' and method == 'GET':
+            return (HTTPStatus.OK, json.dumps(self.snapshot(), indent=2).encode(),
+                    {'Content-Type': 'application/json'})
+        if url.path != '/normalize':
+            return HTTPStatus.NOT_FOUND, b'Unknown path\n', {}
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, b'Use POST\n', {}
+
+        shape = None
+        if SHAPE_HEADER.lower() in headers:
+            try:
+                shape = tuple(int(v) for v in headers[SHAPE_HEADER.lower()].split(',')[:2])
+            except ValueError:
+                return HTTPStatus.BAD_REQUEST, f"Invalid {SHAPE_HEADER}\n".encode(), {}
+        fmt = parse_qs(url.query).get('format', ['raw' if shape else 'png'])[0]
+        if fmt not in CONTENT_TYPES:
+            return HTTPStatus.BAD_REQUEST, f"format must be one of {list(CONTENT_TYPES)}\n".encode(), {}
+
+        try:
+            ok, payload, out_shape = await self.submit(body, shape, fmt)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, b'Queue full\n', {'Retry-After': '1'}
+        if not ok:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, f"{payload}\n".encode(), {}
+
+        response_headers = {'Content-Type': CONTENT_TYPES[fmt]}
+        if fmt == 'raw':
+            response_headers[SHAPE_HEADER] = f"{out_shape[0]},{out_shape[1]}"
+        return HTTPStatus.OK, payload, response_headers
+
+
+async def _read_request(reader):
+    """(method, target, headers, body) of the next request, or None at end of stream."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise ValueError("Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f"Request body larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+
+def _write_response(writer, status, payload, headers=None, keep_alive=True):
+    status = HTTPStatus(status)
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+             f"Content-Length: {len(payload)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + payload)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix domain socket."""
+
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class NormalizationClient:
+    """
+    Blocking client of a NormalizationService (one keep-alive connection).
+
+    >>> client = NormalizationClient(socket_path='/tmp/macenko.sock')
+    >>> normalized = client.normalize(img_rgb)           # raw array in, array out
+    >>> png_bytes = client.normalize(open('tile.png', 'rb').read())
+
+    Parameters:
+    -----------
+    address : str
+        'http://host:port' of a TCP service
+    socket_path : str
+        Unix socket of the service (instead of `address`)
+    """
+
+    def __init__(self, address=None, socket_path=None, timeout=60):
+        if socket_path is not None:
+            self._connection = _UnixHTTPConnection(socket_path, timeout)
+        else:
+            url = urlsplit(address or f"http://{PROCESSING['service_host']}:{PROCESSING['service_port']}")
+            self._connection = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+    def _request(self, method, path, body=None, headers=None):
+        self._connection.request(method, path, body=body, headers=headers or {})
+        response = self._connection.getresponse()
+        payload = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{response.status} {response.reason}: {payload.decode(errors='replace').strip()}")
+        return response, payload
+
+    def normalize(self, image, fmt=None):
+        """
+        Normalize an RGB array (sent raw) or encoded image bytes.
+
+        Returns:
+        --------
+        np.ndarray or bytes : The normalized array for raw results (the
+                              default for array input), else the encoded bytes
+        """
+        headers = {}
+        if isinstance(image, np.ndarray):
+            headers[SHAPE_HEADER] = f"{image.shape[0]},{image.shape[1]}"
+            body = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+        else:
+            body = bytes(image)
+        path = '/normalize' if fmt is None else f"/normalize?format={fmt}"
+        response, payload = self._request('POST', path, body, headers)
+
+        shape = response.getheader(SHAPE_HEADER)
+        if shape is None:
+            return payload
+        height, width = (int(v) for v in shape.split(','))
+        return np.frombuffer(payload, dtype=np.uint8).reshape((height, width, 3))
+
+    def stats(self):
+        """Service statistics (see `ServiceStats.snapshot`)."""
+        return json.loads(self._request('GET', '/stats')[1])
+
+    def close(self):
+        self._connection.close()
+
+
+def _service_options(parser):
+    parser.add_argument('--workers', type=int, default=PROCESSING['service_workers'],
+                        help="Worker processes, 0 = in-process thread (default: %(default)s)")
+    parser.add_argument('--max-batch', type=int, default=PROCESSING['service_max_batch'],
+                        help="Most requests per micro-batch (default: %(default)s)")
+    parser.add_argument('--max-wait-ms', type=float, default=PROCESSING['service_max_wait_ms'],
+                        help="Longest wait for a batch to fill (default: %(default)s)")
+    parser.add_argument('--max-queue', type=int, default=PROCESSING['service_max_queue'],
+                        help="Most queued requests before rejecting (default: %(default)s)")
+
+
+def _make_service(args):
+    return NormalizationService(workers=args.workers, max_batch=args.max_batch,
+                                max_wait_ms=args.max_wait_ms, max_queue=args.max_queue)
+
+
+def serve(args):
+    """Run the service until interrupted."""
+    async def run():
+        service = await _make_service(args).start(args.host, args.port, args.socket)
+        print("="*60)
+        print("NORMALIZATION SERVICE")
+        print("="*60)
+        print(f"Listening on: {service.address}")
+        print(f"Workers: {args.workers}, max batch: {args.max_batch}, max wait: {args.max_wait_ms:g} ms")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("\nService stopped")
+    return 0
+
+
+def _bench_images(args):
+    """Test tiles: sampled dataset images, or synthetic tiles."""
+    if args.dataset:
+        from src.dataset_catalog import DatasetCatalog
+        paths = DatasetCatalog(DATASETS[args.dataset]['input_dir']).sample(args.n_images)
+        images = [img for img in (read_image_rgb(path) for path in paths) if img is not None]
+        if images:
+            return images
+    from src.synthetic_data import synthetic_he_tile
+    rng = np.random.default_rng(RANDOM_SEED)
+    return [synthetic_he_tile(args.tile_size, seed=rng) for _ in range(args.n_images)]
+
+
+def bench(args):
+    """
+    Start a service on a temporary Unix socket, send concurrent requests and
+    check every result against `transform`.
+    """
+    images = _bench_images(args)
+    service = _make_service(args)
+    expected = [service.normalizer.transform(img) for img in images]
+    encoded = [cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))[1].tobytes() for img in images]
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    socket_path = os.path.join(tempfile.mkdtemp(), "normalization.sock")
+    asyncio.run_coroutine_threadsafe(service.start(socket_path=socket_path), loop).result()
+
+    print("="*60)
+    print("NORMALIZATION SERVICE BENCHMARK")
+    print("="*60)
+    print(f"Service: {socket_path}")
+    print(f"Tiles: {len(images)} x {images[0].shape[1]}x{images[0].shape[0]}, "
+          f"requests: {args.requests}, concurrency: {args.concurrency}")
+    print(f"Workers: {args.workers}, max batch: {args.max_batch}, max wait: {args.max_wait_ms:g} ms")
+
+    local = threading.local()
+    clients = []
+    mismatches = []
+
+    def send(k):
+        if not hasattr(local, 'client'):
+            local.client = NormalizationClient(socket_path=socket_path)
+            clients.append(local.client)
+        i = k % len(images)
+        if k % 2:
+            out = local.client.normalize(images[i])
+        else:
+            payload = local.client.normalize(encoded[i], fmt='png')
+            out = cv2.cvtColor(cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR),
+                               cv2.COLOR_BGR2RGB)
+        if not np.array_equal(out, expected[i]):
+            mismatches.append(k)
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as senders:
+            list(senders.map(send, range(args.requests)))
+        elapsed = time.perf_counter() - start
+        stats = service.snapshot()
+    finally:
+        for client in clients:
+            client.close()
+        asyncio.run_coroutine_threadsafe(service.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    latency = stats['latency_ms']
+    print(f"\nThroughput: {args.requests / elapsed:.1f} requests/s ({elapsed:.2f} s)")
+    print(f"Batches: {stats['batches']} (mean size {stats['mean_batch_size']:.2f})")
+    print(f"Latency ms: p50 {latency['p50']:.1f}, p90 {latency['p90']:.1f}, "
+          f"p99 {latency['p99']:.1f}, max {latency['max']:.1f}")
+    print(f"Queue wait ms: p50 {stats['queue_wait_ms']['p50']:.1f}, p99 {stats['queue_wait_ms']['p99']:.1f}")
+    print(f"Queue depth: mean {stats['queue_depth']['mean']:.1f}, max {stats['queue_depth']['max']}")
+    print(f"Errors: {stats['errors']}, mismatches vs transform: {len(mismatches)}")
+
+    log_dir = Path("results/logs")
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / "pipeline.log", 'a') as f:
+        f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Normalization Service Benchmark\n")
+        f.write(f"  {args.requests} requests, concurrency {args.concurrency}, workers {args.workers}, "
+                f"max batch {args.max_batch}, max wait {args.max_wait_ms:g} ms\n")
+        f.write(f"  {args.requests / elapsed:.1f} requests/s, mean batch {stats['mean_batch_size']:.2f}, "
+                f"latency p50 {latency['p50']:.1f} ms / p99 {latency['p99']:.1f} ms, "
+                f"mismatches {len(mismatches)}\n")
+
+    failed = bool(mismatches) or stats['errors'] > 0
+    print("FAILED" if failed else "PASSED")
+    return 1 if failed else 0
+
+
+def main():
+    """Run the normalization service, or benchmark and check it locally."""
+    parser = argparse.ArgumentParser(description="Local Macenko normalization service")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="Run the service")
+    serve_parser.add_argument('--host', default=PROCESSING['service_host'],
+                              help="Listen address (default: %(default)s)")
+    serve_parser.add_argument('--port', type=int, default=PROCESSING['service_port'],
+                              help="Listen port (default: %(default)s)")
+    serve_parser.add_argument('--socket', default=None,
+                              help="Listen on this Unix socket instead of host:port")
+    _service_options(serve_parser)
+
+    bench_parser = commands.add_parser('bench', help="Benchmark and check a temporary local service")
+    bench_parser.add_argument('--requests', type=int, default=200,
+                              help="Requests to send (default: %(default)s)")
+    bench_parser.add_argument('--concurrency', type=int, default=16,
+                              help="Concurrent client connections (default: %(default)s)")
+    bench_parser.add_argument('--dataset', choices=list(DATASETS), default=None,
+                              help="Sample tiles from this dataset (default: synthetic tiles)")
+    bench_parser.add_argument('--n-images', type=int, default=16,
+                              help="Distinct tiles (default: %(default)s)")
+    bench_parser.add_argument('--tile-size', type=int, default=256,
+                              help="Synthetic tile size (default: %(default)s)")
+    _service_options(bench_parser)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        return serve(args)
+    return bench(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+On-the-Fly Normalized Dataset
+Iterates over a dataset directory and yields Macenko-normalized tiles
+without writing them to disk, with prefetching threads and an LRU cache
+"""
+
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import threading
+import time
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, PROCESSING, RANDOM_SEED
+from src.macenko_normalization import decode_image_file, normalize_decoded
+from src.run_pipeline import build_normalizer, get_all_images
+from src.dataset_catalog import image_groups
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by total array size.
+
+    Stored arrays are made read-only, so a consumer cannot change a cached
+    tile in place (copy it first to modify it).
+
+    Parameters:
+    -----------
+    max_bytes : int
+        Maximum total `nbytes` of the cached arrays (0 = no caching)
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Cached array for `key` (marked most recently used), or None."""
+        with self._lock:
+            arr = self._items.get(key)
+            if arr is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return arr
+
+    def put(self, key, arr):
+        """Cache `arr`, evicting the least recently used arrays to stay within max_bytes."""
+        if arr.nbytes > self.max_bytes:
+            return
+        arr.setflags(write=False)
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = arr
+            self.nbytes += arr.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class NormalizedDataset:
+    """
+    Iterable of `(normalized_rgb, label, path)` over one dataset directory.
+
+    Tiles are decoded and normalized on demand by `threads` prefetching
+    threads, at most `prefetch` tiles ahead of the consumer; OpenCV decoding
+    and the NumPy core release the GIL, so this overlaps with the training
+    step. Normalized tiles are kept in an LRU cache of `cache_mb` MB, so
+    later epochs over a dataset that fits are served from memory. The
+    label is the class folder of the image (see `dataset_catalog.image_groups`).
+
+    >>> dataset = NormalizedDataset('CRC5000', shuffle=True)
+    >>> for images, labels, paths in dataset.batches(32):
+    ...     train_step(images, labels)
+
+    Parameters:
+    -----------
+    dataset : str
+        Dataset name in DATASETS (its input_dir is read)
+    normalizer : MacenkoNormalizer
+        Normalizer to apply (default: the pipeline normalizer from MACENKO_PARAMS)
+    input_dir : str or Path
+        Directory to read instead of the dataset's input_dir
+    threads : int
+        Prefetching threads (0 = decode and normalize in the consuming thread)
+    prefetch : int
+        Maximum tiles in flight ahead of the consumer
+    cache_mb : float
+        LRU cache size for normalized tiles in MB (0 = off)
+    shuffle : bool
+        Visit the images in a new random order every epoch
+    seed : int
+        Seed of the shuffling order
+    """
+
+    def __init__(self, dataset='LC25000', normalizer=None, input_dir=None,
+                 threads=PROCESSING['loader_threads'], prefetch=PROCESSING['loader_prefetch'],
+                 cache_mb=PROCESSING['loader_cache_mb'], shuffle=False, seed=RANDOM_SEED):
+        self.input_dir = Path(input_dir if input_dir is not None else DATASETS[dataset]['input_dir'])
+        self.normalizer = normalizer if normalizer is not None else build_normalizer()
+        self.threads = threads
+        self.prefetch = max(1, prefetch)
+        self.cache = LRUCache(int(cache_mb * 2**20))
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        self.paths = get_all_images(self.input_dir)
+        self.labels = [self.label(path) for path in self.paths]
+        self.classes = sorted(set(self.labels))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def label(self, path):
+        """Class folder of an image under input_dir."""
+        return image_groups(Path(path).relative_to(self.input_dir))[0]
+
+    def load(self, path):
+        """
+        Normalized RGB tile of one image (read-only), from the cache if present.
+
+        Raises IOError if the image cannot be decoded.
+        """
+        key = str(path)
+        normalized = self.cache.get(key)
+        if normalized is not None:
+            return normalized
+
+        decoded = decode_image_file(path, self.normalizer)
+        if decoded is None:
+            raise IOError(f"Could not read {path}")
+        normalized = normalize_decoded(*decoded, normalizer=self.normalizer)
+        self.cache.put(key, normalized)
+        return normalized
+
+    def _epoch_order(self):
+        if self.shuffle:
+            return self.rng.permutation(len(self.paths))
+        return range(len(self.paths))
+
+    def __iter__(self):
+        """
+        One epoch of `(normalized_rgb, label, path)`.
+
+        Images that cannot be read or normalized are reported and skipped.
+        """
+        order = self._epoch_order()
+        if self.threads <= 0:
+            for i in order:
+                try:
+                    normalized = self.load(self.paths[i])
+                except Exception as e:
+                    print(f"Error processing {self.paths[i]}: {str(e)}")
+                    continue
+                yield normalized, self.labels[i], self.paths[i]
+            return
+
+        pool = ThreadPoolExecutor(max_workers=self.threads)
+        pending = deque()
+        order = iter(order)
+        try:
+            def fill():
+                while len(pending) < self.prefetch:
+                    i = next(order, None)
+                    if i is None:
+                        return
+                    pending.append((i, pool.submit(self.load, self.paths[i])))
+
+            fill()
+            while pending:
+                i, future = pending.popleft()
+                fill()
+                try:
+                    normalized = future.result()
+                except Exception as e:
+                    print(f"Error processing {self.paths[i]}: {str(e)}")
+                    continue
+                yield normalized, self.labels[i], self.paths[i]
+        finally:
+            # Also reached when the consumer stops early: drop queued work
+            # (cancelled here; shutdown's cancel_futures needs Python 3.9)
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def batches(self, batch_size, drop_last=False):
+        """
+        One epoch of `(images, labels, paths)` batches of same-size tiles.
+
+        Tiles are grouped by shape, so a batch stacks into one
+        N x H x W x 3 uint8 array; mixed-size datasets give one stream of
+        batches per size.
+
+        Parameters:
+        -----------
+        batch_size : int
+            Tiles per batch
+        drop_last : bool
+            Drop incomplete batches at the end of the epoch
+
+        Returns:
+        --------
+        generator : (np.ndarray, list, list) per batch
+        """
+        buffers = {}
+        for normalized, label, path in self:
+            buffer = buffers.setdefault(normalized.shape, [])
+            buffer.append((normalized, label, path))
+            if len(buffer) == batch_size:
+                yield _stack(buffer)
+                buffer.clear()
+
+        if not drop_last:
+            for buffer in buffers.values():
+                if buffer:
+                    yield _stack(buffer)
+
+
+def _stack(buffer):
+    images, labels, paths = zip(*buffer)
+    return np.stack(images), list(labels), list(paths)
+
+
+def main():
+    """Iterate a dataset for a few epochs and report throughput and cache use."""
+    parser = argparse.ArgumentParser(description="On-the-fly normalized dataset iterator")
+    parser.add_argument('dataset', choices=list(DATASETS), help="Dataset to iterate")
+    parser.add_argument('--epochs', type=int, default=2,
+                        help="Epochs to iterate (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help="Tiles per batch (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=PROCESSING['loader_threads'],
+                        help="Prefetching threads (default: %(default)s)")
+    parser.add_argument('--prefetch', type=int, default=PROCESSING['loader_prefetch'],
+                        help="Tiles in flight (default: %(default)s)")
+    parser.add_argument('--cache-mb', type=float, default=PROCESSING['loader_cache_mb'],
+                        help="LRU cache size in MB (default: %(default)s)")
+    parser.add_argument('--shuffle', action='store_true', help="Shuffle every epoch")
+    args = parser.parse_args()
+
+    dataset = NormalizedDataset(args.dataset, threads=args.threads, prefetch=args.prefetch,
+                                cache_mb=args.cache_mb, shuffle=args.shuffle)
+
+    print("="*60)
+    print(f"NORMALIZED DATASET - {args.dataset}")
+    print("="*60)
+    print(f"Images: {len(dataset)} in {len(dataset.classes)} classes ({', '.join(dataset.classes)})")
+    print(f"Threads: {args.threads}, prefetch: {args.prefetch}, cache: {args.cache_mb:g} MB")
+
+    for epoch in range(1, args.epochs + 1):
+        start = time.time()
+        n = 0
+        for images, labels, paths in dataset.batches(args.batch_size):
+            n += len(images)
+        elapsed = time.time() - start
+        print(f"  Epoch {epoch}: {n} tiles in {elapsed:.2f} s ({n / max(elapsed, 1e-9):.1f} tiles/s), "
+              f"cache {len(dataset.cache)} tiles / {dataset.cache.nbytes / 2**20:.1f} MB, "
+              f"hit rate {100 * dataset.cache.hit_rate:.1f}%")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
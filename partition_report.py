@@ -0,0 +1,183 @@
+"""
+Sharded Run Equivalence Check
+Checks that a run split over N shards (see partitioning.py) and merged with
+`python -m src.partitioning` gives the same metrics tables as one
+unsharded run
+
+A sample of the dataset images is copied into two scratch working
+directories. One runs run_pipeline --metrics and calculate_metrics once;
+the other runs every shard as a separate process, as N machines would, and
+merges them. metrics_detailed.csv, metrics.csv and metrics_by_group.csv of
+both stages must be identical. When the datasets are not present, seeded
+synthetic and edge-case tiles in class / split folders are used instead.
+"""
+
+import numpy as np
+from pathlib import Path
+import pandas as pd
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, RANDOM_SEED
+from src.macenko_normalization import write_image_rgb
+from src.run_pipeline import get_all_images
+from src.synthetic_data import edge_case_tiles, synthetic_he_tile
+
+# Merged tables that must equal the unsharded ones
+TABLES = ('metrics_detailed.csv', 'metrics.csv', 'metrics_by_group.csv')
+
+# Synthetic tiles per dataset when its images are missing: edge length -> number of tiles
+SYNTHETIC_TILES = {150: 12, 224: 6}
+
+
+def copy_inputs(directory, n_images):
+    """
+    Copy a seeded sample of every dataset (or synthetic tiles) into `directory`.
+
+    The files keep their paths relative to the dataset root, so the shard
+    assignment and the class / split groups are those of the full run.
+
+    Returns:
+    --------
+    dict : Dataset name -> (number of images, 'sample' or 'synthetic')
+    """
+    sources = {}
+    for dataset_name, config in DATASETS.items():
+        root = Path(directory) / config['input_dir']
+        images = get_all_images(config['input_dir'])
+        if images:
+            random.seed(RANDOM_SEED)
+            images = random.sample(images, min(n_images, len(images)))
+            for img_path in images:
+                target = root / Path(img_path).relative_to(config['input_dir'])
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(img_path, target)
+            sources[dataset_name] = (len(images), 'sample')
+            continue
+
+        rng = np.random.default_rng(RANDOM_SEED)
+        tiles = [synthetic_he_tile(size, seed=rng) for size, n in SYNTHETIC_TILES.items()
+                 for _ in range(n)]
+        tiles += list(edge_case_tiles(size=150).values())
+        for i, tile in enumerate(tiles):
+            # Nested split / class folders so metrics_by_group.csv has both levels
+            write_image_rgb(root / f"split_{i % 2}" / f"class_{i % 3}" / f"tile_{i:03d}.png", tile)
+        sources[dataset_name] = (len(tiles), 'synthetic')
+    return sources
+
+
+def run_module(module, args, cwd):
+    """Run `python -m src.<module> <args>` in `cwd`; raises RuntimeError on failure."""
+    env = dict(os.environ)
+    root = str(Path(__file__).parent.parent)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-m', f"src.{module}", *args], cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        tail = "\n".join(result.stdout.splitlines()[-20:])
+        raise RuntimeError(f"src.{module} {' '.join(args)} exited with {result.returncode}:\n{tail}")
+
+
+def compare_tables(single_dir, merged_dir, stage):
+    """One row per table: whether the merged file equals the unsharded one."""
+    rows = []
+    for name in TABLES:
+        single_path, merged_path = Path(single_dir) / name, Path(merged_dir) / name
+        row = {'stage': stage, 'table': name, 'rows': np.nan, 'identical': False,
+               'max_abs_diff': np.nan, 'failure': None}
+        if not merged_path.exists():
+            row['failure'] = "merged table missing"
+            rows.append(row)
+            continue
+        single, merged = pd.read_csv(single_path), pd.read_csv(merged_path)
+        row['rows'] = len(single)
+        row['identical'] = single_path.read_bytes() == merged_path.read_bytes()
+        if not row['identical']:
+            if list(single.columns) != list(merged.columns) or len(single) != len(merged):
+                row['failure'] = (f"{len(merged)} rows / columns {list(merged.columns)} "
+                                  f"instead of {len(single)} / {list(single.columns)}")
+            else:
+                numeric = single.select_dtypes('number').columns
+                row['max_abs_diff'] = float((single[numeric] - merged[numeric]).abs().max().max())
+                row['failure'] = f"tables differ (max abs diff {row['max_abs_diff']:.2e})"
+        rows.append(row)
+    return rows
+
+
+def main():
+    """Run the sharded and unsharded runs, compare the merged tables and exit non-zero on a mismatch."""
+    parser = argparse.ArgumentParser(description="Sharded run equivalence check")
+    parser.add_argument('--num-shards', type=int, default=3,
+                        help="Number of shards of the sharded run (default: %(default)s)")
+    parser.add_argument('--n-images', type=int, default=40,
+                        help="Images sampled per dataset (default: %(default)s)")
+    args = parser.parse_args()
+    if args.num_shards < 2:
+        parser.error("--num-shards must be at least 2")
+
+    print("="*60)
+    print(f"SHARDED RUN EQUIVALENCE CHECK ({args.num_shards} shards)")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        single_dir, sharded_dir = Path(directory) / "single", Path(directory) / "sharded"
+        sources = copy_inputs(single_dir, args.n_images)
+        shutil.copytree(single_dir, sharded_dir)
+        for dataset_name, (n, source) in sources.items():
+            print(f"  {dataset_name}: {n} images ({source})")
+
+        shards = [['--shard-index', str(i), '--num-shards', str(args.num_shards)]
+                  for i in range(args.num_shards)]
+        tables = Path("results/tables")
+        # (stage, script run in both directories, merge arguments)
+        stages = [
+            ('run_pipeline --metrics', 'run_pipeline', ['--metrics'], []),
+            ('calculate_metrics', 'calculate_metrics', [], ['--skip-pipeline']),
+        ]
+        try:
+            for stage, module, module_args, merge_args in stages:
+                print(f"\n{stage}: unsharded run")
+                run_module(module, module_args, single_dir)
+                print(f"{stage}: {args.num_shards} shards + merge")
+                for shard in shards:
+                    run_module(module, module_args + shard, sharded_dir)
+                run_module('partitioning', ['--num-shards', str(args.num_shards)] + merge_args,
+                           sharded_dir)
+                rows += compare_tables(single_dir / tables, sharded_dir / tables, stage)
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            return 1
+
+    df = pd.DataFrame(rows)
+    print("\n" + "="*60)
+    print("MERGED VS UNSHARDED TABLES")
+    print("="*60)
+    print(df[['stage', 'table', 'rows', 'identical']].to_string(index=False))
+
+    failures = df[df['failure'].notna()]
+    print()
+    if len(failures):
+        for _, row in failures.iterrows():
+            print(f"  FAILED {row['stage']}: {row['table']}: {row['failure']}")
+    else:
+        print("  All checks passed (merged tables identical to the unsharded run)")
+
+    output_dir = Path("results/tables")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    df.to_csv(output_dir / "partition_check.csv", index=False)
+    print(f"\nCheck table saved to: {output_dir / 'partition_check.csv'}")
+
+    return 1 if len(failures) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
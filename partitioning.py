@@ -0,0 +1,201 @@
+"""
+Deterministic Dataset Partitioning Across Machines
+Stable hash partitioning of the image list for coordinator-free runs of
+run_pipeline / calculate_metrics on N nodes, and merging of the per-shard
+stats, logs and metrics tables into the single-run formats
+
+Each image goes to the shard given by a hash of its path relative to the
+dataset root, so every node computes the same split independently (also
+when the datasets are mounted at different locations), and an image keeps
+its shard when others are added. To test locally, run the shards as
+separate processes on one machine and merge:
+
+    for i in 0 1 2 3; do
+        python -m src.run_pipeline --shard-index $i --num-shards 4 --metrics &
+    done; wait
+    python -m src.partitioning --num-shards 4
+"""
+
+from pathlib import Path
+import argparse
+import csv
+import hashlib
+import json
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS
+
+
+def shard_of(relative_path, num_shards):
+    """Shard (0 .. num_shards - 1) of an image from its path relative to the dataset root."""
+    digest = hashlib.blake2b(Path(relative_path).as_posix().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % num_shards
+
+
+def select_shard(paths, root, shard_index, num_shards):
+    """The paths (under `root`, order kept) that belong to shard `shard_index`."""
+    if num_shards <= 1:
+        return list(paths)
+    return [path for path in paths
+            if shard_of(Path(path).relative_to(root), num_shards) == shard_index]
+
+
+def shard_suffix(shard_index, num_shards):
+    """File name tag of a shard's outputs ('' for unsharded runs)."""
+    if num_shards <= 1:
+        return ""
+    return f".shard{shard_index:03d}-of-{num_shards:03d}"
+
+
+def shard_path(path, shard_index, num_shards):
+    """`path` with the shard tag inserted before its suffix (e.g. store.shard001-of-004.npz)."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}{shard_suffix(shard_index, num_shards)}{path.suffix}")
+
+
+def add_shard_arguments(parser):
+    """Add --shard-index / --num-shards to a script's argument parser."""
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help="Shard processed by this run, 0 .. num-shards - 1 (default: %(default)s)")
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help="Number of independent runs the datasets are split over "
+                             "(default: %(default)s = no sharding)")
+
+
+def check_shard_arguments(parser, args):
+    """Reject inconsistent --shard-index / --num-shards values."""
+    if args.num_shards < 1:
+        parser.error("--num-shards must be at least 1")
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f"--shard-index must be in 0 .. {args.num_shards - 1}")
+
+
+def _shard_files(directory, stem, suffix, num_shards):
+    """Per-shard files of a run; raises FileNotFoundError naming the missing shards."""
+    files = [Path(directory) / f"{stem}{shard_suffix(i, num_shards)}{suffix}" for i in range(num_shards)]
+    missing = [str(path) for path in files if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Missing shard outputs: {', '.join(missing)}")
+    return files
+
+
+def merge_metrics(tables_dir, num_shards, datasets=tuple(DATASETS)):
+    """
+    Merge per-shard metrics_detailed files into metrics_detailed.csv, metrics.csv
+    and metrics_by_group.csv.
+
+    Rows are put back in the order of an unsharded run (datasets in
+    `datasets` order, then by relative path) and replayed through a
+    MetricsWriter, so the merged files equal those of a single run. The
+    writer's title is the one the shards recorded in metrics_source
+    (calculate_metrics or run_pipeline --metrics).
+
+    Returns:
+    --------
+    tuple : (MetricsWriter, pd.DataFrame) writer with the output paths, per-dataset summary
+    """
+    from src.calculate_metrics import METRICS, METRICS_TITLE, MetricsWriter
+
+    titles = set()
+    for i in range(num_shards):
+        path = Path(tables_dir) / f"metrics_source{shard_suffix(i, num_shards)}.json"
+        if path.exists():
+            with open(path) as f:
+                titles.add(json.load(f)['title'])
+    if len(titles) > 1:
+        print(f"Warning: shard metrics come from different runs ({', '.join(sorted(titles))})")
+    title = titles.pop() if len(titles) == 1 else METRICS_TITLE
+
+    rows = []
+    for path in _shard_files(tables_dir, "metrics_detailed", ".csv", num_shards):
+        with open(path, newline='') as f:
+            rows.extend(csv.DictReader(f))
+
+    order = {name: i for i, name in enumerate(datasets)}
+    rows.sort(key=lambda row: (order.get(row['dataset'], len(order)), row['dataset'], Path(row['path'])))
+
+    writer = MetricsWriter(tables_dir, title=title)
+    for row in rows:
+        writer.add(row['dataset'], row['image'], {name: float(row[name]) for name in METRICS},
+                   relative_path=row['path'])
+    summary_df = writer.close(tuple(dict.fromkeys(list(datasets) + [row['dataset'] for row in rows])))
+    return writer, summary_df
+
+
+def merge_pipeline_stats(logs_dir, num_shards):
+    """
+    Combine the per-shard pipeline_stats files (written by run_pipeline).
+
+    Returns:
+    --------
+    tuple : (all_stats, lines) per-dataset totals (and tissue pre-check
+            route counts) summed over the shards and the run configuration
+            lines of the log entry
+    """
+    all_stats = {}
+    lines = None
+    for path in _shard_files(logs_dir, "pipeline_stats", ".json", num_shards):
+        with open(path) as f:
+            shard = json.load(f)
+        if lines is None:
+            lines = shard['lines']
+        elif shard['lines'] != lines:
+            print(f"Warning: {path} was run with a different configuration")
+        for dataset_name, stats in shard['stats'].items():
+            merged = all_stats.setdefault(dataset_name, {'total': 0, 'success': 0, 'failed': 0})
+            for key in ('total', 'success', 'failed'):
+                merged[key] += stats[key]
+            for route, n in stats.get('routes', {}).items():
+                routes = merged.setdefault('routes', {})
+                routes[route] = routes.get(route, 0) + n
+    return all_stats, lines
+
+
+def main():
+    """Merge the outputs of a sharded run into the single-run files."""
+    from src.run_pipeline import write_pipeline_log
+    from src.calculate_metrics import log_summary
+
+    parser = argparse.ArgumentParser(description="Merge the outputs of --shard-index/--num-shards runs")
+    parser.add_argument('--num-shards', type=int, required=True, help="Number of shards of the run")
+    parser.add_argument('--tables-dir', default="results/tables",
+                        help="Directory of the metrics tables (default: %(default)s)")
+    parser.add_argument('--logs-dir', default="results/logs",
+                        help="Directory of pipeline.log and the shard stats (default: %(default)s)")
+    parser.add_argument('--skip-pipeline', action='store_true',
+                        help="Do not merge run_pipeline stats (metrics only)")
+    parser.add_argument('--skip-metrics', action='store_true',
+                        help="Do not merge metrics tables (pipeline stats only)")
+    args = parser.parse_args()
+
+    print("="*60)
+    print(f"MERGE SHARDED RUN ({args.num_shards} shards)")
+    print("="*60)
+
+    log_path = Path(args.logs_dir) / "pipeline.log"
+    try:
+        if not args.skip_pipeline:
+            all_stats, lines = merge_pipeline_stats(args.logs_dir, args.num_shards)
+            write_pipeline_log(log_path, all_stats, lines + [f"Merged from {args.num_shards} shards"])
+            for dataset_name, stats in all_stats.items():
+                print(f"  {dataset_name}: {stats['success']}/{stats['total']} images normalized")
+
+        if not args.skip_metrics:
+            writer, summary_df = merge_metrics(args.tables_dir, args.num_shards)
+            log_summary(summary_df, log_path, writer.title,
+                        method=f"RGB 3-channel metrics (PSNR, SSIM, RMSE), "
+                               f"merged from {args.num_shards} shards")
+            print(f"\nDetailed metrics saved to: {writer.detailed_path}")
+            print(f"Summary metrics saved to: {writer.summary_path}")
+            print(f"Per class/split metrics saved to: {writer.groups_path}")
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return 1
+
+    print(f"\nLog updated: {log_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,7 @@ DATASETS = {
     'LC25000': {
         'input_dir': 'data/processed/LC25000/LC25000',
         'output_dir': 'data/processed/LC25000/macenko_norm',
+        'shard_dir': 'data/processed/LC25000/macenko_norm_shards',
         'format': 'jpeg',
         'resolution': (768, 768),
         'use_patches': False,  # Images already appropriately sized
@@ -18,6 +19,7 @@ DATASETS = {
     'CRC5000': {
         'input_dir': 'data/processed/CRC5000/Kather_texture_2016_image_tiles_5000',
         'output_dir': 'data/processed/CRC5000/macenko_norm',
+        'shard_dir': 'data/processed/CRC5000/macenko_norm_shards',
         'format': 'tif',
         'resolution': (150, 150),
         'use_patches': False,  # Images are small tiles already
@@ -34,7 +36,18 @@ MACENKO_PARAMS = {
         [0.7201, 0.8012],  # Eosin
         [0.4062, 0.5581]   # Residual
     ],
-    'maxCRef': [1.9705, 1.0308]  # Reference maximum concentrations
+    'maxCRef': [1.9705, 1.0308],  # Reference maximum concentrations
+    'reference_image': None,      # Optional target tile to fit HERef/maxCRef on
+    'sample_pixels': None,        # Pixels subsampled for stain estimation (None = all)
+    'estimation_scale': 1,        # Downscale factor for stain estimation (1, 2, 4 or 8)
+    'dtype': 'float64',           # Compute precision ('float64' or 'float32')
+    'chunk_pixels': None,         # Pixels per block in the streamed solve (None = whole image)
+    'fast_path': False,           # Lookup-table / pseudo-inverse / selection fast path
+    'unique_colors': False,       # Per-pixel math once per distinct color (same output)
+    'fused_kernel': None,         # Single-pass reconstruction: 'auto', 'numba', 'numpy' (None = off)
+    'min_tissue_fraction': None,  # Thumbnail tissue pre-check threshold (None = off)
+    'precheck_scale': 8,          # Downscale factor of the pre-check thumbnail
+    'low_tissue': 'passthrough',  # Tiles below the threshold: 'passthrough' or 'reference'
 }
 
 # Processing parameters
@@ -43,6 +56,34 @@ PROCESSING = {
     'preserve_structure': True,     # Maintain original folder structure
     'skip_existing': False,         # Re-process existing files
     'log_every': 100,              # Log progress every N images
+    'workers': 1,                  # Worker processes (1 = serial)
+    'chunk_size': 16,              # Images per worker task
+    'batch_size': 1,               # Same-size tiles per batched normalization (1 = off)
+    'patch_size': 1024,            # Tile size for datasets with use_patches=True
+    'lut_grid': None,              # Apply slide estimates via a 3D LUT (256 = exact, 33/65 = trilinear, None = off)
+    'io_threads': 0,               # Threaded decode/encode per process (0 = sequential I/O)
+    'io_depth': 8,                 # Images in flight per I/O stage (bounds memory)
+    'manifest': None,              # Run manifest path for incremental/resumable runs (None = off)
+    'stain_store': None,           # Per-image stain parameter store (.npz, None = off)
+    'telemetry': None,             # Telemetry JSON path (.prom written alongside, None = off)
+    'telemetry_interval': 30,      # Seconds between telemetry file updates
+    'fused_metrics': False,        # Compute PSNR/SSIM/RMSE during normalization
+    'fast_metrics': False,         # Batched float32 SSIM/PSNR/RMSE instead of skimage
+    'loader_threads': 2,           # Prefetching threads of the on-the-fly normalized dataset
+    'loader_prefetch': 16,         # Tiles normalized ahead of the consumer
+    'loader_cache_mb': 512,        # LRU cache of normalized tiles (MB, 0 = off)
+    'output_format': 'files',      # 'files' (one image per input) or 'shards' (packed .npy)
+    'shard_size': 1024,            # Tiles per shard file
+    'catalog_dir': 'results/cache/catalog',  # Persisted dataset listings (None = rescan every run)
+    'thumbnail_dir': 'results/cache/thumbnails',  # Cached QA contact-sheet thumbnails (None = no cache)
+    'qa_thumb_size': 128,          # Contact-sheet thumbnail edge (pixels)
+    'qa_columns': 8,               # Original|normalized pairs per contact-sheet row
+    'service_host': '127.0.0.1',   # Normalization service listen address (localhost only)
+    'service_port': 8765,          # Normalization service port
+    'service_workers': 1,          # Service worker processes (0 = in-process thread)
+    'service_max_batch': 16,       # Most requests per service micro-batch
+    'service_max_wait_ms': 5,      # Longest wait for a micro-batch to fill
+    'service_max_queue': 256,      # Queued requests before the service rejects (HTTP 503)
 }
 
 # Pipeline steps (in order)
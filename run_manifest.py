@@ -0,0 +1,206 @@
+"""
+Run Manifest for Incremental and Resumable Processing
+Content-addressed record of every processed input (SQLite)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """BLAKE2b (128-bit) hex digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def params_digest(params):
+    """Stable digest of a JSON-serialisable parameter dict."""
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def fingerprint(input_path, output_path):
+    """Size/mtime/hash of an input and of its output."""
+    st = os.stat(input_path)
+    out = os.stat(output_path)
+    return {
+        'input_size': st.st_size,
+        'input_mtime_ns': st.st_mtime_ns,
+        'input_hash': file_digest(input_path),
+        'output_size': out.st_size,
+        'output_mtime_ns': out.st_mtime_ns,
+        'output_hash': file_digest(output_path),
+    }
+
+
+class RunManifest:
+    """
+    Record of inputs, parameters and outputs of previous runs.
+
+    For every input the manifest stores its size, mtime and content hash,
+    the hash of the parameters it was processed with, and the size, mtime
+    and hash of the output. `needs_processing` uses it to select only inputs that are
+    new, changed, failed, produced with different parameters, or whose
+    output has gone missing or changed.
+
+    Size and mtime are checked first, so unchanged inputs and outputs are
+    never re-read; the content hash is only computed when they differ (e.g.
+    after a copy), so a resume only stats the files. With `verify=True`
+    every output is re-hashed as well, which also catches an output
+    rewritten with the same size and mtime.
+
+    Runs with fused metrics also store every input's PSNR/SSIM/RMSE, so a
+    resumed run can rebuild the metrics tables without re-measuring the
+    inputs it skips.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            input_path TEXT PRIMARY KEY,
+            input_size INTEGER,
+            input_mtime_ns INTEGER,
+            input_hash TEXT,
+            params_hash TEXT,
+            output_path TEXT,
+            output_size INTEGER,
+            output_mtime_ns INTEGER,
+            output_hash TEXT,
+            status TEXT,
+            updated TEXT,
+            metrics TEXT
+        )
+    """
+
+    COLUMNS = ('input_path', 'input_size', 'input_mtime_ns', 'input_hash', 'params_hash',
+               'output_path', 'output_size', 'output_mtime_ns', 'output_hash', 'status',
+               'updated', 'metrics')
+
+    # Columns added after the first schema (added to older manifests on open)
+    ADDED_COLUMNS = {'metrics': 'TEXT', 'output_mtime_ns': 'INTEGER'}
+
+    def __init__(self, path, verify=False):
+        self.path = Path(path)
+        self.verify = verify
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(self.SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(entries)")]
+        for name, kind in self.ADDED_COLUMNS.items():
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE entries ADD COLUMN {name} {kind}")
+        self.conn.commit()
+
+        # Entries are loaded once; lookups during planning are dict hits
+        cursor = self.conn.execute("SELECT * FROM entries")
+        columns = [c[0] for c in cursor.description]
+        self.entries = {row[0]: dict(zip(columns, row)) for row in cursor}
+
+    def needs_processing(self, input_path, output_path, params_hash, need_metrics=False):
+        """
+        Decide whether an input has to be (re)processed.
+
+        With `need_metrics`, an input without stored metrics is reprocessed
+        as well (reason 'metrics').
+
+        Returns:
+        --------
+        str or None : Reason ('new', 'failed', 'params', 'input', 'output',
+                      'metrics'), or None if the recorded output is still valid
+        """
+        entry = self.entries.get(str(input_path))
+        if entry is None:
+            return 'new'
+        if entry['status'] != 'done':
+            return 'failed'
+        if entry['params_hash'] != params_hash or entry['output_path'] != str(output_path):
+            return 'params'
+
+        st = os.stat(input_path)
+        if (st.st_size, st.st_mtime_ns) != (entry['input_size'], entry['input_mtime_ns']):
+            if st.st_size != entry['input_size'] or file_digest(input_path) != entry['input_hash']:
+                return 'input'
+            # Same content, new mtime (e.g. copied): refresh the stat fields
+            self._update_stat(str(input_path), st)
+
+        try:
+            out = os.stat(output_path)
+        except FileNotFoundError:
+            return 'output'
+        if out.st_size != entry['output_size']:
+            return 'output'
+        if self.verify or out.st_mtime_ns != entry['output_mtime_ns']:
+            if file_digest(output_path) != entry['output_hash']:
+                return 'output'
+            if out.st_mtime_ns != entry['output_mtime_ns']:
+                # Same content, new mtime (e.g. copied): refresh the stat field
+                self._update_output_stat(str(input_path), out)
+
+        if need_metrics and entry['metrics'] is None:
+            return 'metrics'
+        return None
+
+    def metrics(self, input_path):
+        """Stored metrics of an input (dict of psnr_db, ssim, rmse), or None."""
+        entry = self.entries.get(str(input_path))
+        if entry is None or entry['metrics'] is None:
+            return None
+        return json.loads(entry['metrics'])
+
+    def _update_output_stat(self, input_path, st):
+        self.entries[input_path]['output_mtime_ns'] = st.st_mtime_ns
+        self.conn.execute("UPDATE entries SET output_mtime_ns = ? WHERE input_path = ?",
+                          (st.st_mtime_ns, input_path))
+
+    def _update_stat(self, input_path, st):
+        self.entries[input_path].update(input_size=st.st_size, input_mtime_ns=st.st_mtime_ns)
+        self.conn.execute(
+            "UPDATE entries SET input_size = ?, input_mtime_ns = ? WHERE input_path = ?",
+            (st.st_size, st.st_mtime_ns, input_path)
+        )
+
+    def record(self, input_path, output_path, params_hash, success, input_size=None,
+               input_mtime_ns=None, input_hash=None, output_size=None, output_mtime_ns=None,
+               output_hash=None, metrics=None):
+        """
+        Record the outcome of processing one input (committed by `commit`).
+
+        The fingerprint fields are normally produced by `fingerprint` in the
+        process that handled the file; `metrics` are its fused metrics, if
+        measured.
+        """
+        entry = {
+            'input_path': str(input_path),
+            'input_size': input_size,
+            'input_mtime_ns': input_mtime_ns,
+            'input_hash': input_hash,
+            'params_hash': params_hash,
+            'output_path': str(output_path),
+            'output_size': output_size,
+            'output_mtime_ns': output_mtime_ns,
+            'output_hash': output_hash,
+            'status': 'done' if success else 'failed',
+            'updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'metrics': (json.dumps({k: float(v) for k, v in metrics.items()})
+                        if metrics and success else None),
+        }
+        self.entries[entry['input_path']] = entry
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO entries ({', '.join(self.COLUMNS)}) "
+            f"VALUES ({', '.join(':' + c for c in self.COLUMNS)})",
+            entry
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -7,24 +7,530 @@ import numpy as np
 import cv2
 from pathlib import Path
 import sys
+import argparse
+import csv
+import json
+import time
+from collections import deque
 from datetime import datetime
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 
 sys.path.append(str(Path(__file__).parent.parent))
 from config.pipeline_config import DATASETS, MACENKO_PARAMS, PROCESSING, RANDOM_SEED
-from src.macenko_normalization import normalize_image_file
+from src.macenko_normalization import (
+    LOW_TISSUE_MODES, MacenkoNormalizer, decode_image_file, normalize_decoded, normalize_image_file,
+    read_image_rgb, write_image_rgb
+)
+from src.io_pipeline import overlapped_imap
+from src.wsi_normalization import normalize_large_image
+from src.run_manifest import RunManifest, fingerprint, params_digest
+from src.stain_store import StainParamStore
+from src.shard_store import ShardWriter
+from src.dataset_catalog import DatasetCatalog
+from src.partitioning import (
+    add_shard_arguments, check_shard_arguments, select_shard, shard_path, shard_suffix
+)
+from src.telemetry import PipelineTelemetry, peak_rss_bytes, task_sample
+from src.calculate_metrics import FUSED_METRICS_TITLE, MetricsWriter, compute_metrics, log_summary
+from src.fast_metrics import compute_metrics_batch
+from src.fused_kernel import set_threads as set_kernel_threads
+
+IMAGE_EXTENSIONS = ('*.jpeg', '*.jpg', '*.png', '*.tif', '*.tiff')
+SLIDE_EXTENSIONS = IMAGE_EXTENSIONS + ('*.npy',)  # raw slides for use_patches datasets
+
+# State of the current process: normalizer and options (installed once per worker)
+_worker = {}
+
+
+def get_all_images(dataset_path, extensions=IMAGE_EXTENSIONS):
+    """Recursively find all images in a directory (sorted, from the cached dataset catalog)."""
+    return DatasetCatalog(dataset_path).files(ext.lstrip('*') for ext in extensions)
+
+
+def build_normalizer(reference_path=None, **overrides):
+    """
+    Build the pipeline normalizer from MACENKO_PARAMS.
+
+    Parameters:
+    -----------
+    reference_path : str or Path
+        Optional target tile; if given, HERef/maxCRef are fitted on it
+        instead of using the hardcoded reference values.
+    **overrides : dict
+        MacenkoNormalizer arguments that replace the configured values
+        (e.g. from command-line options)
+
+    Returns:
+    --------
+    MacenkoNormalizer : Normalizer with precomputed reference state
+    """
+    params = dict(
+        Io=MACENKO_PARAMS['Io'],
+        alpha=MACENKO_PARAMS['alpha'],
+        beta=MACENKO_PARAMS['beta'],
+        HERef=MACENKO_PARAMS['HERef'],
+        maxCRef=MACENKO_PARAMS['maxCRef'],
+        sample_pixels=MACENKO_PARAMS['sample_pixels'],
+        estimation_scale=MACENKO_PARAMS['estimation_scale'],
+        seed=RANDOM_SEED,
+        dtype=MACENKO_PARAMS['dtype'],
+        chunk_pixels=MACENKO_PARAMS['chunk_pixels'],
+        fast=MACENKO_PARAMS['fast_path'],
+        unique_colors=MACENKO_PARAMS['unique_colors'],
+        fused=MACENKO_PARAMS['fused_kernel'],
+        min_tissue_fraction=MACENKO_PARAMS['min_tissue_fraction'],
+        precheck_scale=MACENKO_PARAMS['precheck_scale'],
+        low_tissue=MACENKO_PARAMS['low_tissue'],
+    )
+    params.update(overrides)
+    normalizer = MacenkoNormalizer(**params)
+
+    if reference_path is not None:
+        reference = read_image_rgb(reference_path)
+        if reference is None:
+            raise FileNotFoundError(f"Could not read reference image {reference_path}")
+        normalizer.fit(reference)
+
+    return normalizer
+
+
+def _measure(metrics, img_rgb, normalized):
+    """Fill `metrics` with PSNR/SSIM/RMSE of the in-memory original and result (if not None)."""
+    if metrics is None:
+        return
+    if PROCESSING['fast_metrics']:
+        values = compute_metrics_batch(img_rgb[np.newaxis], normalized[np.newaxis],
+                                       PROCESSING['channel_mode'])[0]
+    else:
+        values = compute_metrics(img_rgb, normalized, PROCESSING['channel_mode'])
+    metrics.update(psnr_db=values['psnr'], ssim=values['ssim'], rmse=values['rmse'])
+
+
+def _on_normalized(metrics):
+    """normalize_image_file callback that measures into `metrics`, or None."""
+    return None if metrics is None else partial(_measure, metrics)
+
+
+def _write_output(output_path, img_rgb):
+    """Save a normalized image, or keep it for the shard writer in shard output mode."""
+    if _worker['shards']:
+        _worker['outputs'][str(output_path)] = img_rgb
+        return True
+    return write_image_rgb(output_path, img_rgb)
+
+
+def _normalize_task(task, timings=None, metrics=None, stats=None):
+    """Normalize one (input_path, output_path) pair with the process normalizer."""
+    img_path, output_path = task
+    return normalize_image_file(img_path, output_path, normalizer=_worker['normalizer'],
+                                stats=stats, timings=timings, on_normalized=_on_normalized(metrics),
+                                writer=_write_output)
+
+
+def _normalize_task_with_stats(task, timings=None, metrics=None):
+    """
+    Normalize one task for the stain parameter store.
 
+    In re-target mode images already in the store are normalized with their
+    stored source parameters; all other images are fully estimated and their
+    stats are returned for the store.
+    """
+    img_path, output_path = task
+    normalizer = _worker['normalizer']
+
+    if _worker['stain_params'] is not None:
+        stain_params = _worker['stain_params'].get(str(img_path))
+        if stain_params is not None:
+            return {'success': normalize_image_file(img_path, output_path, normalizer,
+                                                    stain_params=stain_params, timings=timings,
+                                                    on_normalized=_on_normalized(metrics),
+                                                    writer=_write_output)}
 
-def get_all_images(dataset_path, extensions=('*.jpeg', '*.jpg', '*.png', '*.tif', '*.tiff')):
-    """Recursively find all images in a directory."""
-    dataset_path = Path(dataset_path)
-    images = []
-    for ext in extensions:
-        images.extend(dataset_path.rglob(ext))
-    return sorted(images)
+    image_stats = {}
+    success = normalize_image_file(img_path, output_path, normalizer, stats=image_stats,
+                                   timings=timings, on_normalized=_on_normalized(metrics),
+                                   writer=_write_output)
+    return {'success': success, 'stats': image_stats}
 
 
-def process_dataset(dataset_name, config):
+def _process_batched(chunk, timings, metrics, tissue):
+    """
+    Normalize a chunk through the batched path.
+
+    Images are decoded and grouped by resolution; each group is normalized
+    in stacks of at most `batch_size` tiles. If a stack fails (e.g. one tile
+    has a degenerate tissue mask) its tiles are retried one by one, so a bad
+    tile only fails itself.
+
+    `timings`, `metrics` and `tissue` hold one stage-timing /
+    quality-metrics / tissue pre-check dict (or None) per task; the time of
+    a batched normalization is split evenly over its tiles. Tiles below the
+    tissue pre-check threshold are normalized one by one; the others get
+    their transform stats from `transform_batch`, so `tissue_route` sees
+    the same entries as on the per-image path.
+    """
+    normalizer = _worker['normalizer']
+    batch_size = _worker['batch_size']
+    results = [False] * len(chunk)
+
+    # Group decoded images by resolution
+    groups = {}
+    for i, (img_path, _) in enumerate(chunk):
+        start = time.perf_counter()
+        img = read_image_rgb(img_path)
+        if timings[i] is not None:
+            timings[i]['decode'] = time.perf_counter() - start
+        if img is None:
+            print(f"Warning: Could not read {img_path}")
+            continue
+        if tissue[i] is not None and normalizer.precheck(img, tissue[i]) is not None:
+            results[i] = _normalize_task(chunk[i], timings[i], metrics[i], tissue[i])
+            continue
+        groups.setdefault(img.shape, []).append((i, img))
+
+    for items in groups.values():
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            batch_start = time.perf_counter()
+            try:
+                normalized = normalizer.transform_batch(np.stack([img for _, img in batch]),
+                                                        stats=[tissue[i] for i, _ in batch])
+            except Exception:
+                for i, _ in batch:
+                    results[i] = _normalize_task(chunk[i], timings[i], metrics[i], tissue[i])
+                continue
+            per_tile = (time.perf_counter() - batch_start) / len(batch)
+
+            for (i, original), img in zip(batch, normalized):
+                try:
+                    write_start = time.perf_counter()
+                    _write_output(chunk[i][1], img)
+                    results[i] = True
+                    if timings[i] is not None:
+                        timings[i]['normalize'] = per_tile
+                        timings[i]['encode_write'] = time.perf_counter() - write_start
+                    _measure(metrics[i], original, img)
+                except Exception as e:
+                    print(f"Error processing {chunk[i][0]}: {str(e)}")
+
+    return results
+
+
+def _overlapped_tasks(tasks):
+    """
+    Normalize tasks with decode and encode/write on thread pools.
+
+    Results are identical to `_normalize_task` / `_normalize_task_with_stats`
+    (including stain store stats and re-target parameters); only the I/O is
+    overlapped with the compute of neighbouring images. Tasks are consumed
+    through one `overlapped_imap`, so reads keep running ahead for the
+    whole list.
+
+    Yields:
+    -------
+    tuple : (result, timings, metrics, tissue) per task, in order, as soon
+            as its output is written; the last three are the task's dicts
+            (or None) from `_task_state`
+    """
+    normalizer = _worker['normalizer']
+    stain_params = _worker['stain_params'] or {}
+    state = {}
+
+    def decode(i):
+        state[i] = ({'success': False},) + _task_state()
+        timings = state[i][1]
+        start = time.perf_counter()
+        decoded = decode_image_file(tasks[i][0], normalizer, stain_params.get(str(tasks[i][0])))
+        if timings is not None:
+            timings['decode'] = time.perf_counter() - start
+        return decoded
+
+    def compute(i, decoded):
+        if decoded is None:
+            return None
+        result, timings, _, tissue = state[i]
+        start = time.perf_counter()
+        params = stain_params.get(str(tasks[i][0]))
+        image_stats = tissue
+        if _worker['stain_store'] and params is None:
+            image_stats = result['stats'] = {}
+        normalized = normalize_decoded(*decoded, normalizer=normalizer, stats=image_stats,
+                                       stain_params=params)
+        if timings is not None:
+            timings['normalize'] = time.perf_counter() - start
+        return decoded[0], normalized
+
+    def encode(i, computed):
+        if computed is None:
+            print(f"Warning: Could not read {tasks[i][0]}")
+            return False
+        _, timings, metrics, _ = state[i]
+        img_rgb, normalized = computed
+        start = time.perf_counter()
+        _write_output(tasks[i][1], normalized)
+        if timings is not None:
+            timings['encode_write'] = time.perf_counter() - start
+        _measure(metrics, img_rgb, normalized)
+        return True
+
+    outcomes = overlapped_imap(range(len(tasks)), decode, compute, encode,
+                               threads=_worker['io_threads'], depth=_worker['io_depth'])
+    for i, outcome in enumerate(outcomes):
+        result, timings, metrics, tissue = state.pop(i)
+        if isinstance(outcome, Exception):
+            print(f"Error processing {tasks[i][0]}: {str(outcome)}")
+        else:
+            result['success'] = outcome
+        yield result, timings, metrics, tissue
+
+
+def _normalize_large_image(task, timings=None):
+    """Normalize one large image in tiles (whole call timed as 'normalize')."""
+    img_path, output_path = task
+    start = time.perf_counter()
+    success = normalize_large_image(img_path, output_path, _worker['normalizer'],
+                                    tile_size=_worker['patch_size'], lut_grid=_worker['lut_grid'])
+    if timings is not None:
+        timings['normalize'] = time.perf_counter() - start
+    return success
+
+
+def _normalize_chunk(chunk, timings, metrics, tissue):
+    """Normalize a chunk of tasks, returning one success flag per task (in order)."""
+    if _worker['use_patches']:
+        return [_normalize_large_image(task, t) for task, t in zip(chunk, timings)]
+    if _worker['batch_size'] > 1:
+        return _process_batched(chunk, timings, metrics, tissue)
+    return [_normalize_task(task, t, m, st) for task, t, m, st in zip(chunk, timings, metrics, tissue)]
+
+
+def _task_state():
+    """Stage-timing, quality-metrics and tissue pre-check dicts (or None) of one task."""
+    precheck = _worker['precheck'] and not _worker['use_patches']
+    return ({} if _worker['telemetry'] else None,
+            {} if _worker['metrics'] else None,
+            {} if precheck else None)
+
+
+def _finish_result(task, result, timings, metrics, tissue, peak_rss=None):
+    """
+    Complete the result of one normalized task (see `_process_chunk`).
+
+    `peak_rss` is the worker peak RSS for the telemetry sample (measured now
+    if not given).
+    """
+    if metrics:
+        result['metrics'] = metrics
+
+    if tissue is not None:
+        result['tissue'] = tissue_route(result.get('stats', tissue), result['success'])
+
+    img_path, output_path = task
+    if _worker['shards']:
+        image = _worker['outputs'].pop(str(output_path), None)
+        if result['success'] and image is not None:
+            result['image'] = image
+        else:
+            result['success'] = False
+
+    if _worker['telemetry']:
+        if peak_rss is None:
+            peak_rss = peak_rss_bytes()
+        result['telemetry'] = task_sample(img_path, output_path, timings, result['success'], peak_rss)
+
+    if _worker['manifest'] and result['success']:
+        try:
+            result.update(fingerprint(img_path, output_path))
+        except OSError:
+            result['success'] = False
+
+    return result
+
+
+def _process_chunk(chunk):
+    """
+    Normalize a chunk of tasks.
+
+    Returns one result dict per task (in order) with a 'success' flag, the
+    source stain estimate ('stats') when a stain parameter store is used,
+    a 'telemetry' sample when telemetry is on, quality 'metrics' of the
+    in-memory arrays when fused metrics are on (not for patch datasets),
+    the normalized 'image' in shard output mode, the 'tissue' pre-check
+    route when the pre-check is on (see `tissue_route`), and the
+    input/output fingerprint when a manifest is used.
+    """
+    _worker['outputs'] = {}
+
+    if _worker['io_threads'] > 0 and not _worker['use_patches']:
+        return [_finish_result(task, *finished)
+                for task, finished in zip(chunk, _overlapped_tasks(chunk))]
+
+    timings, metrics, tissue = (list(column) for column in zip(*(_task_state() for _ in chunk)))
+    if _worker['stain_store'] and not _worker['use_patches']:
+        results = [_normalize_task_with_stats(task, t, m)
+                   for task, t, m in zip(chunk, timings, metrics)]
+    else:
+        results = [{'success': success}
+                   for success in _normalize_chunk(chunk, timings, metrics, tissue)]
+
+    peak_rss = peak_rss_bytes() if _worker['telemetry'] else None
+    return [_finish_result(task, result, t, m, st, peak_rss)
+            for task, result, t, m, st in zip(chunk, results, timings, metrics, tissue)]
+
+
+def _process_stream(tasks):
+    """
+    Normalize all tasks through one overlapped I/O pipeline (io_threads > 0,
+    in-process runs).
+
+    Unlike per-chunk processing, decoding keeps running ahead across what
+    would be chunk boundaries, so read time stays hidden for the whole task
+    list. Yields the `_process_chunk` result of every task, in order, as
+    soon as its output is written.
+    """
+    _worker['outputs'] = {}
+    for task, finished in zip(tasks, _overlapped_tasks(tasks)):
+        yield _finish_result(task, *finished)
+
+
+def tissue_route(stats, success):
+    """
+    Route an image took through the tissue pre-check, from its transform stats.
+
+    Returns:
+    --------
+    dict : 'route' ('full', the low_tissue mode 'passthrough' / 'reference',
+           'no_tissue' when full estimation found no tissue, 'stored' for
+           re-targeted images, or 'failed') and 'thumbnail_tissue_fraction'
+    """
+    if not success:
+        route = 'failed'
+    elif 'precheck' in stats:
+        route = stats['precheck']
+    elif 'thumbnail_tissue_fraction' not in stats:
+        route = 'stored'
+    elif stats.get('tissue_fraction') == 0:
+        route = 'no_tissue'
+    else:
+        route = 'full'
+    return {'route': route, 'thumbnail_tissue_fraction': stats.get('thumbnail_tissue_fraction')}
+
+
+def _init_worker(state):
+    """Pool initializer: receive the normalizer and options once per worker process."""
+    _worker.update(state)
+
+    # Keep OpenCV (and the fused kernel) single-threaded inside workers to avoid oversubscription
+    cv2.setNumThreads(1)
+    set_kernel_threads(1)
+
+
+def run_tasks(tasks, normalizer, workers=1, chunk_size=16, batch_size=1, use_patches=False,
+              manifest=False, stain_store=False, stain_params=None, telemetry=False,
+              io_threads=0, io_depth=8, metrics=False, shards=False, desc=None):
+    """
+    Normalize a list of (input_path, output_path) tasks, serially or in a process pool.
+
+    Tasks are submitted in chunks of `chunk_size` and results are yielded in
+    submission order, so the output files are identical to a serial run.
+
+    Parameters:
+    -----------
+    tasks : list
+        List of (input_path, output_path) tuples
+    normalizer : MacenkoNormalizer
+        Normalizer applied to every image (sent once to each worker)
+    workers : int
+        Number of worker processes (1 runs in the current process)
+    chunk_size : int
+        Number of tasks sent to a worker at once
+    batch_size : int
+        Tiles per batched normalization call (1 disables the batched path;
+        chunks are enlarged to at least `batch_size`)
+    use_patches : bool
+        Normalize each image in PROCESSING['patch_size'] tiles with one
+        global stain estimate (see wsi_normalization.py)
+    manifest : bool
+        Fingerprint inputs and outputs for the run manifest
+    stain_store : bool
+        Return the per-image source stain estimate (per-image tasks only;
+        disables the batched path)
+    stain_params : dict
+        Re-target mode: stored (HE, maxC) by input path; these images skip
+        stain estimation (requires `stain_store`)
+    telemetry : bool
+        Time the decode / normalize / encode_write stages of every image and
+        report bytes read/written and worker peak RSS
+    io_threads : int
+        Decode and encode/write threads per process around the compute
+        stage (0 = sequential I/O). Replaces the batched path. In-process
+        runs stream every task through one overlapped pipeline; worker
+        processes overlap per chunk, with chunks enlarged to at least
+        2 x `io_depth`
+    io_depth : int
+        Images decoded ahead / pending writes per process (bounds memory)
+    metrics : bool
+        Compute PSNR/SSIM/RMSE on the in-memory original and normalized
+        arrays right after normalization
+    shards : bool
+        Return each normalized image in its result instead of writing the
+        output file (for the shard writer; not for patch datasets)
+    desc : str
+        Progress bar description
+
+    Yields:
+    -------
+    dict : Result for each task, in the order of `tasks` ('success' flag,
+           plus 'stats' if `stain_store`, 'telemetry' if `telemetry`,
+           'metrics' if `metrics`, 'image' if `shards` and fingerprint fields
+           if `manifest` is set)
+    """
+    state = {
+        'normalizer': normalizer,
+        'batch_size': batch_size,
+        'use_patches': use_patches,
+        'patch_size': PROCESSING['patch_size'],
+        'lut_grid': PROCESSING['lut_grid'],
+        'manifest': manifest,
+        'stain_store': stain_store,
+        'stain_params': stain_params,
+        'telemetry': telemetry,
+        'io_threads': io_threads,
+        'io_depth': io_depth,
+        'metrics': metrics,
+        'shards': shards,
+        'precheck': normalizer.min_tissue_fraction is not None,
+    }
+
+    chunk_size = max(chunk_size, batch_size, 2 * io_depth if io_threads > 0 else 1)
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+    with tqdm(total=len(tasks), desc=desc) as pbar:
+        if workers <= 1 and io_threads > 0 and not use_patches:
+            _worker.update(state)
+            for result in _process_stream(tasks):
+                pbar.update(1)
+                yield result
+        elif workers <= 1:
+            _worker.update(state)
+            for chunk in chunks:
+                results = _process_chunk(chunk)
+                pbar.update(len(results))
+                yield from results
+        else:
+            with Pool(processes=workers, initializer=_init_worker,
+                      initargs=(state,)) as pool:
+                for results in pool.imap(_process_chunk, chunks):
+                    pbar.update(len(results))
+                    yield from results
+
+
+def process_dataset(dataset_name, config, normalizer=None, workers=1, chunk_size=None,
+                    batch_size=None, manifest=None, stain_store=None, retarget=False,
+                    telemetry=None, io_threads=None, io_depth=None, metrics_writer=None,
+                    shard_writer=None, shard_index=0, num_shards=1, tissue_rows=None):
     """
     Process a single dataset with Macenko normalization.
 
@@ -34,10 +540,50 @@ def process_dataset(dataset_name, config):
         Name of the dataset (e.g., 'LC25000', 'CRC5000')
     config : dict
         Dataset configuration from pipeline_config.py
+    normalizer : MacenkoNormalizer
+        Normalizer to apply (default: built from MACENKO_PARAMS)
+    workers : int
+        Number of worker processes (1 = serial)
+    chunk_size : int
+        Tasks per worker submission (default: PROCESSING['chunk_size'])
+    batch_size : int
+        Same-size tiles per batched normalization (default: PROCESSING['batch_size'])
+    manifest : RunManifest
+        If given, only inputs that are new, changed, failed or processed with
+        other parameters are normalized, and every outcome is recorded
+    stain_store : StainParamStore
+        If given, the source stain estimate of every normalized image is
+        added to the store (saved at the end of the dataset)
+    retarget : bool
+        Normalize images found in `stain_store` with their stored source
+        parameters, running only the concentration rescale and reconstruction
+    telemetry : PipelineTelemetry
+        If given, per-stage timings, bytes and worker peak RSS of every
+        image are added to it
+    io_threads : int
+        Threaded decode/encode per process (default: PROCESSING['io_threads'])
+    io_depth : int
+        Images in flight per I/O stage (default: PROCESSING['io_depth'])
+    metrics_writer : MetricsWriter
+        If given, PSNR/SSIM/RMSE of every normalized image (computed on the
+        in-memory arrays) are streamed into it; with a manifest, inputs that
+        are skipped as up to date contribute their stored metrics (inputs
+        without stored metrics are reprocessed)
+    shard_writer : ShardWriter
+        If given, normalized tiles are packed into its shards (in input
+        order) instead of being written as individual files; not used for
+        patch datasets
+    shard_index, num_shards : int
+        Only process the images of this shard (see partitioning.py)
+    tissue_rows : list
+        With the tissue pre-check on, receives one row (dataset, image,
+        route, thumbnail tissue fraction) per image that did not take the
+        full estimation path
 
     Returns:
     --------
-    dict : Processing statistics
+    dict : Processing statistics (with 'routes' counts when the tissue
+           pre-check is on)
     """
     print(f"\n{'='*60}")
     print(f"Processing {dataset_name}")
@@ -46,9 +592,19 @@ def process_dataset(dataset_name, config):
     input_dir = Path(config['input_dir'])
     output_dir = Path(config['output_dir'])
 
-    # Get all images
-    images = get_all_images(input_dir)
+    # Get all images (patch datasets may also hold raw .npy slides)
+    use_patches = config.get('use_patches', False)
+    if use_patches and shard_writer is not None:
+        print("Warning: shard output is not supported for patch datasets; writing files")
+        shard_writer = None
+    if use_patches:
+        images = get_all_images(input_dir, SLIDE_EXTENSIONS)
+    else:
+        images = get_all_images(input_dir)
     print(f"Found {len(images)} images")
+    if num_shards > 1:
+        images = select_shard(images, input_dir, shard_index, num_shards)
+        print(f"Shard {shard_index}/{num_shards}: {len(images)} images")
 
     if len(images) == 0:
         print(f"Warning: No images found in {input_dir}")
@@ -57,11 +613,39 @@ def process_dataset(dataset_name, config):
     # Set random seed
     np.random.seed(RANDOM_SEED)
 
-    # Process images
+    if normalizer is None:
+        normalizer = build_normalizer()
+    if chunk_size is None:
+        chunk_size = PROCESSING['chunk_size']
+    if batch_size is None:
+        batch_size = PROCESSING['batch_size']
+    if io_threads is None:
+        io_threads = PROCESSING['io_threads']
+    if io_depth is None:
+        io_depth = PROCESSING['io_depth']
+
+    # Everything that changes the output of an image
+    params = {
+        'normalizer': normalizer.get_params(),
+        'use_patches': use_patches,
+        'patch_size': PROCESSING['patch_size'] if use_patches else None,
+    }
+    if use_patches and PROCESSING['lut_grid'] is not None:
+        params['lut_grid'] = PROCESSING['lut_grid']
+    params_hash = params_digest(params)
+
     success_count = 0
     failed_count = 0
-
-    for img_path in tqdm(images, desc=f"Normalizing {dataset_name}"):
+    reasons = {}
+    routes = {}
+
+    # Build the task list; with a manifest, stored metrics of skipped
+    # inputs are kept (with their position) to be written in input order
+    need_metrics = metrics_writer is not None and not use_patches
+    tasks = []
+    task_positions = []
+    stored_metrics = deque()
+    for position, img_path in enumerate(images):
         # Preserve directory structure
         relative_path = img_path.relative_to(input_dir)
 
@@ -70,27 +654,96 @@ def process_dataset(dataset_name, config):
         else:
             output_path = output_dir / img_path.name
 
-        # Skip if exists and skip_existing is True
-        if PROCESSING['skip_existing'] and output_path.exists():
+        if manifest is not None:
+            # Skip inputs whose recorded output is still valid
+            reason = manifest.needs_processing(img_path, output_path, params_hash,
+                                               need_metrics=need_metrics)
+            if reason is None:
+                success_count += 1
+                if need_metrics:
+                    stored_metrics.append((position, output_path, manifest.metrics(img_path)))
+                continue
+            reasons[reason] = reasons.get(reason, 0) + 1
+        elif PROCESSING['skip_existing'] and output_path.exists():
+            # Skip if exists and skip_existing is True
             success_count += 1
             continue
 
-        # Process image
-        success = normalize_image_file(
-            img_path,
-            output_path,
-            Io=MACENKO_PARAMS['Io'],
-            alpha=MACENKO_PARAMS['alpha'],
-            beta=MACENKO_PARAMS['beta'],
-            HERef=np.array(MACENKO_PARAMS['HERef']),
-            maxCRef=np.array(MACENKO_PARAMS['maxCRef'])
-        )
-
-        if success:
+        tasks.append((img_path, output_path))
+        task_positions.append(position)
+
+    def add_stored_metrics(before):
+        # Stream stored metrics of skipped inputs that precede `before`
+        while stored_metrics and stored_metrics[0][0] < before:
+            _, output_path, image_metrics = stored_metrics.popleft()
+            metrics_writer.add(dataset_name, output_path.name, image_metrics,
+                               relative_path=output_path.relative_to(output_dir))
+
+    if manifest is not None:
+        print(f"Manifest: {len(images) - len(tasks)} up to date, {len(tasks)} to process "
+              f"({', '.join(f'{k}={v}' for k, v in sorted(reasons.items())) or 'none'})")
+
+    stain_params = None
+    if stain_store is not None and retarget:
+        stain_params = {str(img_path): stain_store.get(img_path) for img_path, _ in tasks}
+        stain_params = {k: v for k, v in stain_params.items() if v is not None}
+        print(f"Re-target: {len(stain_params)} of {len(tasks)} images use stored stain parameters")
+
+    # Process images
+    results = run_tasks(tasks, normalizer, workers=workers, chunk_size=chunk_size,
+                        batch_size=batch_size, use_patches=use_patches,
+                        manifest=manifest is not None, stain_store=stain_store is not None,
+                        stain_params=stain_params, telemetry=telemetry is not None,
+                        io_threads=io_threads, io_depth=io_depth,
+                        metrics=metrics_writer is not None, shards=shard_writer is not None,
+                        desc=f"Normalizing {dataset_name}")
+    for i, ((img_path, output_path), result) in enumerate(zip(tasks, results), 1):
+        if result['success']:
             success_count += 1
         else:
             failed_count += 1
 
+        image_stats = result.pop('stats', None)
+        if image_stats is not None:
+            stain_store.add(img_path, image_stats, group=dataset_name)
+
+        sample = result.pop('telemetry', None)
+        if sample is not None:
+            telemetry.observe(sample, result['success'], dataset_name)
+
+        route = result.pop('tissue', None)
+        if route is not None:
+            routes[route['route']] = routes.get(route['route'], 0) + 1
+            if route['route'] != 'full' and tissue_rows is not None:
+                tissue_rows.append({'dataset': dataset_name,
+                                    'image': output_path.relative_to(output_dir).as_posix(),
+                                    **route})
+
+        image = result.pop('image', None)
+        if image is not None:
+            shard_writer.add(output_path.relative_to(output_dir), image)
+
+        image_metrics = result.pop('metrics', None)
+        if image_metrics is not None:
+            add_stored_metrics(task_positions[i - 1])
+            metrics_writer.add(dataset_name, output_path.name, image_metrics,
+                               relative_path=output_path.relative_to(output_dir))
+
+        if manifest is not None:
+            manifest.record(img_path, output_path, params_hash, metrics=image_metrics, **result)
+            if i % PROCESSING['log_every'] == 0:
+                manifest.commit()
+
+    if stored_metrics:
+        add_stored_metrics(len(images))
+    if manifest is not None:
+        manifest.commit()
+    if stain_store is not None:
+        stain_store.save()
+    if shard_writer is not None:
+        shard_writer.close()
+        print(f"Shards: {len(shard_writer)} tiles in {shard_writer.directory}")
+
     stats = {
         'total': len(images),
         'success': success_count,
@@ -101,27 +754,135 @@ def process_dataset(dataset_name, config):
     print(f"  Total:   {stats['total']}")
     print(f"  Success: {stats['success']}")
     print(f"  Failed:  {stats['failed']}")
+    if routes:
+        stats['routes'] = routes
+        print(f"  Tissue pre-check: {', '.join(f'{k}={v}' for k, v in sorted(routes.items()))}")
 
     return stats
 
 
-def main():
+def parse_args(argv=None):
+    """Parse command-line options for the pipeline."""
+    parser = argparse.ArgumentParser(description="Macenko color normalization pipeline")
+    parser.add_argument('--workers', type=int, default=PROCESSING['workers'],
+                        help="Number of worker processes (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int, default=PROCESSING['chunk_size'],
+                        help="Images per worker task (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=PROCESSING['batch_size'],
+                        help="Same-size tiles per batched normalization, 1 = off (default: %(default)s)")
+    parser.add_argument('--io-threads', type=int, default=PROCESSING['io_threads'],
+                        help="Decode/encode threads per process, 0 = sequential I/O (default: %(default)s)")
+    parser.add_argument('--io-depth', type=int, default=PROCESSING['io_depth'],
+                        help="Images in flight per I/O stage (default: %(default)s)")
+    parser.add_argument('--manifest', default=PROCESSING['manifest'],
+                        help="Run manifest (SQLite) for incremental/resumable runs")
+    parser.add_argument('--verify', action='store_true',
+                        help="With --manifest, re-hash every up-to-date output instead of "
+                             "trusting its size and mtime")
+    parser.add_argument('--stain-store', default=PROCESSING['stain_store'],
+                        help="Per-image stain parameter store (.npz) to update")
+    parser.add_argument('--retarget', action='store_true',
+                        help="Reuse stored source stain parameters; only rescale and reconstruct "
+                             "(requires --stain-store)")
+    parser.add_argument('--telemetry', default=PROCESSING['telemetry'],
+                        help="Write run telemetry to this JSON file (and a .prom textfile next to it)")
+    parser.add_argument('--metrics', action='store_true', default=PROCESSING['fused_metrics'],
+                        help="Compute PSNR/SSIM/RMSE during normalization into "
+                             "results/tables/metrics_detailed.csv and metrics.csv")
+    parser.add_argument('--output-format', choices=('files', 'shards'),
+                        default=PROCESSING['output_format'],
+                        help="Individual image files, or packed .npy shards in each dataset's "
+                             "shard_dir (default: %(default)s)")
+    parser.add_argument('--shard-size', type=int, default=PROCESSING['shard_size'],
+                        help="Tiles per shard (default: %(default)s)")
+    parser.add_argument('--min-tissue-fraction', type=float, default=MACENKO_PARAMS['min_tissue_fraction'],
+                        help="Tissue pre-check: tiles whose thumbnail tissue fraction is below this "
+                             "skip stain estimation (default: %(default)s = off)")
+    parser.add_argument('--low-tissue', choices=LOW_TISSUE_MODES, default=MACENKO_PARAMS['low_tissue'],
+                        help="Output for tiles below the pre-check threshold (default: %(default)s)")
+    parser.add_argument('--reference', default=MACENKO_PARAMS['reference_image'],
+                        help="Reference tile to fit HERef/maxCRef on (default: hardcoded values)")
+    add_shard_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.retarget and not args.stain_store:
+        parser.error("--retarget requires --stain-store")
+    if args.verify and not args.manifest:
+        parser.error("--verify requires --manifest")
+    if args.output_format == 'shards' and args.manifest:
+        parser.error("--manifest tracks individual output files; not supported with shards")
+    check_shard_arguments(parser, args)
+    return args
+
+
+def main(argv=None):
     """Run the full pipeline on all datasets."""
+    args = parse_args(argv)
+
     print("="*60)
     print("COLOR NORMALIZATION PIPELINE - Phase 2")
     print("="*60)
     print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"Random seed: {RANDOM_SEED}")
     print(f"Method: Macenko normalization")
+    print(f"Workers: {args.workers}")
+    if args.io_threads > 0:
+        print(f"I/O threads: {args.io_threads} (depth {args.io_depth})")
+    print(f"Reference: {args.reference or 'MACENKO_PARAMS (HERef/maxCRef)'}")
+    if args.manifest:
+        print(f"Manifest: {args.manifest}{' (verify outputs)' if args.verify else ''}")
+    if args.stain_store:
+        print(f"Stain store: {args.stain_store}{' (re-target)' if args.retarget else ''}")
+    if args.output_format == 'shards':
+        print(f"Output: packed shards of {args.shard_size} tiles")
     print()
 
+    # Build the normalizer once; it is shared by every dataset and worker
+    normalizer = build_normalizer(args.reference, min_tissue_fraction=args.min_tissue_fraction,
+                                  low_tissue=args.low_tissue)
+
+    # Sharded runs keep every output file of their own (merged by src.partitioning)
+    shard = (args.shard_index, args.num_shards)
+    suffix = shard_suffix(*shard)
+    manifest = (RunManifest(shard_path(args.manifest, *shard), verify=args.verify)
+                if args.manifest else None)
+    stain_store = StainParamStore(shard_path(args.stain_store, *shard)) if args.stain_store else None
+    telemetry = (PipelineTelemetry(shard_path(args.telemetry, *shard), PROCESSING['telemetry_interval'])
+                 if args.telemetry else None)
+    metrics_writer = (MetricsWriter(suffix=suffix, with_paths=args.num_shards > 1,
+                                    title=FUSED_METRICS_TITLE)
+                      if args.metrics else None)
+
     all_stats = {}
+    tissue_rows = []
 
     # Process each dataset
     for dataset_name, config in DATASETS.items():
-        stats = process_dataset(dataset_name, config)
+        stats = process_dataset(dataset_name, config, normalizer=normalizer,
+                                workers=args.workers, chunk_size=args.chunk_size,
+                                batch_size=args.batch_size, manifest=manifest,
+                                stain_store=stain_store, retarget=args.retarget,
+                                telemetry=telemetry, io_threads=args.io_threads,
+                                io_depth=args.io_depth, metrics_writer=metrics_writer,
+                                shard_writer=(ShardWriter(shard_path(config['shard_dir'], *shard),
+                                                          args.shard_size)
+                                              if args.output_format == 'shards' else None),
+                                shard_index=args.shard_index, num_shards=args.num_shards,
+                                tissue_rows=tissue_rows)
         all_stats[dataset_name] = stats
 
+    if manifest is not None:
+        manifest.close()
+    if telemetry is not None:
+        telemetry.write()
+    metrics_summary = None
+    if metrics_writer is not None:
+        print("\n" + "="*60)
+        print("METRICS SUMMARY")
+        print("="*60)
+        metrics_summary = metrics_writer.close(tuple(DATASETS))
+        print(f"\nDetailed metrics saved to: {metrics_writer.detailed_path}")
+        print(f"Summary metrics saved to: {metrics_writer.summary_path}")
+
     # Summary
     print("\n" + "="*60)
     print("PIPELINE SUMMARY")
@@ -134,22 +895,78 @@ def main():
     print(f"Successfully normalized: {success_all}")
     print(f"Failed: {failed_all}")
     print(f"Success rate: {100 * success_all / total_all:.2f}%")
+    if normalizer.min_tissue_fraction is not None:
+        tissue_path = Path("results/tables") / f"tissue_precheck{suffix}.csv"
+        tissue_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tissue_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['dataset', 'image', 'route', 'thumbnail_tissue_fraction'])
+            writer.writeheader()
+            writer.writerows(tissue_rows)
+        print(f"Tissue pre-check routes per image saved to: {tissue_path}")
     print(f"\nEnd time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
     # Save log
     log_dir = Path("results/logs")
     log_dir.mkdir(parents=True, exist_ok=True)
 
-    log_path = log_dir / "pipeline.log"
+    lines = run_log_lines(args, normalizer)
+    if args.num_shards > 1:
+        # Per-shard totals for `python -m src.partitioning`
+        with open(log_dir / f"pipeline_stats{suffix}.json", 'w') as f:
+            json.dump({'shard_index': args.shard_index, 'num_shards': args.num_shards,
+                       'lines': lines, 'stats': all_stats}, f, indent=2)
+        lines = lines + [f"Shard: {args.shard_index} of {args.num_shards}"]
+    if telemetry is not None:
+        lines = lines + telemetry.log_lines()
+
+    log_path = log_dir / f"pipeline{suffix}.log"
+    write_pipeline_log(log_path, all_stats, lines)
+
+    if metrics_summary is not None:
+        log_summary(metrics_summary, log_path, metrics_writer.title)
+
+    print(f"\nLog saved to: {log_path}")
+
+
+def run_log_lines(args, normalizer):
+    """Configuration lines of a pipeline.log entry."""
+    lines = [f"Method: Macenko normalization (Io={MACENKO_PARAMS['Io']}, "
+             f"alpha={MACENKO_PARAMS['alpha']}, beta={MACENKO_PARAMS['beta']})"]
+    if args.reference:
+        lines.append(f"Reference: {args.reference}")
+    if args.manifest:
+        lines.append(f"Manifest: {args.manifest}")
+    if args.stain_store:
+        lines.append(f"Stain store: {args.stain_store}{' (re-target)' if args.retarget else ''}")
+    if args.output_format == 'shards':
+        lines.append(f"Output: packed shards ({args.shard_size} tiles per shard)")
+    if normalizer.low_memory:
+        lines.append(f"Compute: dtype={normalizer.dtype.name}, chunk_pixels={normalizer.chunk_pixels}")
+    if normalizer.reduced_estimation:
+        lines.append(f"Stain estimation: sample_pixels={normalizer.sample_pixels}, "
+                     f"estimation_scale={normalizer.estimation_scale}")
+    if normalizer.min_tissue_fraction is not None:
+        lines.append(f"Tissue pre-check: min_tissue_fraction={normalizer.min_tissue_fraction}, "
+                     f"precheck_scale={normalizer.precheck_scale}, low_tissue={normalizer.low_tissue}")
+    return lines
+
+
+def write_pipeline_log(log_path, all_stats, lines):
+    """Append a 'Phase 2 - Pipeline Execution' entry with per-dataset totals to the log."""
+    total_all = sum(s['total'] for s in all_stats.values())
+    success_all = sum(s['success'] for s in all_stats.values())
+
     with open(log_path, 'a') as f:
         f.write(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Phase 2 - Pipeline Execution\n")
-        f.write(f"Method: Macenko normalization (Io={MACENKO_PARAMS['Io']}, alpha={MACENKO_PARAMS['alpha']}, beta={MACENKO_PARAMS['beta']})\n")
+        for line in lines:
+            f.write(f"{line}\n")
         for dataset_name, stats in all_stats.items():
             f.write(f"  {dataset_name}: {stats['success']}/{stats['total']} images normalized\n")
+            if stats.get('routes'):
+                f.write(f"    tissue pre-check: "
+                        f"{', '.join(f'{k}={v}' for k, v in sorted(stats['routes'].items()))}\n")
         f.write(f"Total: {success_all}/{total_all} images (Success rate: {100 * success_all / total_all:.2f}%)\n")
 
-    print(f"\nLog saved to: {log_path}")
-
 
 if __name__ == "__main__":
     main()
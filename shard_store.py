@@ -0,0 +1,240 @@
+"""
+Packed Shard Output Format
+Normalized tiles packed into fixed-size raw uint8 .npy shards per
+resolution, with a CSV index, zero-copy memory-mapped reads and a
+converter back to individual image files
+"""
+
+import numpy as np
+from pathlib import Path
+import argparse
+import csv
+import os
+import re
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import PROCESSING
+from src.macenko_normalization import write_image_rgb
+from src.dataset_catalog import image_groups
+
+INDEX_NAME = "index.csv"
+INDEX_COLUMNS = ('path', 'class', 'split', 'shard', 'offset', 'height', 'width')
+
+# Shard file names: <height>x<width>_<number>.npy
+SHARD_PATTERN = re.compile(r"^\d+x\d+_\d{5}\.npy$")
+
+
+class ShardWriter:
+    """
+    Writes normalized tiles into packed shards.
+
+    Tiles are grouped by resolution; each group fills `shard_size`-tile
+    .npy files (N x H x W x 3 uint8) created as memory maps, so a shard is
+    never held in memory. Shards are written under a temporary name and
+    renamed into place when full (or trimmed to their tile count on
+    `close`), and the index (path, class, split, shard, offset, height,
+    width per tile, in insertion order) is written atomically on `close`.
+
+    Parameters:
+    -----------
+    directory : str or Path
+        Output directory (shards and index.csv)
+    shard_size : int
+        Tiles per shard
+    """
+
+    def __init__(self, directory, shard_size=PROCESSING['shard_size']):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.rows = []
+        self._open = {}      # (height, width) -> [memmap, shard name, tiles written]
+        self._written = {}   # (height, width) -> shards started
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _partial(self, name):
+        return self.directory / f".{name}.partial"
+
+    def add(self, relative_path, img_rgb):
+        """Append one RGB tile (H x W x 3, uint8) stored under `relative_path`."""
+        if img_rgb.ndim != 3 or img_rgb.shape[2] != 3:
+            raise ValueError(f"Expected an H x W x 3 image, got shape {img_rgb.shape}")
+        height, width = img_rgb.shape[:2]
+        key = (height, width)
+
+        if key not in self._open:
+            number = self._written.get(key, 0)
+            self._written[key] = number + 1
+            name = f"{height}x{width}_{number:05d}.npy"
+            shard = np.lib.format.open_memmap(self._partial(name), mode='w+', dtype=np.uint8,
+                                              shape=(self.shard_size, height, width, 3))
+            self._open[key] = [shard, name, 0]
+
+        entry = self._open[key]
+        shard, name, offset = entry
+        shard[offset] = img_rgb
+        entry[2] = offset + 1
+
+        image_class, split = image_groups(relative_path)
+        self.rows.append({
+            'path': Path(relative_path).as_posix(),
+            'class': image_class,
+            'split': split,
+            'shard': name,
+            'offset': offset,
+            'height': height,
+            'width': width,
+        })
+
+        if entry[2] == self.shard_size:
+            self._finish(key)
+
+    def _finish(self, key):
+        """Flush the open shard of a resolution group and move it into place."""
+        shard, name, count = self._open.pop(key)
+        partial = self._partial(name)
+        if count < len(shard):
+            # Last shard of the group: copy the filled tiles into an exact-size file
+            trimmed_path = self.directory / f".{name}.trimmed.partial"
+            trimmed = np.lib.format.open_memmap(trimmed_path, mode='w+', dtype=np.uint8,
+                                                shape=(count,) + shard.shape[1:])
+            trimmed[:] = shard[:count]
+            trimmed.flush()
+            del trimmed, shard
+            os.replace(trimmed_path, partial)
+        else:
+            shard.flush()
+            del shard
+        os.replace(partial, self.directory / name)
+
+    def close(self):
+        """
+        Finish all shards, write index.csv and remove shards of an earlier run
+        that the new index no longer references.
+
+        Returns:
+        --------
+        int : Number of tiles written
+        """
+        for key in list(self._open):
+            self._finish(key)
+
+        index_path = self.directory / INDEX_NAME
+        partial = self._partial(INDEX_NAME)
+        with open(partial, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+        os.replace(partial, index_path)
+
+        used = {row['shard'] for row in self.rows}
+        for path in self.directory.iterdir():
+            if SHARD_PATTERN.match(path.name) and path.name not in used:
+                path.unlink()
+
+        return len(self.rows)
+
+
+class ShardReader:
+    """
+    Random access to the tiles of a shard directory.
+
+    `reader[i]` is a read-only view into a memory-mapped shard (no copy,
+    and only the pages of that tile are read from disk). Shards are
+    opened on first use and kept open.
+
+    Parameters:
+    -----------
+    directory : str or Path
+        Shard directory written by ShardWriter
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(self.directory / INDEX_NAME, newline='') as f:
+            self.rows = [
+                dict(row, offset=int(row['offset']), height=int(row['height']),
+                     width=int(row['width']))
+                for row in csv.DictReader(f)
+            ]
+        self._positions = {row['path']: i for i, row in enumerate(self.rows)}
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _shard(self, name):
+        if name not in self._shards:
+            self._shards[name] = np.load(self.directory / name, mmap_mode='r')
+        return self._shards[name]
+
+    def __getitem__(self, i):
+        row = self.rows[i]
+        return self._shard(row['shard'])[row['offset']]
+
+    def __iter__(self):
+        """Yield `(tile, class, relative_path)` in index order."""
+        for i, row in enumerate(self.rows):
+            yield self[i], row['class'], row['path']
+
+    @property
+    def paths(self):
+        return [row['path'] for row in self.rows]
+
+    def get(self, relative_path):
+        """Tile stored under `relative_path` (KeyError if absent)."""
+        return self[self._positions[Path(relative_path).as_posix()]]
+
+
+def export_images(shard_dir, output_dir):
+    """
+    Convert a shard directory back into individual image files.
+
+    Each tile is written to `output_dir / path` in the format of its path's
+    extension (JPEG paths are re-encoded lossily, like the files output).
+
+    Returns:
+    --------
+    int : Number of images written
+    """
+    reader = ShardReader(shard_dir)
+    output_dir = Path(output_dir)
+    for tile, _, relative_path in reader:
+        write_image_rgb(output_dir / relative_path, tile)
+    return len(reader)
+
+
+def main():
+    """Summarize a shard directory and optionally export it to image files."""
+    parser = argparse.ArgumentParser(description="Inspect or export a packed shard directory")
+    parser.add_argument('shard_dir', help="Shard directory written by run_pipeline.py --output-format shards")
+    parser.add_argument('--export', default=None, metavar='OUTPUT_DIR',
+                        help="Write every tile as an individual image file under OUTPUT_DIR")
+    args = parser.parse_args()
+
+    reader = ShardReader(args.shard_dir)
+    print("="*60)
+    print("SHARD DIRECTORY")
+    print("="*60)
+    print(f"Directory: {args.shard_dir}")
+    print(f"Tiles: {len(reader)} in {len({row['shard'] for row in reader.rows})} shards")
+
+    groups = {}
+    for row in reader.rows:
+        key = (f"{row['height']}x{row['width']}", row['split'], row['class'])
+        groups[key] = groups.get(key, 0) + 1
+    for (resolution, split, image_class), n in sorted(groups.items()):
+        print(f"  {resolution} {split or '-'} / {image_class or '-'}: {n}")
+
+    if args.export:
+        n = export_images(args.shard_dir, args.export)
+        print(f"\nExported {n} images to: {args.export}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Per-Image Stain Parameter Store
+Persists the source stain estimate (HE, maxC, tissue fraction, eigenvalues)
+of every normalized image, so a new reference can be applied without
+re-estimating, and outlier images can be queried
+"""
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import argparse
+import os
+import sys
+
+# Modified z-score above which a value is flagged (Iglewicz & Hoaglin)
+OUTLIER_THRESHOLD = 3.5
+
+
+def _angles_to(vectors, reference):
+    """Angle (degrees) between each row of `vectors` (N x 3) and `reference` (3,)."""
+    cos = vectors.dot(reference) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+class StainParamStore:
+    """
+    Columnar store of per-image source stain estimates (.npz).
+
+    Arrays are kept per column: image paths, HE (N x 3 x 2), maxC (N x 2),
+    tissue fraction (N,) and the ascending eigenvalues of the tissue OD
+    covariance (N x 3), plus a group label (the dataset name). Values that
+    were not estimated (no tissue, failed images) are NaN.
+
+    The store is loaded once, updated in memory with `add`, and written
+    atomically with `save`.
+    """
+
+    COLUMNS = {
+        'HE': (3, 2),
+        'maxC': (2,),
+        'tissue_fraction': (),
+        'eigvals': (3,),
+    }
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = {}
+        self.groups = {}
+
+        if self.path.exists():
+            with np.load(self.path) as data:
+                for i, image_path in enumerate(data['paths']):
+                    self.records[str(image_path)] = {name: data[name][i] for name in self.COLUMNS}
+                    self.groups[str(image_path)] = str(data['groups'][i])
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, image_path):
+        return str(image_path) in self.records
+
+    def add(self, image_path, stats, group=''):
+        """
+        Add or replace the estimate of one image.
+
+        Parameters:
+        -----------
+        image_path : str or Path
+            Input image path (key)
+        stats : dict
+            Stats filled by `MacenkoNormalizer.transform`; missing entries
+            are stored as NaN
+        group : str
+            Group label (e.g. dataset name); outliers are scored per group
+        """
+        self.groups[str(image_path)] = group
+        self.records[str(image_path)] = {
+            name: np.asarray(stats.get(name, np.full(shape, np.nan)), dtype=np.float64)
+            for name, shape in self.COLUMNS.items()
+        }
+
+    def get(self, image_path):
+        """
+        Stored source parameters of an image.
+
+        Returns:
+        --------
+        tuple or None : (HE, maxC); (None, None) if the image has no tissue;
+                        None if the image is not in the store or its
+                        estimate failed
+        """
+        record = self.records.get(str(image_path))
+        if record is None:
+            return None
+        if record['tissue_fraction'] == 0:
+            return None, None
+        if np.isnan(record['HE']).any() or np.isnan(record['maxC']).any():
+            return None
+        return record['HE'], record['maxC']
+
+    def save(self):
+        """Write the store atomically (temporary file + rename)."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        paths = sorted(self.records)
+        columns = {
+            name: np.array([self.records[p][name] for p in paths]).reshape((len(paths),) + shape)
+            for name, shape in self.COLUMNS.items()
+        }
+
+        partial = self.path.with_name(f".{self.path.name}.partial")
+        with open(partial, 'wb') as f:
+            np.savez(f, paths=np.array(paths, dtype=str),
+                     groups=np.array([self.groups[p] for p in paths], dtype=str), **columns)
+        os.replace(partial, self.path)
+
+    def to_frame(self):
+        """
+        One row per image with flattened parameters and derived columns.
+
+        h_angle_deg / e_angle_deg are the angles between each image's stain
+        vectors and the median stain vectors of its group; eig_ratio is the
+        share of the OD variance outside the stain plane.
+        """
+        paths = sorted(self.records)
+        HE = np.array([self.records[p]['HE'] for p in paths]).reshape((-1, 3, 2))
+        maxC = np.array([self.records[p]['maxC'] for p in paths]).reshape((-1, 2))
+        eigvals = np.array([self.records[p]['eigvals'] for p in paths]).reshape((-1, 3))
+
+        df = pd.DataFrame({
+            'image': paths,
+            'group': [self.groups[p] for p in paths],
+            'tissue_fraction': [float(self.records[p]['tissue_fraction']) for p in paths],
+            'maxC_h': maxC[:, 0],
+            'maxC_e': maxC[:, 1],
+        })
+        for j, stain in enumerate(('h', 'e')):
+            for k, channel in enumerate('rgb'):
+                df[f'{stain}_{channel}'] = HE[:, k, j]
+
+        df['h_angle_deg'] = np.nan
+        df['e_angle_deg'] = np.nan
+        for _, index in df.groupby('group').indices.items():
+            median_HE = np.nanmedian(HE[index], axis=0)
+            df.loc[index, 'h_angle_deg'] = _angles_to(HE[index, :, 0], median_HE[:, 0])
+            df.loc[index, 'e_angle_deg'] = _angles_to(HE[index, :, 1], median_HE[:, 1])
+        df['eig_ratio'] = eigvals[:, 0] / eigvals.sum(axis=1)
+
+        return df
+
+    def outliers(self, threshold=OUTLIER_THRESHOLD):
+        """
+        Images whose stain estimate is missing or far from the rest of the store.
+
+        Each of h_angle_deg, e_angle_deg, maxC_h, maxC_e, tissue_fraction and
+        eig_ratio is scored with the modified z-score (median / MAD) within
+        the image's group.
+
+        Parameters:
+        -----------
+        threshold : float
+            Modified z-score above which a value is flagged
+
+        Returns:
+        --------
+        pd.DataFrame : Flagged rows of `to_frame` with a 'reasons' column
+        """
+        df = self.to_frame()
+        reasons = [[] for _ in range(len(df))]
+
+        for i in np.flatnonzero(df[['maxC_h', 'maxC_e', 'h_r']].isna().any(axis=1).to_numpy()):
+            reasons[i].append('no_estimate')
+
+        for _, index in df.groupby('group').indices.items():
+            for column in ('h_angle_deg', 'e_angle_deg', 'maxC_h', 'maxC_e',
+                           'tissue_fraction', 'eig_ratio'):
+                values = df[column].to_numpy()[index]
+                if np.isnan(values).all():
+                    continue
+                median = np.nanmedian(values)
+                mad = np.nanmedian(np.abs(values - median))
+                if mad == 0:
+                    continue
+                score = 0.6745 * np.abs(values - median) / mad
+                for i in np.flatnonzero(score > threshold):
+                    reasons[index[i]].append(f"{column} (z={score[i]:.1f})")
+
+        df['reasons'] = ['; '.join(r) for r in reasons]
+        return df[df['reasons'] != ''].reset_index(drop=True)
+
+
+def main():
+    """Summarize a stain parameter store and list outlier images."""
+    parser = argparse.ArgumentParser(description="Query a per-image stain parameter store")
+    parser.add_argument('store', help="Stain parameter store (.npz) written by run_pipeline.py")
+    parser.add_argument('--threshold', type=float, default=OUTLIER_THRESHOLD,
+                        help="Modified z-score threshold (default: %(default)s)")
+    parser.add_argument('--output', default="results/tables/stain_outliers.csv",
+                        help="Outlier table (default: %(default)s)")
+    args = parser.parse_args()
+
+    store = StainParamStore(args.store)
+    if not len(store):
+        print(f"No entries in {args.store}")
+        return 1
+
+    df = store.to_frame()
+    print("="*60)
+    print("STAIN PARAMETER STORE")
+    print("="*60)
+    columns = ['tissue_fraction', 'maxC_h', 'maxC_e', 'h_angle_deg', 'e_angle_deg', 'eig_ratio']
+    for group, group_df in df.groupby('group'):
+        print(f"\n{group or '(no group)'}: {len(group_df)} images")
+        print(group_df[columns].describe().to_string(float_format=lambda x: f"{x:.4f}"))
+
+    outliers = store.outliers(args.threshold)
+    print("\n" + "="*60)
+    print(f"OUTLIERS (modified z > {args.threshold:g}): {len(outliers)}")
+    print("="*60)
+    for _, row in outliers.iterrows():
+        print(f"  {row['image']}: {row['reasons']}")
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    outliers.to_csv(output, index=False)
+    print(f"\nOutlier table saved to: {output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Pipeline Telemetry
+Per-stage timing histograms, throughput, bytes read/written and peak RSS
+per worker, written periodically as JSON and Prometheus textfile
+"""
+
+import numpy as np
+from pathlib import Path
+import json
+import os
+import resource
+import time
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Stages recorded by normalize_image_file (and the batched / patch paths)
+STAGES = ('decode', 'normalize', 'encode_write')
+
+
+def peak_rss_bytes():
+    """Peak resident set size of the current process in bytes (Linux: ru_maxrss is KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def task_sample(input_path, output_path, timings, success, peak_rss=None):
+    """
+    Telemetry sample of one processed image, built in the worker.
+
+    Parameters:
+    -----------
+    input_path, output_path : Path
+        Task paths (their sizes are the bytes read and written)
+    timings : dict
+        Stage -> seconds
+    success : bool
+        Whether the output was written
+    peak_rss : int
+        Peak RSS of the worker (default: measured now)
+
+    Returns:
+    --------
+    dict : Sample for `PipelineTelemetry.observe`
+    """
+    try:
+        bytes_read = os.stat(input_path).st_size
+    except OSError:
+        bytes_read = 0
+    try:
+        bytes_written = os.stat(output_path).st_size if success else 0
+    except OSError:
+        bytes_written = 0
+
+    return {
+        'timings': timings,
+        'bytes_read': bytes_read,
+        'bytes_written': bytes_written,
+        'pid': os.getpid(),
+        'peak_rss': peak_rss_bytes() if peak_rss is None else peak_rss,
+    }
+
+
+class StageHistogram:
+    """Cumulative time, count and fixed-bucket histogram of one stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = np.zeros(len(BUCKETS), dtype=np.int64)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[np.searchsorted(BUCKETS, seconds)] += 1
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-quantile (seconds), or None."""
+        if self.count == 0:
+            return None
+        return BUCKETS[int(np.searchsorted(np.cumsum(self.buckets), q * self.count))]
+
+
+class PipelineTelemetry:
+    """
+    Run-wide telemetry aggregated in the main process.
+
+    Workers attach a `task_sample` to each result; `observe` folds it in and
+    the JSON / Prometheus files are rewritten at most every `interval`
+    seconds (and once more by `write` at the end of the run).
+
+    Parameters:
+    -----------
+    path : str or Path
+        JSON output path; the Prometheus textfile is written next to it
+        with a .prom suffix. None keeps the telemetry in memory only.
+    interval : float
+        Minimum seconds between periodic writes
+    """
+
+    def __init__(self, path=None, interval=30.0):
+        self.path = Path(path) if path is not None else None
+        self.interval = interval
+        self.start = time.time()
+        self.last_write = self.start
+
+        self.stages = {stage: StageHistogram() for stage in STAGES}
+        self.images = {'success': 0, 'failed': 0}
+        self.datasets = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = {}
+
+    def observe(self, sample, success, dataset=None):
+        """Fold one task sample into the totals and write the files if due."""
+        self.images['success' if success else 'failed'] += 1
+        if dataset is not None:
+            self.datasets[dataset] = self.datasets.get(dataset, 0) + 1
+
+        for stage, seconds in sample['timings'].items():
+            self.stages.setdefault(stage, StageHistogram()).observe(seconds)
+        self.bytes_read += sample['bytes_read']
+        self.bytes_written += sample['bytes_written']
+        pid = str(sample['pid'])
+        self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), sample['peak_rss'])
+
+        if self.path is not None and time.time() - self.last_write >= self.interval:
+            self.write()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def images_per_second(self):
+        return sum(self.images.values()) / max(self.elapsed, 1e-9)
+
+    def snapshot(self):
+        """All telemetry as a JSON-serialisable dict."""
+        return {
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'elapsed_s': self.elapsed,
+            'images': dict(self.images),
+            'images_per_dataset': dict(self.datasets),
+            'images_per_s': self.images_per_second,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss_bytes': dict(self.peak_rss),
+            'stages': {
+                stage: {
+                    'count': hist.count,
+                    'total_s': hist.total,
+                    'mean_ms': 1e3 * hist.total / hist.count if hist.count else None,
+                    'p50_le_s': hist.quantile(0.5),
+                    'p95_le_s': hist.quantile(0.95),
+                    'buckets': {_le(b): int(n) for b, n in zip(BUCKETS, np.cumsum(hist.buckets))},
+                }
+                for stage, hist in self.stages.items()
+            },
+        }
+
+    def prometheus(self):
+        """All telemetry in the Prometheus text exposition format."""
+        lines = [
+            "# HELP macenko_stage_seconds Time spent per image in each pipeline stage.",
+            "# TYPE macenko_stage_seconds histogram",
+        ]
+        for stage, hist in self.stages.items():
+            for b, n in zip(BUCKETS, np.cumsum(hist.buckets)):
+                lines.append(f'macenko_stage_seconds_bucket{{stage="{stage}",le="{_le(b)}"}} {n}')
+            lines.append(f'macenko_stage_seconds_sum{{stage="{stage}"}} {hist.total:.6f}')
+            lines.append(f'macenko_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+
+        lines += [
+            "# HELP macenko_images_total Images processed.",
+            "# TYPE macenko_images_total counter",
+        ]
+        lines += [f'macenko_images_total{{status="{status}"}} {n}' for status, n in self.images.items()]
+        lines += [
+            "# HELP macenko_images_per_second Mean throughput since the start of the run.",
+            "# TYPE macenko_images_per_second gauge",
+            f"macenko_images_per_second {self.images_per_second:.3f}",
+            "# HELP macenko_bytes_read_total Bytes of input images read.",
+            "# TYPE macenko_bytes_read_total counter",
+            f"macenko_bytes_read_total {self.bytes_read}",
+            "# HELP macenko_bytes_written_total Bytes of normalized images written.",
+            "# TYPE macenko_bytes_written_total counter",
+            f"macenko_bytes_written_total {self.bytes_written}",
+            "# HELP macenko_worker_peak_rss_bytes Peak resident set size per worker process.",
+            "# TYPE macenko_worker_peak_rss_bytes gauge",
+        ]
+        lines += [f'macenko_worker_peak_rss_bytes{{pid="{pid}"}} {rss}' for pid, rss in self.peak_rss.items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Atomically rewrite the JSON and Prometheus files."""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(self.path, json.dumps(self.snapshot(), indent=2))
+        _write_atomic(self.path.with_suffix('.prom'), self.prometheus())
+        self.last_write = time.time()
+
+    def log_lines(self):
+        """Human-readable summary for pipeline.log."""
+        total = sum(h.total for h in self.stages.values()) or 1.0
+        lines = [f"Telemetry: {sum(self.images.values())} images in {self.elapsed:.1f} s "
+                 f"({self.images_per_second:.2f} images/s), "
+                 f"read {self.bytes_read / 1e6:.1f} MB, written {self.bytes_written / 1e6:.1f} MB"]
+        for stage, hist in self.stages.items():
+            if hist.count:
+                lines.append(f"  {stage}: {hist.total:.2f} s ({100 * hist.total / total:.1f}%), "
+                             f"mean {1e3 * hist.total / hist.count:.2f} ms, "
+                             f"p95 <= {1e3 * hist.quantile(0.95):g} ms")
+        if self.peak_rss:
+            lines.append(f"  peak RSS per worker: max {max(self.peak_rss.values()) / 2**20:.1f} MB "
+                         f"over {len(self.peak_rss)} process(es)")
+        return lines
+
+
+def _le(bound):
+    """Prometheus bucket label."""
+    return "+Inf" if bound == float('inf') else f"{bound:g}"
+
+
+def _write_atomic(path, text):
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_text(text)
+    os.replace(partial, path)
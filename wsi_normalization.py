@@ -0,0 +1,422 @@
+"""
+Whole-Slide / Large-Image Macenko Normalization
+Two-pass, constant-memory normalization of images too large for RAM.
+
+Pass 1 estimates one global stain matrix and maxC from sampled tiles using
+mergeable statistics (running covariance, angle and concentration
+histograms). Pass 2 normalizes the image tile by tile with those global
+parameters, optionally through a 3D color LUT compiled from them (see
+color_lut.py). Because the per-pixel transform is identical for every tile,
+the output has no seams.
+
+Slides are stored as .npy arrays (H x W x 3, uint8). Every tile access maps
+only the rows it needs and unmaps them afterwards, so memory use depends on
+the tile size, not on the slide size.
+"""
+
+import numpy as np
+import cv2
+from pathlib import Path
+import argparse
+import resource
+import time
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import MACENKO_PARAMS, PROCESSING, RANDOM_SEED
+from src.macenko_normalization import (
+    MacenkoNormalizer, read_image_rgb, stain_matrix_from_angles, write_image_rgb
+)
+from src.synthetic_data import synthetic_he_tile
+from src.color_lut import ColorLUT
+
+
+class SlideFile:
+    """
+    Tile-wise reader/writer for a large .npy RGB image (H x W x 3, uint8).
+
+    Each read or write memory-maps only the rows covered by the tile and
+    releases the mapping before returning.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = Path(path)
+        self.mode = mode
+
+        with open(self.path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+
+        if fortran_order or dtype != np.uint8 or len(shape) != 3 or shape[2] != 3:
+            raise ValueError(f"{self.path} is not a C-ordered H x W x 3 uint8 array")
+        self.shape = shape
+
+    @classmethod
+    def create(cls, path, height, width):
+        """Create an empty (sparse) slide file of the given size."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arr = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+        del arr
+        return cls(path, mode='r+')
+
+    def _rows(self, y0, y1, mode):
+        """Memory-map rows [y0, y1) of the slide."""
+        width = self.shape[1]
+        return np.memmap(self.path, dtype=np.uint8, mode=mode,
+                         offset=self.offset + y0 * width * 3, shape=(y1 - y0, width, 3))
+
+    def read_tile(self, y0, y1, x0, x1):
+        """Copy of the tile [y0:y1, x0:x1]."""
+        rows = self._rows(y0, y1, 'r')
+        tile = np.array(rows[:, x0:x1])
+        del rows
+        return tile
+
+    def write_tile(self, y0, x0, tile):
+        """Write a tile with its top-left corner at (y0, x0)."""
+        rows = self._rows(y0, y0 + tile.shape[0], 'r+')
+        rows[:, x0:x0 + tile.shape[1]] = tile
+        rows.flush()
+        del rows
+
+
+class InMemorySlide:
+    """Slide interface over an in-memory RGB array (used for decoded image files)."""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+
+    def read_tile(self, y0, y1, x0, x1):
+        return self.array[y0:y1, x0:x1]
+
+    def write_tile(self, y0, x0, tile):
+        self.array[y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] = tile
+
+
+class RunningCovariance:
+    """Mergeable sample covariance (Chan et al. parallel update)."""
+
+    def __init__(self, dim=3):
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.M2 = np.zeros((dim, dim))
+
+    def update(self, X):
+        """Add samples X (N x dim)."""
+        if X.shape[0] == 0:
+            return
+        other = RunningCovariance(X.shape[1])
+        other.n = X.shape[0]
+        other.mean = X.mean(axis=0)
+        centered = X - other.mean
+        other.M2 = centered.T.dot(centered)
+        self.merge(other)
+
+    def merge(self, other):
+        """Combine with another RunningCovariance."""
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.M2 = self.M2 + other.M2 + np.outer(delta, delta) * (self.n * other.n / n)
+        self.n = n
+
+    def covariance(self):
+        """Sample covariance (ddof=1), as np.cov."""
+        return self.M2 / (self.n - 1)
+
+
+class StreamingHistogram:
+    """Mergeable fixed-range histogram with approximate percentiles."""
+
+    def __init__(self, low, high, n_bins=65536):
+        self.low = low
+        self.high = high
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+
+    @property
+    def bin_width(self):
+        return (self.high - self.low) / self.counts.size
+
+    def update(self, values):
+        """Add values (out-of-range values are clipped to the edge bins)."""
+        idx = ((values - self.low) / self.bin_width).astype(np.int64)
+        np.clip(idx, 0, self.counts.size - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.counts.size)
+
+    def merge(self, other):
+        """Combine with another histogram over the same range."""
+        self.counts += other.counts
+
+    def percentile(self, q):
+        """
+        Percentile with the rank convention of np.percentile.
+
+        Samples are assumed uniformly spread inside their bin, so the error
+        is at most one bin width.
+        """
+        n = self.counts.sum()
+        rank = (n - 1) * np.true_divide(q, 100)
+        cumulative = np.cumsum(self.counts)
+        b = int(np.searchsorted(cumulative, np.floor(rank), side='right'))
+        before = cumulative[b - 1] if b > 0 else 0
+        frac = (rank - before + 0.5) / self.counts[b]
+        return self.low + (b + min(frac, 1.0)) * self.bin_width
+
+
+def tile_windows(shape, tile_size):
+    """(y0, y1, x0, x1) of every tile in row-major order."""
+    height, width = shape[:2]
+    return [(y, min(y + tile_size, height), x, min(x + tile_size, width))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def sample_windows(shape, tile_size, max_tiles=None, seed=RANDOM_SEED):
+    """Seeded random subset of tile windows (all tiles if max_tiles is None)."""
+    windows = tile_windows(shape, tile_size)
+    if max_tiles is None or len(windows) <= max_tiles:
+        return windows
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(len(windows), max_tiles, replace=False))
+    return [windows[i] for i in idx]
+
+
+def estimate_slide_stain_params(slide, normalizer, tile_size=1024, max_tiles=64,
+                                n_bins=65536, seed=RANDOM_SEED):
+    """
+    Estimate one stain matrix and maxC for a whole slide from sampled tiles.
+
+    Three streaming sweeps over the sampled tiles build mergeable
+    statistics: the covariance of tissue OD, a histogram of tissue angles in
+    the eigenvector plane, and histograms of both stain concentrations.
+
+    Parameters:
+    -----------
+    slide : SlideFile or InMemorySlide
+        Input slide
+    normalizer : MacenkoNormalizer
+        Provides Io/alpha/beta and the OD lookup tables
+    tile_size : int
+        Tile edge length in pixels
+    max_tiles : int
+        Number of tiles sampled for estimation (None = all tiles)
+    n_bins : int
+        Histogram bins for angle/concentration percentiles
+    seed : int
+        Seed for tile sampling
+
+    Returns:
+    --------
+    tuple or None : (HE, maxC), or None if no tissue was found
+    """
+    windows = sample_windows(slide.shape, tile_size, max_tiles, seed)
+
+    def tiles():
+        for window in windows:
+            pixels = slide.read_tile(*window).reshape((-1, 3))
+            yield normalizer.optical_density(pixels), normalizer.tissue_mask(pixels)
+
+    # Sweep 1: covariance of tissue OD
+    cov = RunningCovariance()
+    for OD, mask in tiles():
+        cov.update(OD[mask])
+    if cov.n < 2:
+        return None
+
+    eigvals, eigvecs = np.linalg.eigh(cov.covariance())
+    plane = eigvecs[:, 1:3]
+
+    # Sweep 2: angle distribution of tissue pixels
+    angles = StreamingHistogram(-np.pi, np.pi, n_bins)
+    for OD, mask in tiles():
+        That = OD[mask].dot(plane)
+        angles.update(np.arctan2(That[:, 1], That[:, 0]))
+
+    HE = stain_matrix_from_angles(eigvecs, angles.percentile(normalizer.alpha),
+                                  angles.percentile(100 - normalizer.alpha))
+    pinv = np.linalg.pinv(HE)
+
+    # Sweep 3: concentration distributions over all pixels; |C| is bounded
+    # by |pinv| times the largest possible |OD|
+    od_max = np.abs(normalizer.optical_density(np.array([0, 255]))).max()
+    bound = np.abs(pinv).sum(axis=1).max() * od_max
+    concentrations = [StreamingHistogram(-bound, bound, n_bins) for _ in range(2)]
+    for OD, _ in tiles():
+        C = OD.dot(pinv.T)
+        for k in range(2):
+            concentrations[k].update(C[:, k])
+
+    maxC = np.array([h.percentile(99) for h in concentrations])
+    maxC[maxC == 0] = 1.0
+
+    return HE, maxC
+
+
+def normalize_slide(slide, output, normalizer, tile_size=1024, max_tiles=64, seed=RANDOM_SEED,
+                    lut_grid=None):
+    """
+    Normalize a slide tile by tile with one global stain estimate.
+
+    Parameters:
+    -----------
+    slide : SlideFile or InMemorySlide
+        Input slide
+    output : SlideFile or InMemorySlide
+        Output slide of the same shape
+    normalizer : MacenkoNormalizer
+        Normalizer holding the reference stain state
+    tile_size : int
+        Tile edge length in pixels
+    max_tiles : int
+        Tiles sampled for stain estimation (None = all tiles)
+    seed : int
+        Seed for tile sampling
+    lut_grid : int
+        Apply the estimate through a ColorLUT with this many nodes per
+        channel (256 = exact; None = per-pixel `apply_stain_params`)
+
+    Returns:
+    --------
+    tuple or None : (HE, maxC) used for the slide, or None if no tissue
+                    (the slide is then copied unchanged)
+    """
+    params = estimate_slide_stain_params(slide, normalizer, tile_size, max_tiles, seed=seed)
+    lut = None
+    if params is not None and lut_grid is not None:
+        lut = ColorLUT(normalizer, *params, grid=lut_grid)
+
+    for window in tile_windows(slide.shape, tile_size):
+        tile = slide.read_tile(*window)
+        if lut is not None:
+            tile = lut.apply(tile)
+        elif params is not None:
+            tile = normalizer.apply_stain_params(tile, *params)
+        output.write_tile(window[0], window[2], tile)
+
+    return params
+
+
+def normalize_large_image(input_path, output_path, normalizer, tile_size=None, max_tiles=64,
+                          lut_grid=None):
+    """
+    Normalize one large image file in patches.
+
+    .npy inputs are streamed tile by tile into a .npy output; other formats
+    are decoded, normalized patch-wise with one global estimate and saved.
+
+    Returns:
+    --------
+    bool : True if successful, False otherwise
+    """
+    if tile_size is None:
+        tile_size = PROCESSING['patch_size']
+
+    try:
+        if Path(input_path).suffix.lower() == '.npy':
+            slide = SlideFile(input_path)
+            output = SlideFile.create(Path(output_path).with_suffix('.npy'), *slide.shape[:2])
+            normalize_slide(slide, output, normalizer, tile_size, max_tiles, lut_grid=lut_grid)
+            return True
+
+        img = read_image_rgb(input_path)
+        if img is None:
+            print(f"Warning: Could not read {input_path}")
+            return False
+
+        normalized = InMemorySlide(np.empty_like(img))
+        normalize_slide(InMemorySlide(img), normalized, normalizer, tile_size, max_tiles,
+                        lut_grid=lut_grid)
+        write_image_rgb(output_path, normalized.array)
+        return True
+
+    except Exception as e:
+        print(f"Error processing {input_path}: {str(e)}")
+        return False
+
+
+def write_synthetic_slide(path, height, width, tile_size=1024, seed=RANDOM_SEED):
+    """
+    Write a synthetic H&E slide of arbitrary size tile by tile.
+
+    Parameters:
+    -----------
+    path : str or Path
+        Output .npy path
+    height, width : int
+        Slide size in pixels
+    tile_size : int
+        Generation tile size (memory use scales with tile_size**2)
+    seed : int
+        Random seed
+
+    Returns:
+    --------
+    SlideFile : The written slide
+    """
+    slide = SlideFile.create(path, height, width)
+    rng = np.random.default_rng(seed)
+    for y0, y1, x0, x1 in tile_windows((height, width), tile_size):
+        slide.write_tile(y0, x0, synthetic_he_tile(y1 - y0, x1 - x0, seed=rng))
+    return SlideFile(path)
+
+
+def main():
+    """Normalize a .npy slide (optionally generating a synthetic one first)."""
+    parser = argparse.ArgumentParser(description="Streaming whole-slide Macenko normalization")
+    parser.add_argument('input', help="Input slide (.npy, H x W x 3 uint8)")
+    parser.add_argument('output', help="Output slide (.npy)")
+    parser.add_argument('--tile-size', type=int, default=PROCESSING['patch_size'])
+    parser.add_argument('--sample-tiles', type=int, default=64,
+                        help="Tiles sampled for stain estimation (default: %(default)s)")
+    parser.add_argument('--lut-grid', type=int, default=PROCESSING['lut_grid'],
+                        help="Apply the slide estimate through a 3D color LUT with this many "
+                             "nodes per channel (256 = exact, default: %(default)s = off)")
+    parser.add_argument('--synthetic', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'),
+                        help="Generate a synthetic slide of this size at INPUT first")
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+
+    if args.synthetic:
+        start = time.perf_counter()
+        write_synthetic_slide(args.input, *args.synthetic, tile_size=args.tile_size)
+        print(f"Synthetic slide {args.synthetic[0]}x{args.synthetic[1]} written to {args.input} "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    slide = SlideFile(args.input)
+    output = SlideFile.create(args.output, *slide.shape[:2])
+    normalizer = MacenkoNormalizer(
+        Io=MACENKO_PARAMS['Io'],
+        alpha=MACENKO_PARAMS['alpha'],
+        beta=MACENKO_PARAMS['beta'],
+        HERef=MACENKO_PARAMS['HERef'],
+        maxCRef=MACENKO_PARAMS['maxCRef'],
+        dtype=MACENKO_PARAMS['dtype'],
+        chunk_pixels=MACENKO_PARAMS['chunk_pixels']
+    )
+
+    start = time.perf_counter()
+    params = normalize_slide(slide, output, normalizer, args.tile_size, args.sample_tiles,
+                             lut_grid=args.lut_grid)
+    elapsed = time.perf_counter() - start
+
+    megapixels = slide.shape[0] * slide.shape[1] / 1e6
+    print(f"Normalized {slide.shape[0]}x{slide.shape[1]} slide in {elapsed:.1f}s "
+          f"({megapixels / elapsed:.1f} MP/s)")
+    if params is None:
+        print("No tissue detected; slide copied unchanged")
+    else:
+        print(f"HE:\n{params[0]}\nmaxC: {params[1]}")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
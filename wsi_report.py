@@ -0,0 +1,188 @@
+"""
+Streaming Whole-Slide Estimate Check
+Checks that the two-pass streaming stain estimate of wsi_normalization.py
+(RunningCovariance / StreamingHistogram over tiles) reproduces the
+in-memory `estimate_stain_params` on images that fit in memory.
+
+Every image is estimated as a slide of several tile sizes (including tiles
+that do not divide the image), in memory and from a tile-mapped .npy file.
+HE and maxC must agree within HE_TOLERANCE / MAXC_RTOL on tiles with at
+least MIN_TISSUE_PIXELS tissue pixels and a well-conditioned tissue
+covariance; the histogram percentiles are only that close when enough
+pixels fill the bins. Degenerate edge tiles (no tissue, one or two tissue
+pixels, flat colors) only have to give the same outcome (no tissue vs an
+estimate) without raising. The checks always run on seeded synthetic tiles
+and edge tiles, and additionally on dataset images when they are present.
+"""
+
+import numpy as np
+from pathlib import Path
+import pandas as pd
+import argparse
+import random
+import tempfile
+import warnings
+from datetime import datetime
+import sys
+
+sys.path.append(str(Path(__file__).parent.parent))
+from config.pipeline_config import DATASETS, MACENKO_PARAMS, RANDOM_SEED
+from src.macenko_normalization import (
+    NEAR_SINGULAR_EIGVAL_RATIO, MacenkoNormalizer, estimate_stain_params, read_image_rgb,
+    rgb_to_od, tissue_eigh, tissue_od
+)
+from src.run_pipeline import get_all_images
+from src.synthetic_data import edge_case_tiles, synthetic_he_tile
+from src.wsi_normalization import InMemorySlide, SlideFile, estimate_slide_stain_params
+
+# Largest allowed absolute difference of the stain matrix entries
+HE_TOLERANCE = 1e-3
+
+# Largest allowed relative difference of the maximum concentrations
+MAXC_RTOL = 1e-3
+
+# Fewer tissue pixels than this only get the outcome check
+MIN_TISSUE_PIXELS = 1024
+
+# Slide tile sizes every image is estimated with
+TILE_SIZES = (256, 1000)
+
+# Seeded synthetic tiles checked on every run: edge length -> number of tiles
+SYNTHETIC_TILES = {512: 2, 1000: 1, 2048: 1}
+
+
+def _outcome(fn, *args):
+    """(result, exception name or None) of fn(*args)."""
+    try:
+        return fn(*args), None
+    except Exception as e:
+        return None, type(e).__name__
+
+
+def well_conditioned(img, Io, beta):
+    """True if the tissue of `img` is large enough and its covariance not near-singular."""
+    ODhat = tissue_od(rgb_to_od(img.reshape((-1, 3)).astype(np.float64), Io), beta)
+    if ODhat.shape[0] < MIN_TISSUE_PIXELS:
+        return False
+    eigvals = tissue_eigh(ODhat)[0]
+    return bool(eigvals[1] > NEAR_SINGULAR_EIGVAL_RATIO * eigvals[2])
+
+
+def compare_image(img, normalizer, directory):
+    """
+    Compare the streaming estimate of `img` (as a slide) with `estimate_stain_params`.
+
+    Returns:
+    --------
+    list : One row per (tile size, storage) with the differences and a 'failure' (or None)
+    """
+    reference, ref_error = _outcome(estimate_stain_params, img, normalizer.Io,
+                                    normalizer.alpha, normalizer.beta)
+    compared = reference is not None and well_conditioned(img, normalizer.Io, normalizer.beta)
+
+    path = Path(directory) / "slide.npy"
+    on_disk = SlideFile.create(path, *img.shape[:2])
+    on_disk.write_tile(0, 0, img)
+    slides = {'memory': InMemorySlide(img), 'file': SlideFile(path)}
+
+    rows = []
+    for tile_size in TILE_SIZES:
+        for storage, slide in slides.items():
+            streamed, error = _outcome(estimate_slide_stain_params, slide, normalizer,
+                                       tile_size, None)
+            row = {'tile_size': tile_size, 'storage': storage, 'compared': compared,
+                   'he_max_diff': np.nan, 'maxc_max_rel_diff': np.nan, 'failure': None}
+            if error is not None:
+                row['failure'] = f"streaming estimate raised {error}"
+            elif (streamed is None) != (reference is None):
+                expected = 'estimate' if reference is not None else ref_error or 'no tissue'
+                got = 'estimate' if streamed is not None else 'no tissue'
+                row['failure'] = f"outcome differs (reference: {expected}, streaming: {got})"
+            elif reference is not None:
+                row['he_max_diff'] = float(np.abs(streamed[0] - reference[0]).max())
+                row['maxc_max_rel_diff'] = float((np.abs(streamed[1] - reference[1])
+                                                  / np.abs(reference[1])).max())
+                if compared and row['he_max_diff'] > HE_TOLERANCE:
+                    row['failure'] = f"HE differs by {row['he_max_diff']:.2e}"
+                elif compared and row['maxc_max_rel_diff'] > MAXC_RTOL:
+                    row['failure'] = f"maxC differs by {row['maxc_max_rel_diff']:.2e} (relative)"
+            rows.append(row)
+    return rows
+
+
+def main():
+    """Run the streaming estimate checks and exit non-zero on a mismatch."""
+    parser = argparse.ArgumentParser(description="Streaming whole-slide estimate check")
+    parser.add_argument('--n-images', type=int, default=10,
+                        help="Images sampled per dataset (default: %(default)s)")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("STREAMING WHOLE-SLIDE ESTIMATE CHECK")
+    print("="*60)
+    print(f"Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    normalizer = MacenkoNormalizer(Io=MACENKO_PARAMS['Io'], alpha=MACENKO_PARAMS['alpha'],
+                                   beta=MACENKO_PARAMS['beta'])
+
+    # (group, name, image) for every checked image
+    rng = np.random.default_rng(RANDOM_SEED)
+    cases = [('synthetic', f"synthetic {size} #{i}", synthetic_he_tile(size, seed=rng))
+             for size, n in SYNTHETIC_TILES.items() for i in range(n)]
+    cases += [('edge_cases', name, tile) for name, tile in edge_case_tiles(size=150).items()]
+    for dataset_name, config in DATASETS.items():
+        images = get_all_images(config['input_dir'])
+        if not images:
+            print(f"{dataset_name}: no images in {config['input_dir']} (synthetic checks only)")
+            continue
+        random.seed(RANDOM_SEED)
+        images = random.sample(images, min(args.n_images, len(images)))
+        cases += [(dataset_name, img_path, img_path) for img_path in images]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for group, name, img in cases:
+            if not isinstance(img, np.ndarray):
+                img = read_image_rgb(img)
+                if img is None:
+                    continue
+            with warnings.catch_warnings(), np.errstate(all='ignore'):
+                # Degenerate tiles warn in np.cov / divisions on both paths alike
+                warnings.simplefilter('ignore', RuntimeWarning)
+                rows += [{'dataset': group, 'image': str(name), **row}
+                         for row in compare_image(img, normalizer, directory)]
+
+    df = pd.DataFrame(rows)
+    summary = df[df['compared']].groupby('dataset', sort=False).agg(
+        n_images=('image', 'nunique'),
+        he_max_diff=('he_max_diff', 'max'),
+        maxc_max_rel_diff=('maxc_max_rel_diff', 'max'),
+    ).reset_index()
+
+    print("\n" + "="*60)
+    print("STREAMING VS IN-MEMORY ESTIMATE (well-conditioned images)")
+    print("="*60)
+    print(summary.to_string(index=False, float_format=lambda x: f"{x:.2e}"))
+
+    failures = df[df['failure'].notna()]
+    print("\n" + "="*60)
+    print(f"CHECKS ({df['image'].nunique()} images x {len(TILE_SIZES)} tile sizes x 2 storages)")
+    print("="*60)
+    if len(failures):
+        for _, row in failures.iterrows():
+            print(f"  FAILED {row['dataset']}: {row['image']} (tile {row['tile_size']}, "
+                  f"{row['storage']}): {row['failure']}")
+    else:
+        print(f"  All checks passed (HE within {HE_TOLERANCE:g}, maxC within {MAXC_RTOL:g} "
+              f"relative; edge tiles give the same outcome)")
+
+    output_dir = Path("results/tables")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    df.to_csv(output_dir / "wsi_estimate_check.csv", index=False)
+    print(f"\nCheck table saved to: {output_dir / 'wsi_estimate_check.csv'}")
+
+    return 1 if len(failures) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())